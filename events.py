@@ -0,0 +1,164 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import logging
+import pandas as pd
+import paypalrestsdk as pp
+
+from twilio.request_validator import RequestValidator
+
+from NGS2apis.messaging.callbacks import CallbackStore
+from NGS2apis.payments.cache import DETAIL_COLUMNS, StatusCache
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qsl, urlparse
+
+
+logger = logging.getLogger(__name__)
+log_format = '%(asctime)s | %(name)s | %(filename)s (%(lineno)d) | %(levelname)s | %(message)s'
+
+
+TWILIO_PATH = '/twilio/status'
+PAYPAL_PATH = '/paypal/webhook'
+
+
+def handle_twilio(store, params):
+    # one StatusCallback post: MessageSid, MessageStatus, To, and ErrorCode
+    # once something went wrong
+    return store.record(params['MessageSid'], params.get('To'),
+                        params['MessageStatus'], params.get('ErrorCode') or None)
+
+
+def handle_paypal(cache, event):
+    # PAYMENT.PAYOUTS-ITEM.* events carry the item as post-processing sees
+    # it; batch-level events add nothing the item events don't
+    if not event.get('event_type', '').startswith('PAYMENT.PAYOUTS-ITEM.'):
+        return False
+    item = event['resource']
+    status = item['transaction_status']
+    error = ''
+    if 'FAILED' in status:
+        error = (item.get('errors') or {}).get('name', '')
+    return cache.record(pd.DataFrame([(
+        item['payout_batch_id'], item['payout_item']['sender_item_id'],
+        item['payout_item_id'], status, error,
+    )], columns=DETAIL_COLUMNS)) > 0
+
+
+def paypal_verifier(webhook_id):
+    # checks the transmission signature against PayPal's certificate (needs
+    # pyOpenSSL)
+    def verify(headers, body):
+        try:
+            return pp.WebhookEvent.verify(
+                headers['PAYPAL-TRANSMISSION-ID'],
+                headers['PAYPAL-TRANSMISSION-TIME'], webhook_id,
+                body.decode('utf-8'), headers['PAYPAL-CERT-URL'],
+                headers['PAYPAL-TRANSMISSION-SIG'],
+                headers.get('PAYPAL-AUTH-ALGO', 'sha256'),
+            )
+        except Exception as e:
+            logger.info('PayPal webhook could not be verified: {}'.format(e))
+            return False
+    return verify
+
+
+class EventServer(ThreadingMixIn, HTTPServer):
+    # receives Twilio status callbacks and PayPal payout webhooks and writes
+    # them to the stores sms.py and paypal_post_process.py build outputs from
+    daemon_threads = True
+
+    def __init__(self, address, callbacks=None, statuses=None,
+                 auth_token=None, public_url=None, paypal_verify=None):
+        HTTPServer.__init__(self, address, EventHandler)
+        self.callbacks = callbacks
+        self.statuses = statuses
+        self.validator = RequestValidator(auth_token) if auth_token else None
+        self.public_url = public_url
+        self.paypal_verify = paypal_verify
+
+    def ingest(self, path, headers, body):
+        # returns the HTTP status to answer with; unverifiable posts are
+        # refused and recorded nowhere
+        route = urlparse(path).path
+        if route == TWILIO_PATH and self.callbacks is not None:
+            params = dict(parse_qsl(body.decode('utf-8')))
+            url = '{}{}'.format(self.public_url or
+                                'http://{}'.format(headers.get('Host')), path)
+            if self.validator is None or not self.validator.validate(
+                    url, params, headers.get('X-Twilio-Signature', '')):
+                logger.info('Refused unsigned Twilio callback.')
+                return 403
+            handle_twilio(self.callbacks, params)
+            return 204
+        if route == PAYPAL_PATH and self.statuses is not None:
+            if self.paypal_verify is None or not self.paypal_verify(headers,
+                                                                    body):
+                logger.info('Refused unverified PayPal webhook.')
+                return 403
+            try:
+                event = json.loads(body.decode('utf-8'))
+                handle_paypal(self.statuses, event)
+            except (KeyError, TypeError, ValueError) as e:
+                logger.info('Malformed PayPal webhook: {}'.format(e))
+                return 400
+            return 204
+        return 404
+
+
+class EventHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        self.send_response(self.server.ingest(self.path, self.headers, body))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(filename='event_processing.log', format=log_format,
+                        level=logging.DEBUG)
+
+    parser = argparse.ArgumentParser(description='Receive Twilio status '
+                                     'callbacks and PayPal payout webhooks.')
+    parser.add_argument('-c', '--callbacks', required=False,
+                        default='messaging/status_callbacks.db',
+                        help='SQLite store for SMS statuses, read by sms.py.')
+    parser.add_argument('-p', '--port', required=False, default=8080,
+                        type=int, help='Port to listen on.')
+    parser.add_argument('-s', '--statuses', required=False, default=None,
+                        help='Status cache of the payment ledger (e.g. '
+                        'example_payouts_statuses.db) for PayPal webhooks.')
+    parser.add_argument('-t', '--twilio_token', required=False, default=None,
+                        help='Twilio auth token, to verify callbacks.')
+    parser.add_argument('-u', '--public_url', required=False, default=None,
+                        help='Base URL Twilio and PayPal post to, when '
+                        'behind a proxy or tunnel.')
+    parser.add_argument('-w', '--webhook_id', required=False, default=None,
+                        help='PayPal webhook ID, to verify webhooks.')
+    args_dict = vars(parser.parse_args())
+
+    server = EventServer(
+        ('', args_dict['port']),
+        callbacks=CallbackStore(args_dict['callbacks']),
+        statuses=(StatusCache(args_dict['statuses']) if
+                  args_dict['statuses'] else None),
+        auth_token=args_dict['twilio_token'],
+        public_url=args_dict['public_url'],
+        paypal_verify=(paypal_verifier(args_dict['webhook_id']) if
+                       args_dict['webhook_id'] else None),
+    )
+    logger.info('Receiving events on port {}.'.format(args_dict['port']))
+    server.serve_forever()
@@ -1,11 +1,39 @@
 import requests
 
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from NGS2apis import metrics
+from NGS2apis.messaging.cache import LinkCache
+from NGS2apis.transport import Transport
+
+
+# outcome of shortening one long URL; exactly one of `url`/`error` is set, and
+# `transient` marks errors worth trying again later (outages, rate limits)
+ShortenResult = namedtuple('ShortenResult', ['long_url', 'url', 'error',
+                                             'transient'])
+ShortenResult.__new__.__defaults__ = (False, )
+
+
 class Bitly(object):
     EP = 'https://api-ssl.bitly.com'
-    def __init__(self, KEY):
+    RATE_LIMITED = 'RATE_LIMIT_EXCEEDED'
+    # seconds to back off the first time Bitly reports a rate limit
+    RATE_LIMIT_BACKOFF = 60
+    RATE_LIMIT_RETRIES = 3
+    def __init__(self, KEY, cache=None, pool_size=10, retries=3, backoff=.5,
+                 timeout=10, transport=None):
         self.key = KEY
+        self.cache = cache
+        self.timeout = timeout
 
-    def shorten(self, url, format='json'):
+        # one keep-alive pool for every call, retrying transient failures
+        self.transport = transport or Transport(
+            pool_size=pool_size, per_host=pool_size, retries=retries,
+            backoff=backoff, timeout=timeout,
+        )
+
+    def _request(self, url, format):
         URL = '{}/v3/shorten'.format(self.EP)
 
         params = {
@@ -13,10 +41,65 @@ class Bitly(object):
             'longUrl': url,
             'format': format,
         }
-        tmp = requests.get(URL, params=params)
+        return self.transport.request('GET', URL, params=params,
+                                      timeout=self.timeout).json()
+
+    def cached(self, url):
+        # previously shortened links never leave the machine
+        if self.cache is not None:
+            hit = self.cache.get(url)
+            if hit is not None:
+                return ShortenResult(url, hit, None)
+        return None
+
+    def lookup(self, url, format='json'):
+        hit = self.cached(url)
+        if hit is not None:
+            return hit
+
+        try:
+            with metrics.track('bitly', 'shorten') as call:
+                tmp = self._request(url, format)
+                if tmp.get('status_txt') == self.RATE_LIMITED:
+                    call.outcome = 'throttled'
+                elif tmp.get('status_code', 200) != 200:
+                    call.outcome = 'error'
+        except (requests.RequestException, ValueError) as e:
+            return ShortenResult(url, None, str(e), True)
 
         try:
-            return tmp.json()['data']['url']
-        except TypeError:
-            return tmp.json()['status_txt']
+            bitlink = tmp['data']['url']
+        except (TypeError, KeyError):
+            return ShortenResult(url, None, tmp.get('status_txt'),
+                                 tmp.get('status_txt') == self.RATE_LIMITED or
+                                 tmp.get('status_code', 200) >= 500)
+        if self.cache is not None:
+            self.cache.set(url, bitlink)
+        return ShortenResult(url, bitlink, None)
+
+    def shorten(self, url, format='json'):
+        result = self.lookup(url, format)
+        return result.url or result.error
+
+    def shorten_paced(self, url, bucket):
+        # wait for a token, backing off whenever Bitly says we're over the limit;
+        # cache hits make no call, so they don't spend one
+        hit = self.cached(url)
+        if hit is not None:
+            return hit
+        for attempt in range(self.RATE_LIMIT_RETRIES + 1):
+            bucket.acquire()
+            result = self.lookup(url)
+            if result.error != self.RATE_LIMITED:
+                return result
+            bucket.throttle(self.RATE_LIMIT_BACKOFF * 2 ** attempt)
+        return result
 
+    def shorten_many(self, urls, workers=1, bucket=None):
+        # results come back in the order of `urls`
+        if bucket is None:
+            call = self.lookup
+        else:
+            call = lambda url: self.shorten_paced(url, bucket)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(call, urls))
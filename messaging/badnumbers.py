@@ -0,0 +1,58 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import datetime
+import pandas as pd
+import sqlite3
+
+
+class BadNumberStore(object):
+    # stop list keyed by E.164 number; WAL mode and a busy timeout let several
+    # sms.py processes read and append at the same time
+    def __init__(self, path, timeout=30):
+        self.conn = sqlite3.connect(path, timeout=timeout)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS bad_numbers ('
+                              'number TEXT PRIMARY KEY)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS meta ('
+                              'key TEXT PRIMARY KEY, value TEXT)')
+
+    def __contains__(self, number):
+        return self.conn.execute('SELECT 1 FROM bad_numbers WHERE number = ?',
+                                 (number, )).fetchone() is not None
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM bad_numbers').fetchone()[0]
+
+    def add(self, numbers, watermark=None):
+        # new numbers and the sync watermark land in one transaction
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO bad_numbers VALUES (?)',
+                                  ((number, ) for number in numbers))
+            if watermark is not None:
+                self.conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                                  ('watermark', watermark.strftime('%Y-%m-%d')))
+
+    def isin(self, numbers, chunk=500):
+        # boolean mask over `numbers`, looked up against the index in chunks
+        numbers = pd.Series(numbers)
+        unique = numbers.dropna().unique().tolist()
+        found = set()
+        for i in range(0, len(unique), chunk):
+            batch = unique[i:i + chunk]
+            found.update(row[0] for row in self.conn.execute(
+                'SELECT number FROM bad_numbers WHERE number IN ({})'
+                .format(', '.join('?' * len(batch))), batch
+            ))
+        return numbers.isin(found).values
+
+    def watermark(self):
+        # date of the newest message already synced, if any
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?',
+                                ('watermark', )).fetchone()
+        if row is None:
+            return None
+        return datetime.datetime.strptime(row[0], '%Y-%m-%d').date()
+
+    def close(self):
+        self.conn.close()
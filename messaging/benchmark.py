@@ -0,0 +1,122 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import argparse
+import numpy as np
+import os
+import pandas as pd
+import shutil
+import tempfile
+import time
+
+from NGS2apis.messaging import sms
+from NGS2apis.messaging.dispatch import ThrottledHttpClient
+from NGS2apis.messaging.stub import TwilioStub
+from NGS2apis.stub import peak_memory_mb, start_stub
+
+
+class TimedHttpClient(ThrottledHttpClient):
+    # records (start, end) of every send so latency excludes status polling
+    sends = []
+
+    def request(self, method, url, *args, **kwargs):
+        start = time.time()
+        response = ThrottledHttpClient.request(self, method, url, *args,
+                                               **kwargs)
+        if method.upper() == 'POST':
+            self.sends.append((start, time.time()))
+        return response
+
+
+def write_recipients(path, n):
+    pd.DataFrame({
+        'ExternalDataReference': ['R{}'.format(i) for i in range(n)],
+        'SMS_PHONE_CLEAN': ['{}'.format(2000000000 + i) for i in range(n)],
+    }).to_csv(path, index=False)
+
+
+def run(args_dict):
+    stub, base_url = start_stub(TwilioStub, {
+        'latency': args_dict['latency'],
+        'error_rate': args_dict['error_rate'],
+        'max_rps': args_dict['max_rps'],
+        'status_delay': args_dict['status_delay'],
+    })
+    workdir = tempfile.mkdtemp()
+    try:
+        phones = os.path.join(workdir, 'recipients.csv')
+        content = os.path.join(workdir, 'content.txt')
+        write_recipients(phones, args_dict['recipients'])
+        with open(content, 'w') as f:
+            f.write('Benchmark message.\n')
+
+        sms.ThrottledHttpClient = TimedHttpClient
+        start = time.time()
+        sms.run({
+            'api_base': base_url,
+            'auth': ['AC{:032d}'.format(0), 'token', '+15005550006'],
+            'callback_url': None,
+            'chunksize': args_dict['chunksize'],
+            'content': content,
+            'error_check': False,
+            'max_segments': 2,
+            'nation': 'US',
+            'notify': None,
+            'phones': phones,
+            'resume': False,
+            'senders': None,
+            'sps': args_dict['sps'],
+            'status_timeout': args_dict['status_timeout'],
+            'url_link': False,
+            'workers': args_dict['workers'],
+        })
+        elapsed = time.time() - start
+        delivered = pd.read_csv(os.path.join(workdir,
+                                             'recipients_delivery.csv'))
+    finally:
+        sms.ThrottledHttpClient = ThrottledHttpClient
+        shutil.rmtree(workdir)
+        stub.terminate()
+
+    sends = np.array(TimedHttpClient.sends)
+    latency = (sends[:, 1] - sends[:, 0]) * 1000
+    send_time = max(sends[:, 1].max() - sends[:, 0].min(), 1e-6)
+    print('recipients:      {}'.format(args_dict['recipients']))
+    print('send calls:      {}'.format(len(sends)))
+    print('send throughput: {:.1f} messages/s'.format(len(sends) / send_time))
+    print('send latency:    p50 {:.1f}ms, p99 {:.1f}ms'.format(
+        np.percentile(latency, 50), np.percentile(latency, 99)))
+    print('statuses:        {}'.format(
+        ', '.join('{} {}'.format(status, count) for status, count in
+                  delivered.MessageStatus.value_counts().items())))
+    print('total run time:  {:.1f}s'.format(elapsed))
+    print('peak memory:     {:.1f}MB'.format(peak_memory_mb()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark sms.py against a '
+                                     'local Twilio stub.')
+    parser.add_argument('-c', '--chunksize', required=False, default=None,
+                        type=int, help='Rows per chunk passed to sms.py.')
+    parser.add_argument('-d', '--status_delay', required=False, default=1,
+                        type=float, help='Seconds between stub status '
+                        'changes.')
+    parser.add_argument('-e', '--error_rate', required=False, default=0,
+                        type=float, help='Share of sends the stub rejects.')
+    parser.add_argument('-l', '--latency', required=False, default=.05,
+                        type=float, help='Seconds the stub adds to every '
+                        'request.')
+    parser.add_argument('-n', '--recipients', required=False, default=10000,
+                        type=int, help='Number of synthetic recipients.')
+    parser.add_argument('-r', '--max_rps', required=False, default=None,
+                        type=float, help='Requests per second before the stub '
+                        'answers 429.')
+    parser.add_argument('-s', '--sps', required=False, default=100, type=float,
+                        help='Segments per second passed to sms.py.')
+    parser.add_argument('-t', '--status_timeout', required=False, default=30,
+                        type=float, help='Seconds sms.py waits for final '
+                        'statuses.')
+    parser.add_argument('-w', '--workers', required=False, default=8, type=int,
+                        help='Twilio calls in flight passed to sms.py.')
+    args_dict = vars(parser.parse_args())
+
+    run(args_dict)
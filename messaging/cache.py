@@ -0,0 +1,29 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import sqlite3
+import threading
+
+
+class LinkCache(object):
+    # persistent long URL -> bitlink lookup, shared by every run and worker
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS links ('
+                              'long_url TEXT PRIMARY KEY, '
+                              'bitlink TEXT NOT NULL)')
+
+    def get(self, url):
+        with self.lock:
+            row = self.conn.execute('SELECT bitlink FROM links WHERE '
+                                    'long_url = ?', (url,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, url, bitlink):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO links VALUES (?, ?)',
+                              (url, bitlink))
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import datetime
+import logging
+import sqlite3
+import threading
+import time
+
+from NGS2apis.messaging.status import TERMINAL
+
+
+logger = logging.getLogger(__name__)
+
+
+class CallbackStore(object):
+    # latest status per message sid as pushed by Twilio's StatusCallback; the
+    # receiver writes and sms.py reads, so WAL mode lets both in at once
+    def __init__(self, path, timeout=30):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=timeout,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS messages ('
+                              'sid TEXT PRIMARY KEY, phone TEXT, status TEXT, '
+                              'error TEXT, updated TEXT)')
+
+    def record(self, sid, phone, status, error=None):
+        # callbacks can arrive out of order; a final status is never replaced
+        # by an earlier one. Returns whether the status was stored
+        updated = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S')
+        with self.lock, self.conn:
+            row = self.conn.execute('SELECT status FROM messages WHERE sid = ?',
+                                    (sid, )).fetchone()
+            if row and row[0] in TERMINAL and status not in TERMINAL:
+                return False
+            self.conn.execute('INSERT OR REPLACE INTO messages VALUES '
+                              '(?, ?, ?, ?, ?)',
+                              (sid, phone, status, error, updated))
+        return True
+
+    def statuses(self, sids, chunk=500):
+        # sid -> (status, error) for the sids heard from so far
+        sids = list(sids)
+        found = {}
+        with self.lock:
+            for i in range(0, len(sids), chunk):
+                batch = sids[i:i + chunk]
+                for sid, status, error in self.conn.execute(
+                    'SELECT sid, status, error FROM messages WHERE sid IN ({})'
+                    .format(', '.join('?' * len(batch))), batch
+                ):
+                    found[sid] = (status, error)
+        return found
+
+    def close(self):
+        self.conn.close()
+
+
+def wait_for_callbacks(store, statuses, deadline, interval=1):
+    # `statuses` maps sid -> last known status; refreshed from the store until
+    # every status is terminal or `deadline` seconds pass, with no API calls
+    statuses = dict(statuses)
+    errors = {}
+    stop = time.time() + deadline
+    while True:
+        pending = [sid for sid, status in statuses.items() if
+                   status not in TERMINAL]
+        for sid, (status, error) in store.statuses(pending).items():
+            statuses[sid] = status
+            if error:
+                errors[sid] = error
+        pending = [sid for sid in pending if statuses[sid] not in TERMINAL]
+        logger.info('{} of {} statuses still pending.'.format(len(pending),
+                                                              len(statuses)))
+        if not pending or time.time() + interval > stop:
+            return statuses, errors
+        time.sleep(interval)
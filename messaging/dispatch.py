@@ -0,0 +1,206 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import json
+import logging
+import requests
+import time
+import zlib
+
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from twilio.base.exceptions import TwilioRestException
+from twilio.http import HttpClient
+from twilio.http.response import Response
+
+from NGS2apis import metrics
+from NGS2apis.transport import CircuitOpen, Transport
+
+try:
+    from urllib.parse import urlsplit, urlunsplit
+except ImportError:
+    from urlparse import urlsplit, urlunsplit
+
+
+logger = logging.getLogger(__name__)
+
+
+# recipients Twilio Notify accepts in a single notification
+NOTIFY_BATCH = 10000
+
+# outcome of one send; `sid` and `status` are set on success, `error` on failure
+SendResult = namedtuple('SendResult', ['pid', 'phone', 'sid', 'status', 'error'])
+
+
+class ThrottledHttpClient(HttpClient):
+    # the Twilio Client's HTTP client, on the package transport; a 429 holds
+    # every sender's bucket while the transport waits it out, and `base_url`
+    # sends every request to another host, e.g. a local stub
+    def __init__(self, buckets=(), pool_size=10, retries=5, backoff=1,
+                 timeout=30, base_url=None, transport=None):
+        self.is_async = False
+        self.buckets = list(buckets)
+        self.base_url = base_url
+        self.timeout = timeout
+        self.transport = transport or Transport(
+            pool_size=pool_size, per_host=pool_size, retries=retries,
+            backoff=backoff, timeout=timeout,
+        )
+
+    @property
+    def session(self):
+        return self.transport.session
+
+    @session.setter
+    def session(self, session):
+        self.transport.session = session
+
+    def throttle(self, wait):
+        # 429s are account-wide, so hold every sender, not just this one
+        logger.info('Throttled by Twilio; backing off {:.2f}s.'.format(wait))
+        for bucket in self.buckets:
+            bucket.throttle(wait)
+
+    def request(self, method, url, params=None, data=None, headers=None,
+                auth=None, timeout=None, allow_redirects=False):
+        if self.base_url:
+            base = urlsplit(self.base_url)
+            url = urlunsplit(base[:2] + urlsplit(url)[2:])
+        with metrics.track('twilio', twilio_call(method, url)) as call:
+            response = self.transport.request(
+                method, url, on_throttle=self.throttle, params=params,
+                data=data, headers=headers, auth=auth,
+                timeout=timeout or self.timeout,
+                allow_redirects=allow_redirects,
+            )
+            call.status(response.status_code)
+        return Response(int(response.status_code), response.text)
+
+
+def twilio_call(method, url):
+    # metric name for a Twilio REST call, e.g. messages.create
+    parts = urlsplit(url).path.rstrip('/').split('/')
+    resource = parts[-1].split('.')[0] if parts else ''
+    if resource.startswith(('SM', 'MM')):
+        return 'messages.fetch'
+    action = 'create' if method.upper() == 'POST' else 'list'
+    return '{}.{}'.format(resource.lower(), action)
+
+
+def assign_sender(phone, senders):
+    # sticky: a recipient always hears from the same number across runs
+    return senders[(zlib.crc32(phone.encode('utf-8')) & 0xffffffff) %
+                   len(senders)]
+
+
+def send_message(twilio, buckets, message, status_callback=None):
+    # Twilio meters throughput per segment, so a message costs one token each
+    pid, phone, body, segments = message
+    sender = assign_sender(phone, sorted(buckets))
+
+    # Messaging Service SIDs pick their own number from the service's pool
+    if sender.startswith('MG'):
+        origin = {'messaging_service_sid': sender}
+    else:
+        origin = {'from_': sender}
+    if status_callback:
+        origin['status_callback'] = status_callback
+
+    # an open circuit refuses the call before it leaves, so rather than fail
+    # the message, pause this sender until the breaker may let calls through
+    while True:
+        buckets[sender].acquire(segments)
+        try:
+            msg = twilio.messages.create(to=phone, body=body, **origin)
+        except CircuitOpen as e:
+            logger.info('Message to {} held {:.2f}s: {}'.format(phone, e.wait,
+                                                                e))
+            buckets[sender].throttle(e.wait)
+            continue
+        except TwilioRestException as e:
+            logger.info('Message to {} failed: {}'.format(phone, e.msg))
+            return SendResult(pid, phone, None, 'failed',
+                              str(e.code or e.status))
+        except requests.RequestException as e:
+            logger.info('Message to {} failed: {}'.format(phone, e))
+            return SendResult(pid, phone, None, 'failed', type(e).__name__)
+        return SendResult(pid, phone, msg.sid, msg.status, None)
+
+
+def send_messages(twilio, buckets, messages, workers, on_result=None,
+                  status_callback=None):
+    # `messages` are (pid, phone, body, segments) and `buckets` maps each
+    # sender to its own rate limiter; results come back in order and are also
+    # handed to `on_result` as each send completes. Twilio posts each status
+    # change to `status_callback`, if given. Each sender gets `workers` of its
+    # own, so a worker waiting on one sender's bucket never holds up another
+    # sender, and adding senders adds throughput
+    def send(message):
+        result = send_message(twilio, buckets, message, status_callback)
+        if on_result is not None:
+            on_result(result)
+        return result
+
+    senders = sorted(buckets)
+    pools = dict((sender, ThreadPoolExecutor(max_workers=workers)) for
+                 sender in senders)
+    start = time.time()
+    try:
+        futures = []
+        for message in messages:
+            pool = pools[assign_sender(message[1], senders)]
+            futures.append(pool.submit(send, message))
+        results = [future.result() for future in futures]
+    finally:
+        for pool in pools.values():
+            pool.shutdown()
+    elapsed = max(time.time() - start, 1e-6)
+    logger.info('Processed {} messages ({} failed) in {:.1f}s.'.format(
+        len(results), len([r for r in results if r.error]), elapsed)
+    )
+
+    # throughput per sender, to see whether adding numbers is paying off
+    sent = Counter(assign_sender(r.phone, senders) for r in results if r.sid)
+    for sender in senders:
+        logger.info('Sender {}: {} messages, {:.2f} messages per second.'
+                    .format(sender, sent[sender], sent[sender] / elapsed))
+    return results
+
+
+def notify_messages(twilio, service_sid, messages, on_result=None,
+                    batch=NOTIFY_BATCH):
+    # one identical body to many recipients through a Notify service, a
+    # handful of calls in all; Twilio fans these out to individual messages,
+    # so each result carries the notification sid until statuses are matched
+    # back by recipient
+    notifications = twilio.notify.services(service_sid).notifications
+    results = []
+    for i in range(0, len(messages), batch):
+        chunk = messages[i:i + batch]
+        bindings = [json.dumps({'binding_type': 'sms', 'address': phone}) for
+                    _, phone, __, ___ in chunk]
+        try:
+            notification = notifications.create(to_binding=bindings,
+                                                body=chunk[0][2])
+            sent = [SendResult(pid, phone, notification.sid, 'accepted', None)
+                    for pid, phone, _, __ in chunk]
+        except TwilioRestException as e:
+            logger.info('Notification for {} recipients failed: {}'.format(
+                len(chunk), e.msg)
+            )
+            sent = [SendResult(pid, phone, None, 'failed',
+                               str(e.code or e.status)) for
+                    pid, phone, _, __ in chunk]
+        except requests.RequestException as e:
+            logger.info('Notification for {} recipients failed: {}'.format(
+                len(chunk), e)
+            )
+            sent = [SendResult(pid, phone, None, 'failed', type(e).__name__)
+                    for pid, phone, _, __ in chunk]
+        for result in sent:
+            if on_result is not None:
+                on_result(result)
+        results += sent
+    logger.info('Notified {} recipients in {} calls.'.format(
+        len(results), (len(messages) + batch - 1) // batch)
+    )
+    return results
@@ -0,0 +1,58 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import datetime
+import json
+import os
+import threading
+
+from NGS2apis.messaging.dispatch import SendResult
+
+
+TIMESTAMP = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class SendJournal(object):
+    # append-only JSON lines, one per completed send, synced to disk as each
+    # send finishes so a crash loses nothing already sent; a fresh campaign
+    # starts the file over, so a later resume only sees its own sends
+    def __init__(self, path, resume=False):
+        self.lock = threading.Lock()
+        self.f = open(path, 'a' if resume else 'w')
+
+    def record(self, result):
+        line = json.dumps({
+            'ExternalDataReference': str(result.pid),
+            'phone': result.phone,
+            'sid': result.sid,
+            'status': result.status,
+            'error': result.error,
+            'timestamp': datetime.datetime.utcnow().strftime(TIMESTAMP),
+        })
+        with self.lock:
+            self.f.write(line + '\n')
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    def close(self):
+        self.f.close()
+
+
+def read_journal(path):
+    # latest result per ExternalDataReference, plus when the first send went
+    # out; a line cut short by a crash is ignored
+    results, first = {}, None
+    if not os.path.exists(path):
+        return results, first
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            results[entry['ExternalDataReference']] = SendResult(
+                entry['ExternalDataReference'], entry['phone'], entry['sid'],
+                entry['status'], entry['error'],
+            )
+            sent = datetime.datetime.strptime(entry['timestamp'], TIMESTAMP)
+            first = sent if first is None else min(first, sent)
+    return results, first
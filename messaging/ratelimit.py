@@ -0,0 +1,43 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+
+class TokenBucket(object):
+    # tokens refill at `rate` per second up to `capacity`; `throttle` empties
+    # the bucket and holds every caller when an API says we're going too fast
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(self.rate, 1))
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def acquire(self, tokens=1):
+        # never ask for more than the bucket can hold, or we'd wait forever
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self.lock:
+                now = time.time()
+                if now < self.updated:
+                    wait = self.updated - now
+                else:
+                    self._refill(now)
+                    if self.tokens >= tokens:
+                        self.tokens -= tokens
+                        return
+                    wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttle(self, seconds):
+        # pauses overlap rather than stack when many workers are throttled
+        with self.lock:
+            self.tokens = 0
+            self.updated = max(self.updated, time.time() + seconds)
@@ -0,0 +1,44 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+import re
+
+
+# GSM 03.38 default alphabet, and the extension characters that cost two
+GSM_BASIC = (u'@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !"#¤%&\'()*+,-./0123456789:;<=>?'
+             u'¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà')
+GSM_EXTENDED = u'^{}\\[~]|€\f'
+
+NON_GSM = u'[^{}]'.format(re.escape(GSM_BASIC + GSM_EXTENDED))
+EXTENDED = u'[{}]'.format(re.escape(GSM_EXTENDED))
+try:
+    # characters outside the BMP take two UTF-16 code units
+    ASTRAL = re.compile(u'[\U00010000-\U0010ffff]').pattern
+except re.error:
+    # narrow builds already count them as two
+    ASTRAL = None
+
+# (single-segment limit, per-segment limit once concatenated)
+GSM_LIMITS = (160, 153)
+UCS2_LIMITS = (70, 67)
+
+
+def segment_counts(bodies):
+    # segments per body: GSM-7 unless any character forces UCS-2
+    bodies = pd.Series(bodies).astype(str)
+    ucs2 = bodies.str.contains(NON_GSM).values
+
+    length = bodies.str.len().values
+    gsm_length = length + bodies.str.count(EXTENDED).values
+    ucs2_length = length
+    if ASTRAL is not None:
+        ucs2_length = length + bodies.str.count(ASTRAL).values
+
+    length = np.where(ucs2, ucs2_length, gsm_length)
+    single = np.where(ucs2, UCS2_LIMITS[0], GSM_LIMITS[0])
+    multi = np.where(ucs2, UCS2_LIMITS[1], GSM_LIMITS[1])
+    return pd.Series(
+        np.where(length <= single, 1, np.ceil(length / multi.astype(float))),
+        index=bodies.index,
+    ).astype(int)
@@ -1,16 +1,27 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 import argparse
+import collections
+import datetime
 import json
 import logging
 import os
 import pandas as pd
 import re
 import sys
-import time
 
+from concurrent.futures import ThreadPoolExecutor
 from twilio.rest import Client
 
+from NGS2apis import metrics
+from NGS2apis.messaging.badnumbers import BadNumberStore
+from NGS2apis.messaging.callbacks import CallbackStore, wait_for_callbacks
+from NGS2apis.messaging.dispatch import *
+from NGS2apis.messaging.journal import *
+from NGS2apis.messaging.ratelimit import TokenBucket
+from NGS2apis.messaging.segments import segment_counts
+from NGS2apis.messaging.status import *
+
 
 logger = logging.getLogger(__name__)
 log_format = '%(asctime)s | %(name)s | %(filename)s (%(lineno)d) | %(levelname)s | %(message)s'
@@ -19,45 +30,62 @@ logging.basicConfig(filename='messaging/twilio_processing.log', format=log_forma
 logging.getLogger('urllib3').setLevel(logging.INFO)
 
 
-def check_format_validity(data, ctry, link):
-    if ctry == 'US':
-        return log_length_issues(data, 10, link)
-    elif ctry == 'MA':
-        return log_length_issues(data, 9, link)
-    elif ctry == 'PH':
-        return log_length_issues(data, 10, link)
-    else:
-        pass
+# national number length and allowed leading digits per recipient country;
+# add a row here to support a new country
+COUNTRIES = pd.DataFrame([
+    ('US', '1', 10, '23456789'),
+    ('MA', '212', 9, '567'),
+    ('PH', '63', 10, '9'),
+], columns=['nation', 'prefix', 'digits', 'leading']).set_index('nation')
 
 
-def format_phone_numbers(data, ctry, link):
-    if link:
-        if ctry == 'US':
-            return [(pid, '+1{}'.format(nbr), url) for pid, nbr, url in data]
-        elif ctry == 'MA':
-            return [(pid, '+212{}'.format(nbr), url) for pid, nbr, url in data]
-        elif ctry == 'PH':
-            return [(pid, '+63{}'.format(nbr), url) for pid, nbr, url in data]
-        else:
-            sys.exit('STOP! Invalid country. Only US, MA, and PH are valid.')
-    else:
-        if ctry == 'US':
-            return [(pid, '+1{}'.format(nbr)) for pid, nbr in data]
-        elif ctry == 'MA':
-            return [(pid, '+212{}'.format(nbr)) for pid, nbr in data]
-        elif ctry == 'PH':
-            return [(pid, '+63{}'.format(nbr)) for pid, nbr in data]
-        else:
-            sys.exit('STOP! Invalid country. Only US, MA, and PH are valid.')
+def bulk_mode_test(args_dict):
+    # bulk notifications carry one body, so per-recipient links can't ride along
+    assert not (args_dict['notify'] and args_dict['url_link']), \
+    'STOP! Bulk notifications cannot include per-recipient URLs.'
 
 
-def log_length_issues(data, digits, link):
+def build_messages(data, content, link):
+    # one (pid, phone, body, segments) per recipient, with or without a link
     if link:
-        valid_nbrs = [(pid, phone, url) for pid, phone, url in data if
-                      len(str(phone)) == digits]
+        bodies = content + ' ' + data.url.astype(str)
     else:
-        valid_nbrs = [(pid, phone) for pid, phone in data if
-                      len(str(phone)) == digits]
+        bodies = pd.Series(content, index=data.index)
+    return list(zip(data.ExternalDataReference, data.phone, bodies,
+                    segment_counts(bodies)))
+
+
+def check_format_validity(data, ctry):
+    rule = country_rule(ctry)
+    valid_nbrs = log_length_issues(data, rule.digits)
+    return log_leading_issues(valid_nbrs, rule.leading)
+
+
+def country_rule(ctry):
+    if ctry not in COUNTRIES.index:
+        sys.exit('STOP! Invalid country. Only {} are valid.'
+                 .format(', '.join(COUNTRIES.index)))
+    return COUNTRIES.loc[ctry]
+
+
+def format_phone_numbers(data, ctry):
+    # E.164: plus sign, country prefix, national number
+    return data.assign(
+        phone='+' + country_rule(ctry).prefix + data.SMS_PHONE_CLEAN
+    )
+
+
+def log_leading_issues(data, leading):
+    valid_nbrs = data[data.SMS_PHONE_CLEAN.str[:1].isin(list(leading))]
+    if len(valid_nbrs) != len(data):
+        logger.info('Not all numbers start with a valid digit; {} numbers '
+                    'being dropped before sending.'
+                    .format(len(data) - len(valid_nbrs)))
+    return valid_nbrs
+
+
+def log_length_issues(data, digits):
+    valid_nbrs = data[data.SMS_PHONE_CLEAN.str.len() == digits]
     if len(valid_nbrs) != len(data):
         logger.info('Not all numbers valid length; {} numbers being dropped \
                     before sending.'.format(len(data) - len(valid_nbrs)))
@@ -65,37 +93,142 @@ def log_length_issues(data, digits, link):
 
 
 def log_numeric_issues(df, link):
+    # keep whole numbers only, as strings of digits for the checks that follow
+    columns = ['ExternalDataReference', 'SMS_PHONE_CLEAN']
     if link:
-        clean_nbrs = [
-            (pid, phone, url) for pid, phone, url in
-            zip(df.ExternalDataReference, df.SMS_PHONE_CLEAN, df.url) if
-            isinstance(phone, int)
-        ]
-    else:
-        clean_nbrs = [
-            (pid, phone) for pid, phone in
-            zip(df.ExternalDataReference, df.SMS_PHONE_CLEAN) if
-            isinstance(phone, int)
-        ]
+        columns.append('url')
+    phones = pd.to_numeric(df.SMS_PHONE_CLEAN, errors='coerce')
+    numeric = phones.notnull() & (phones % 1 == 0)
+    clean_nbrs = df.loc[numeric, columns].assign(
+        SMS_PHONE_CLEAN=phones[numeric].astype('int64').astype(str)
+    )
     if len(clean_nbrs) != len(df.SMS_PHONE_CLEAN):
         logger.info('Not all numbers numeric; {} numbers being dropped before \
                     sending.'.format(len(df.SMS_PHONE_CLEAN) - len(clean_nbrs)))
     return clean_nbrs
 
 
+def log_segment_issues(messages, budget, rate):
+    # flag bodies over the segment budget and estimate how long sending takes
+    over = [pid for pid, _, __, segments in messages if segments > budget]
+    if over:
+        logger.warning('{} messages exceed {} segments: {}.'.format(
+            len(over), budget, ', '.join(str(pid) for pid in over[:20]))
+        )
+    total = sum(segments for _, __, ___, segments in messages)
+    logger.info('Sending {} messages as {} segments; about {:.0f} seconds at '
+                '{} segments per second.'.format(len(messages), total,
+                                                  total / float(rate), rate))
+    return over
+
+
+def log_url_issues(df, link):
+    # rows whose link failed to shorten have no URL to send
+    if not link:
+        return df
+    missing = df.url.isnull()
+    if 'url_error' in df.columns:
+        missing |= df.url_error.notnull()
+    if missing.any():
+        logger.info('Not all rows have a shortened URL; {} numbers being '
+                    'dropped before sending: {}.'.format(
+                        missing.sum(), ', '.join(
+                            str(pid) for pid in
+                            df.ExternalDataReference[missing][:20])))
+    return df[~missing]
+
+
 def msg_exists_test(content):
     assert content, 'STOP! Message content is empty.'
 
 
 def phone_checks(df, nation, link):
-    numeric_numbers = log_numeric_issues(df, link)
-    valid_numbers = check_format_validity(numeric_numbers, nation, link)
+    linked = log_url_issues(df, link)
+    numeric_numbers = log_numeric_issues(linked, link)
+    valid_numbers = check_format_validity(numeric_numbers, nation)
     return valid_numbers
 
 
+def prepare_chunk(d, args_dict, badnums, sent_before):
+    # test phone numbers
+    valid_numbers = phone_checks(d, args_dict['nation'], args_dict['url_link'])
+
+    # format phone numbers
+    formatted_numbers = format_phone_numbers(valid_numbers, args_dict['nation'])
+
+    # cross-check (and remove) known bad numbers
+    if badnums is not None:
+        formatted_numbers = formatted_numbers[
+            ~badnums.isin(formatted_numbers.phone)
+        ]
+
+    # skip anyone the journal shows was already sent to; failures are retried
+    if sent_before:
+        done = formatted_numbers.ExternalDataReference.astype(str)
+        formatted_numbers = formatted_numbers[~done.isin(list(sent_before))]
+    return formatted_numbers
+
+
+def settle_chunk(twilio, d, results, sent_after, senders, args_dict,
+                 callbacks=None):
+    # poll statuses in bulk until they settle or the deadline passes, or wait
+    # on the statuses Twilio pushes to the callback store
+    with metrics.stage('settle'):
+        if args_dict['notify']:
+            # bulk sends only know their notification, so match on recipient
+            found = reconcile_recipients(
+                twilio, [r.phone for r in results if r.sid], sent_after,
+                args_dict['status_timeout'],
+            )
+            results = [r._replace(sid=found[r.phone][0],
+                                  status=found[r.phone][1]) if
+                       found.get(r.phone, (None, ))[0] else r for r in results]
+        elif callbacks is not None:
+            statuses, errors = wait_for_callbacks(
+                callbacks, dict((r.sid, r.status) for r in results if r.sid),
+                args_dict['status_timeout'],
+            )
+            results = [r._replace(status=statuses.get(r.sid, r.status),
+                                  error=errors.get(r.sid, r.error)) for
+                       r in results]
+        else:
+            # the listing can only be narrowed to a sender when there is just
+            # one
+            single = len(senders) == 1 and not senders[0].startswith('MG')
+            statuses = reconcile_statuses(
+                twilio, dict((r.sid, r.status) for r in results if r.sid),
+                sent_after, args_dict['status_timeout'],
+                from_=senders[0] if single else None,
+            )
+            results = [r._replace(status=statuses.get(r.sid, r.status)) for
+                       r in results]
+
+    # log delivery code
+    delivery = pd.DataFrame(
+        [(r.pid, r.status, r.sid, r.error) for r in results],
+        columns=['ExternalDataReference', 'MessageStatus', 'MessageReference',
+                 'MessageError'],
+    )
+
+    # merge delivery code back to input data
+    d['ExternalDataReference'] = d.ExternalDataReference.astype(str)
+    delivery['ExternalDataReference'] = delivery.ExternalDataReference.astype(str)
+    return d.merge(delivery, on='ExternalDataReference', how='left')
+
+
+def finish_chunk(settling, output):
+    # wait for a chunk to settle, then append; the first chunk starts the file
+    d = settling.result()
+    with metrics.stage('write'):
+        d.to_csv(output, mode='a', header=not os.path.exists(output),
+                 index=False)
+
+
 def run(args_dict):
-    # start logger
+    # start logger; call and stage metrics are written next to the phone
+    # worksheet when the run ends
     logger.info('Starting transactions for {}.'.format(args_dict['phones']))
+    registry = metrics.reset()
 
     # load message content
     with open(args_dict['content'], 'r') as f:
@@ -103,117 +236,125 @@ def run(args_dict):
 
     # test message content
     msg_exists_test(msg_content)
+    bulk_mode_test(args_dict)
+
+    # authenticate client; each sender gets its own segment budget and
+    # workers, and all of them absorb 429 backoffs
+    senders = [args_dict['auth'][2]] + (args_dict['senders'] or [])
+    buckets = dict((sender, TokenBucket(args_dict['sps'],
+                                        capacity=args_dict['sps']))
+                   for sender in senders)
+    twilio = Client(args_dict['auth'][0], args_dict['auth'][1],
+                    http_client=ThrottledHttpClient(
+                        buckets.values(),
+                        pool_size=args_dict['workers'] * len(senders),
+                        base_url=args_dict['api_base']))
 
-    # load phone number worksheet
-    d = pd.read_csv(args_dict['phones'], sep=None, engine='python')
+    # check for bad numbers
+    badnums = None
+    if args_dict['error_check']:
+        badnums = BadNumberStore('messaging/bad_numbers.db')
 
-    # test phone numbers
-    valid_numbers = phone_checks(d, args_dict['nation'], args_dict['url_link'])
+        # carry over the running tally kept before the store existed
+        if not len(badnums) and os.path.exists('messaging/bad_numbers.json'):
+            with open('messaging/bad_numbers.json', 'r') as f:
+                badnums.add(json.load(f))
 
-    # format phone numbers
-    formatted_numbers = format_phone_numbers(valid_numbers, args_dict['nation'],
-                                             args_dict['url_link'])
+        # gather error numbers sent since the last sync (the day of the last
+        # sync is fetched again, since Twilio filters by date only)
+        with metrics.stage('sync'):
+            prev_badnums, newest = sync_error_numbers(
+                twilio, since=badnums.watermark())
 
-    # authenticate client
-    twilio = Client(args_dict['auth'][0], args_dict['auth'][1])
+        # update tally and move the watermark together
+        badnums.add(prev_badnums, watermark=newest)
 
-    # check for bad numbers
-    if args_dict['error_check']:
-        # gather previous error numbers
-        total_errors = [(x.to, x.error_code) for x in twilio.messages.list() if
-                        x.error_code]
-        prev_badnums = list(set([x[0] for x in total_errors if x[1]!=30001]))
-
-        # open up running tally of bad numbers
-        with open('messaging/bad_numbers.json', 'r') as f:
-            badnums = json.load(f)
-
-        # update tally
-        badnums += [x for x in prev_badnums if x not in badnums]
-
-        # cross-check (and remove) current numbers
-        formatted_numbers = [x for x in formatted_numbers if not x[1] in badnums]
-
-        # write out bad numbers for future use
-        with open('messaging/bad_numbers.json', 'w') as f:
-            json.dump(badnums, f)
-
-    # chunk large sends into batches
-    msgs = []
-    if len(formatted_numbers) > 75:
-        length = len(formatted_numbers)
-        beg = [x*75 for x in xrange(length/75 + 1)]
-        end = [x+75 for x in beg]
-        end[-1] = end[-2] + length%75
-        for b, e in zip(beg, end):
-            if args_dict['url_link']:
-                for _, phone, url in formatted_numbers[b:e]:
-                    try:
-                        msgs.append(twilio.messages.create(
-                            to=phone,
-                            from_=args_dict['auth'][2],
-                            body='{} {}'.format(msg_content, url),
-                        ))
-                    except:
-                        pass
-            else:
-                for _, phone in formatted_numbers[b:e]:
-                    try:
-                        msgs.append(twilio.messages.create(
-                            to=phone,
-                            from_=args_dict['auth'][2],
-                            body=msg_content,
-                        ))
-                    except:
-                        pass
-            logger.info('Processed {} messages.'.format(len(msgs)))
-            time.sleep(10)
-    else:
-        if args_dict['url_link']:
-            for _, phone, url in formatted_numbers:
-                try:
-                    msgs.append(twilio.messages.create(
-                        to=phone,
-                        from_=args_dict['auth'][2],
-                        body='{} {}'.format(msg_content, url),
-                    ))
-                except:
-                    pass
-        else:
-            for _, phone in formatted_numbers:
-                try:
-                    msgs.append(twilio.messages.create(
-                        to=phone,
-                        from_=args_dict['auth'][2],
-                        body=msg_content,
-                    ))
-                except:
-                    pass
-        logger.info('Processed {} messages.'.format(len(msgs)))
-
-    # sleep for one minute to queue messaging status for return
-    time.sleep(45)
+    # with a callback URL, Twilio pushes statuses to the event receiver
+    # (events.py), which shares this store, so nothing needs polling
+    callbacks = None
+    if args_dict['callback_url'] and not args_dict['notify']:
+        callbacks = CallbackStore('messaging/status_callbacks.db')
 
-    # log delivery code
-    if args_dict['url_link']:
-        delivery = pd.DataFrame(
-            [(pid, msg.fetch().status, msg.sid) for pid, msg in
-             zip([pid for pid, _, __ in formatted_numbers], msgs)],
-            columns=['ExternalDataReference', 'MessageStatus', 'MessageReference'],
-        )
+    # recipients already sent to, according to the journal
+    fileparts = os.path.splitext(args_dict['phones'])
+    journal_path = '{}_journal.jsonl'.format(fileparts[0])
+    sent_before, first = {}, None
+    if args_dict['resume']:
+        journaled, first = read_journal(journal_path)
+        sent_before = dict((pid, r) for pid, r in journaled.items() if r.sid)
+        logger.info('Resuming; {} recipients already sent.'
+                    .format(len(sent_before)))
+
+    # load phone number worksheet, all at once or a chunk at a time
+    if args_dict['chunksize']:
+        chunks = pd.read_csv(args_dict['phones'], sep=None, engine='python',
+                             chunksize=args_dict['chunksize'])
     else:
-        delivery = pd.DataFrame(
-            [(pid, msg.fetch().status, msg.sid) for pid, msg in
-             zip([pid for pid, _ in formatted_numbers], msgs)],
-            columns=['ExternalDataReference', 'MessageStatus', 'MessageReference'],
-        )
+        chunks = [pd.read_csv(args_dict['phones'], sep=None, engine='python')]
+    output = '{}_delivery{}'.format(fileparts[0], fileparts[1])
+    if os.path.exists(output):
+        os.remove(output)
+
+    # send chunk after chunk while earlier ones settle in the background;
+    # settled chunks are appended in order, and once `workers` + 1 chunks are
+    # held the next is read only after the oldest is written, so memory stays
+    # bounded however slowly statuses settle
+    journal = SendJournal(journal_path, resume=args_dict['resume'])
+    writes = collections.deque()
+    try:
+        with ThreadPoolExecutor(args_dict['workers']) as settlers, \
+                ThreadPoolExecutor(max_workers=1) as writer:
+            for d in chunks:
+                with metrics.stage('prepare'):
+                    formatted_numbers = prepare_chunk(d, args_dict, badnums,
+                                                      sent_before)
+                    messages = build_messages(formatted_numbers, msg_content,
+                                              args_dict['url_link'])
+
+                # send messages concurrently at the configured rate,
+                # journaling each one
+                log_segment_issues(messages, args_dict['max_segments'],
+                                   args_dict['sps'] * len(senders))
+                sent_after = datetime.datetime.utcnow()
+                with metrics.stage('send'):
+                    if args_dict['notify']:
+                        results = notify_messages(twilio, args_dict['notify'],
+                                                  messages,
+                                                  on_result=journal.record)
+                    else:
+                        results = send_messages(
+                            twilio, buckets, messages, args_dict['workers'],
+                            on_result=journal.record,
+                            status_callback=args_dict['callback_url'],
+                        )
+
+                # fold in this chunk's recipients sent on an earlier run
+                pids = d.ExternalDataReference.astype(str)
+                earlier = [sent_before[pid] for pid in pids if
+                           pid in sent_before]
+                if earlier:
+                    sent_after = min(first, sent_after)
+                results = earlier + results
+
+                settling = settlers.submit(settle_chunk, twilio, d, results,
+                                           sent_after, senders, args_dict,
+                                           callbacks)
+                writes.append(writer.submit(finish_chunk, settling, output))
+
+                # surface a failed settle or write without waiting on the rest
+                while writes and (writes[0].done() or
+                                  len(writes) > args_dict['workers'] + 1):
+                    writes.popleft().result()
+            while writes:
+                writes.popleft().result()
+    finally:
+        journal.close()
+        if badnums is not None:
+            badnums.close()
+        if callbacks is not None:
+            callbacks.close()
+        registry.write(fileparts[0])
 
-    # merge delivery code back to input data
-    d = d.merge(delivery, on='ExternalDataReference', how='left')
-
-    # output data
-    fileparts = os.path.splitext(args_dict['phones'])
-    d.to_csv('{}_delivery{}'.format(fileparts[0], fileparts[1]), index=False)
     logger.info('Closing log for {}.\n'.format(args_dict['phones']))
 
 
@@ -221,19 +362,53 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Send SMS via Twilio.')
     parser.add_argument('-a', '--auth', required=True, nargs=3, help='API '
                         'authorization SID, token, and sending phone number '
-                        '(in that order).')
+                        'or Messaging Service SID (in that order).')
+    parser.add_argument('-b', '--api_base', required=False, default=None,
+                        help='Send Twilio API calls to this base URL instead, '
+                        'e.g. a local stub (see stub.py).')
     parser.add_argument('-c', '--content', required=True, help='Path/file to '
                         'txt with message content information.')
+    parser.add_argument('-d', '--chunksize', required=False, default=None,
+                        type=int, help='Stream the phone file this many rows '
+                        'at a time, appending delivery rows as each chunk '
+                        'settles.')
     parser.add_argument('-e', '--error_check', action='store_true',
                         help='Indicate if phone numbers should be checked '
                         'against a known bad/stop list.')
+    parser.add_argument('-f', '--senders', required=False, nargs='+',
+                        help='Additional sending phone numbers or Messaging '
+                        'Service SIDs; recipients are spread across all '
+                        'senders.')
+    parser.add_argument('-k', '--callback_url', required=False, default=None,
+                        help='Public URL of the event receiver\'s '
+                        '/twilio/status endpoint (see events.py); statuses '
+                        'are then pushed by Twilio instead of polled. Bulk '
+                        'notifications still poll.')
     parser.add_argument('-l', '--url_link', action='store_true',
                         help='Indicates if a URL should be sent with the SMS.')
+    parser.add_argument('-m', '--max_segments', required=False, default=2,
+                        type=int, help='Segment budget per message; longer '
+                        'bodies are flagged in the log before sending.')
     parser.add_argument('-n', '--nation', required=True,
-                        choices=['MA', 'US', 'PH'], help='Country 2-letter ISO '
+                        choices=list(COUNTRIES.index), help='Country 2-letter ISO '
                         'code for recipients.')
+    parser.add_argument('-o', '--notify', required=False, help='Twilio Notify '
+                        'service SID; sends one identical message to every '
+                        'recipient in bulk instead of one call per number.')
     parser.add_argument('-p', '--phones', required=True, help='Path/file to '
                         'csv with phone delivery information.')
+    parser.add_argument('-r', '--resume', action='store_true',
+                        help='Skip recipients already sent to according to '
+                        'the send journal and retry only failures.')
+    parser.add_argument('-s', '--sps', required=False, default=10, type=float,
+                        help='Target message segments per second for each '
+                        'sender.')
+    parser.add_argument('-t', '--status_timeout', required=False, default=300,
+                        type=float, help='Seconds to wait for delivery '
+                        'statuses to become final.')
+    parser.add_argument('-w', '--workers', required=False, default=4, type=int,
+                        help='Number of Twilio calls to keep in flight per '
+                        'sender.')
     args_dict = vars(parser.parse_args())
 
     run(args_dict)
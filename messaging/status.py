@@ -0,0 +1,78 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+# statuses Twilio will not move a message out of
+TERMINAL = {'canceled', 'delivered', 'failed', 'read', 'received', 'undelivered'}
+
+# error codes that say nothing about the number itself (queue overflow)
+TRANSIENT_ERRORS = {30001}
+
+
+def poll_messages(twilio, known, key, sent_after, deadline, from_=None,
+                  interval=5, max_interval=60, page_size=1000):
+    # `known` maps a message attribute (`key`) to its last (sid, status); pages
+    # through the messages sent since `sent_after` and joins them locally,
+    # backing off until every status is terminal or `deadline` seconds pass
+    known = dict(known)
+    pending = set(k for k, (sid, status) in known.items() if
+                  status not in TERMINAL)
+    filters = {'date_sent_after': sent_after, 'page_size': page_size}
+    if from_ is not None:
+        filters['from_'] = from_
+
+    stop = time.time() + deadline
+    wait = interval
+    while pending and time.time() + wait <= stop:
+        time.sleep(wait)
+        wait = min(wait * 2, max_interval)
+
+        # listings are newest first, so only the first match per key counts
+        matched = set()
+        for msg in twilio.messages.stream(**filters):
+            k = getattr(msg, key)
+            if k in pending and k not in matched:
+                matched.add(k)
+                known[k] = (msg.sid, msg.status)
+                if msg.status in TERMINAL:
+                    pending.discard(k)
+        logger.info('{} of {} statuses still pending.'.format(len(pending),
+                                                              len(known)))
+    return known
+
+
+def reconcile_recipients(twilio, phones, sent_after, deadline, **kwargs):
+    # phone -> (sid, status), for sends that never returned a message sid
+    known = dict((phone, (None, 'accepted')) for phone in phones)
+    return poll_messages(twilio, known, 'to', sent_after, deadline, **kwargs)
+
+
+def reconcile_statuses(twilio, statuses, sent_after, deadline, **kwargs):
+    # `statuses` maps sid -> last known status; returns the same, refreshed
+    known = dict((sid, (sid, status)) for sid, status in statuses.items())
+    known = poll_messages(twilio, known, 'sid', sent_after, deadline, **kwargs)
+    return dict((sid, status) for sid, (_, status) in known.items())
+
+
+def sync_error_numbers(twilio, since=None, page_size=1000):
+    # numbers with a lasting error among messages sent on or after `since`,
+    # plus the newest send date seen; Twilio filters the listing by date only,
+    # so errors are picked out page by page as they stream in
+    filters = {'page_size': page_size}
+    if since is not None:
+        filters['date_sent_after'] = since
+
+    badnums = set()
+    newest = since
+    for msg in twilio.messages.stream(**filters):
+        if msg.date_sent is not None:
+            sent = msg.date_sent.date()
+            newest = sent if newest is None else max(newest, sent)
+        if msg.error_code and msg.error_code not in TRANSIENT_ERRORS:
+            badnums.add(msg.to)
+    return badnums, newest
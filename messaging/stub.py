@@ -0,0 +1,194 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import argparse
+import collections
+import datetime
+import email.utils
+import itertools
+import re
+import time
+
+from NGS2apis.stub import JSONHandler, StubServer
+
+try:
+    from urllib.parse import parse_qs, urlencode, urlparse
+except ImportError:
+    from urllib import urlencode
+    from urlparse import parse_qs, urlparse
+
+
+# local stand-in for the slice of the Twilio Messages API that sms.py uses
+MESSAGES = re.compile(r'^/2010-04-01/Accounts/(\w+)/Messages(?:/(\w+))?\.json$')
+
+
+class TwilioStub(StubServer):
+    def __init__(self, address=('127.0.0.1', 0), latency=0, error_rate=0,
+                 error_code=21211, max_rps=None, status_delay=1,
+                 undelivered_rate=0, seed=None):
+        StubServer.__init__(self, address, StubHandler, latency, error_rate,
+                            max_rps, seed)
+        self.error_code = error_code
+        self.status_delay = status_delay
+        self.undelivered_rate = undelivered_rate
+        self.messages = collections.OrderedDict()
+        self.sids = itertools.count()
+
+    def create(self, account, form):
+        with self.lock:
+            self.counts['create'] += 1
+            if self.random.random() < self.error_rate:
+                self.counts['rejected'] += 1
+                return 400, {'code': self.error_code, 'status': 400,
+                             'message': 'The To number is not valid.'}
+            msg = {
+                'sid': 'SM{:032d}'.format(next(self.sids)),
+                'account_sid': account,
+                'to': form.get('To'),
+                'from': form.get('From'),
+                'messaging_service_sid': form.get('MessagingServiceSid'),
+                'body': form.get('Body'),
+                'created': time.time(),
+                'undelivered': self.random.random() < self.undelivered_rate,
+            }
+            self.messages[msg['sid']] = msg
+        return 201, self.render(msg)
+
+    def render(self, msg):
+        # statuses advance queued -> sent -> delivered/undelivered with age
+        age = time.time() - msg['created']
+        if age < self.status_delay:
+            status, error = 'queued', None
+        elif age < 2 * self.status_delay:
+            status, error = 'sent', None
+        elif msg['undelivered']:
+            status, error = 'undelivered', 30003
+        else:
+            status, error = 'delivered', None
+        stamp = email.utils.formatdate(msg['created'], usegmt=True)
+        return {
+            'sid': msg['sid'],
+            'account_sid': msg['account_sid'],
+            'to': msg['to'],
+            'from': msg['from'],
+            'messaging_service_sid': msg['messaging_service_sid'],
+            'body': msg['body'],
+            'status': status,
+            'error_code': error,
+            'num_segments': '1',
+            'direction': 'outbound-api',
+            'date_created': stamp,
+            'date_sent': stamp,
+            'date_updated': stamp,
+        }
+
+    def fetch(self, sid):
+        with self.lock:
+            self.counts['fetch'] += 1
+            msg = self.messages.get(sid)
+        if msg is None:
+            return 404, {'code': 20404, 'status': 404,
+                         'message': 'The requested resource was not found.'}
+        return 200, self.render(msg)
+
+    def list(self, account, query):
+        # newest first, filtered like Twilio and paged by offset tokens
+        with self.lock:
+            self.counts['list'] += 1
+            msgs = list(reversed(self.messages.values()))
+        after = parse_date(query.get('DateSent>'))
+        msgs = [msg for msg in msgs if
+                (not query.get('To') or msg['to'] == query['To']) and
+                (not query.get('From') or msg['from'] == query['From']) and
+                (after is None or msg['created'] >= after)]
+
+        size = int(query.get('PageSize', 50))
+        offset = int(query.get('PageToken', 0))
+        page = msgs[offset:offset + size]
+        uri = '/2010-04-01/Accounts/{}/Messages.json'.format(account)
+        next_uri = None
+        if offset + size < len(msgs):
+            params = dict(query, PageToken=offset + size,
+                          Page=int(query.get('Page', 0)) + 1)
+            next_uri = '{}?{}'.format(uri, urlencode(sorted(params.items())))
+        return 200, {
+            'messages': [self.render(msg) for msg in page],
+            'next_page_uri': next_uri,
+            'page': int(query.get('Page', 0)),
+            'page_size': size,
+            'uri': uri,
+        }
+
+
+def parse_date(value):
+    # Twilio accepts a date or a full timestamp for DateSent filters
+    if not value:
+        return None
+    for fmt in ('%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%d'):
+        try:
+            moment = datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        return (moment - datetime.datetime(1970, 1, 1)).total_seconds()
+    return None
+
+
+class StubHandler(JSONHandler):
+    def route(self):
+        parts = urlparse(self.path)
+        match = MESSAGES.match(parts.path)
+        if match is None:
+            self.respond(404, {'code': 20404, 'status': 404,
+                               'message': 'Unknown resource.'})
+            return None, None, None
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.throttled():
+            self.respond(429, {'code': 20429, 'status': 429,
+                               'message': 'Too Many Requests'},
+                         {'Retry-After': '1'})
+            return None, None, None
+        query = dict((k, v[-1]) for k, v in parse_qs(parts.query).items())
+        return match.group(1), match.group(2), query
+
+    def do_GET(self):
+        account, sid, query = self.route()
+        if account is None:
+            return
+        if sid is None:
+            self.respond(*self.server.list(account, query))
+        else:
+            self.respond(*self.server.fetch(sid))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        form = parse_qs(self.rfile.read(length).decode('utf-8'))
+        account, _, __ = self.route()
+        if account is None:
+            return
+        self.respond(*self.server.create(account,
+                                         dict((k, v[-1]) for k, v in
+                                              form.items())))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a local stand-in for '
+                                     'the Twilio Messages API.')
+    parser.add_argument('-d', '--status_delay', required=False, default=1,
+                        type=float, help='Seconds between status changes.')
+    parser.add_argument('-e', '--error_rate', required=False, default=0,
+                        type=float, help='Share of sends rejected with an '
+                        'error code.')
+    parser.add_argument('-l', '--latency', required=False, default=0,
+                        type=float, help='Seconds added to every request.')
+    parser.add_argument('-p', '--port', required=False, default=8099, type=int,
+                        help='Port to listen on.')
+    parser.add_argument('-t', '--max_rps', required=False, default=None,
+                        type=float, help='Requests per second before '
+                        'answering 429.')
+    parser.add_argument('-u', '--undelivered_rate', required=False, default=0,
+                        type=float, help='Share of messages that end up '
+                        'undelivered.')
+    args_dict = vars(parser.parse_args())
+
+    port = args_dict.pop('port')
+    TwilioStub(('127.0.0.1', port), **args_dict).serve_forever()
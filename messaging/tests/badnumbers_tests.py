@@ -0,0 +1,27 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import datetime
+import pytest
+
+from NGS2apis.messaging.badnumbers import *
+
+
+@pytest.mark.parametrize('test_bad, test_numbers, expected', [
+    (['+11111111111'], ['+11111111111', '+12222222222', '+11111111111'],
+     [True, False, True]),
+    ([], ['+11111111111'], [False]),
+])
+def test_bad_number_store_isin(tmpdir, test_bad, test_numbers, expected):
+    store = BadNumberStore(str(tmpdir.join('bad.db')))
+    store.add(test_bad)
+    assert store.isin(test_numbers, chunk=1).tolist() == expected
+
+
+def test_bad_number_store_shared(tmpdir):
+    path = str(tmpdir.join('bad.db'))
+    first, second = BadNumberStore(path), BadNumberStore(path)
+    first.add(['+11111111111', '+11111111111'], watermark=datetime.date(2017, 7, 3))
+    second.add(['+11111111111', '+12222222222'])
+    assert '+12222222222' in first
+    assert len(first) == 2
+    assert second.watermark() == datetime.date(2017, 7, 3)
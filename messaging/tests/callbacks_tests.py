@@ -0,0 +1,31 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import pytest
+
+from NGS2apis.messaging.callbacks import *
+
+
+@pytest.mark.parametrize('events, expected', [
+    ([('SM1', 'sent'), ('SM1', 'delivered')], 'delivered'),
+    ([('SM1', 'delivered'), ('SM1', 'sent')], 'delivered'),
+    ([('SM1', 'queued'), ('SM1', 'sent')], 'sent'),
+])
+def test_callback_store_order(tmpdir, events, expected):
+    store = CallbackStore(str(tmpdir.join('callbacks.db')))
+    for sid, status in events:
+        store.record(sid, '+12025550100', status)
+    assert store.statuses(['SM1'])['SM1'][0] == expected
+
+
+def test_wait_for_callbacks(tmpdir):
+    store = CallbackStore(str(tmpdir.join('callbacks.db')))
+    store.record('SM1', '+12025550100', 'delivered')
+    store.record('SM2', '+12025550101', 'undelivered', '30003')
+    store.record('SM3', '+12025550102', 'sent')
+    statuses, errors = wait_for_callbacks(
+        store, {'SM1': 'queued', 'SM2': 'queued', 'SM3': 'queued',
+                'SM4': 'queued'}, deadline=.2, interval=.05,
+    )
+    assert statuses == {'SM1': 'delivered', 'SM2': 'undelivered',
+                        'SM3': 'sent', 'SM4': 'queued'}
+    assert errors == {'SM2': '30003'}
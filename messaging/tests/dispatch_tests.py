@@ -0,0 +1,175 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import pytest
+import time
+
+from NGS2apis.messaging.dispatch import *
+from NGS2apis.messaging.ratelimit import TokenBucket
+from NGS2apis.transport import CircuitOpen, retry_after
+
+
+class FakeMessages(object):
+    def __init__(self, fail=(), delay=0):
+        self.fail = fail
+        self.delay = delay
+        self.origins = []
+
+    def create(self, to, body, **origin):
+        self.origins.append(origin)
+        time.sleep(self.delay)
+        if self.fail and isinstance(self.fail[0], Exception):
+            raise self.fail.pop(0)
+        if to in self.fail:
+            raise TwilioRestException(400, '/Messages.json', 'Invalid number',
+                                      code=21211)
+        return type('Message', (object, ), {'sid': 'SM{}'.format(to),
+                                            'status': 'queued'})
+
+
+class FakeNotifications(object):
+    def __init__(self, fail):
+        self.fail = fail
+        self.calls = []
+
+    def create(self, to_binding, body):
+        self.calls.append(len(to_binding))
+        if isinstance(self.fail, Exception):
+            raise self.fail
+        if self.fail:
+            raise TwilioRestException(500, '/Notifications', 'Down', code=None)
+        return type('Notification', (object, ), {'sid': 'NT1'})
+
+
+class FakeTwilio(object):
+    def __init__(self, fail=(), delay=0):
+        self.messages = FakeMessages(fail, delay)
+        self.notifications = FakeNotifications(fail)
+        self.notify = self
+
+    def services(self, sid):
+        return self
+
+
+class FakeSession(object):
+    def __init__(self, statuses, headers=None):
+        self.statuses = list(statuses)
+        self.headers = headers or {}
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        return type('Response', (object, ), {
+            'status_code': self.statuses.pop(0),
+            'headers': self.headers,
+            'text': '{}',
+        })
+
+
+@pytest.mark.parametrize('test_headers, test_default, expected', [
+    ({'Retry-After': '3'}, 1, 3),
+    ({}, 1, 1),
+    ({'Retry-After': 'soon'}, 2, 2),
+])
+def test_retry_after(test_headers, test_default, expected):
+    assert retry_after(test_headers, test_default) == expected
+
+
+@pytest.mark.parametrize('test_messages, test_fail, expected', [
+    (
+        [('A1', '+11111111111', 'hi', 1), ('A2', '+12222222222', 'hi', 2)],
+        ('+12222222222', ),
+        [SendResult('A1', '+11111111111', 'SM+11111111111', 'queued', None),
+         SendResult('A2', '+12222222222', None, 'failed', '21211')],
+    ),
+])
+def test_send_messages(test_messages, test_fail, expected):
+    result = send_messages(FakeTwilio(test_fail),
+                           {'+10000000000': TokenBucket(1000)}, test_messages, 2)
+    assert result == expected
+
+
+def test_send_message_circuit_open():
+    # an open circuit holds the sender for its cooldown, then the message goes
+    twilio = FakeTwilio([CircuitOpen('open', .1)])
+    buckets = {'+10000000000': TokenBucket(1000)}
+    start = time.time()
+    result = send_message(twilio, buckets, ('A1', '+11111111111', 'hi', 1))
+    assert result == SendResult('A1', '+11111111111', 'SM+11111111111',
+                                'queued', None)
+    assert len(twilio.messages.origins) == 2
+    assert time.time() - start >= .1
+
+
+@pytest.mark.parametrize('test_phones, test_senders', [
+    (['+1{:010d}'.format(i) for i in range(200)], ['+10000000000', 'MG123']),
+])
+def test_assign_sender(test_phones, test_senders):
+    first = [assign_sender(phone, test_senders) for phone in test_phones]
+    second = [assign_sender(phone, test_senders) for phone in test_phones]
+    assert first == second
+    assert 50 < first.count('MG123') < 150
+
+
+def test_send_messages_senders():
+    twilio = FakeTwilio()
+    buckets = {'+10000000000': TokenBucket(1000), 'MG123': TokenBucket(1000)}
+    messages = [('A{}'.format(i), '+1{:010d}'.format(i), 'hi', 1) for i in
+                range(20)]
+    send_messages(twilio, buckets, messages, 4)
+    assert {'messaging_service_sid': 'MG123'} in twilio.messages.origins
+    assert {'from_': '+10000000000'} in twilio.messages.origins
+
+
+@pytest.mark.parametrize('test_senders', [1, 2, 4])
+def test_send_messages_scale_with_senders(test_senders):
+    # a single worker per sender, each call taking 50ms and each sender paced
+    # at 20 messages per second; six messages apiece take about a third of a
+    # second however many senders share the run, where one pool shared by all
+    # would take that long per sender
+    senders = ['+1000000000{}'.format(i) for i in range(test_senders)]
+    buckets = dict((sender, TokenBucket(20, capacity=1)) for sender in senders)
+    messages, per_sender = [], dict((sender, 0) for sender in senders)
+    for i in range(1000):
+        phone = '+1{:010d}'.format(i)
+        sender = assign_sender(phone, senders)
+        if per_sender[sender] < 6:
+            per_sender[sender] += 1
+            messages.append(('A{}'.format(i), phone, 'hi', 1))
+    start = time.time()
+    results = send_messages(FakeTwilio(delay=.05), buckets, messages, 1)
+    elapsed = time.time() - start
+    assert len(results) == 6 * test_senders and all(r.sid for r in results)
+    assert .25 < elapsed < .6
+
+
+@pytest.mark.parametrize('test_statuses, expected_status, expected_calls', [
+    ([429, 429, 201], 201, 3),
+    ([429, 429, 429], 429, 3),
+])
+def test_throttled_http_client(test_statuses, expected_status, expected_calls):
+    client = ThrottledHttpClient([TokenBucket(1000)], retries=2)
+    client.session = FakeSession(test_statuses, {'Retry-After': '0.01'})
+    assert client.request('POST', 'https://api.twilio.com').status_code == \
+        expected_status
+    assert client.session.calls == expected_calls
+
+
+@pytest.mark.parametrize('test_count, test_batch, test_fail, expected_calls, expected', [
+    (5, 2, False, [2, 2, 1], SendResult('A0', '+10000000000', 'NT1', 'accepted', None)),
+    (2, 10, True, [2], SendResult('A0', '+10000000000', None, 'failed', '500')),
+    (3, 2, requests.Timeout('timed out'), [2, 1],
+     SendResult('A0', '+10000000000', None, 'failed', 'Timeout')),
+    (1, 10, CircuitOpen('open'), [1],
+     SendResult('A0', '+10000000000', None, 'failed', 'CircuitOpen')),
+])
+def test_notify_messages(test_count, test_batch, test_fail, expected_calls,
+                         expected):
+    twilio = FakeTwilio(fail=test_fail)
+    messages = [('A{}'.format(i), '+1{:010d}'.format(i), 'hi', 1) for i in
+                range(test_count)]
+    recorded = []
+    result = notify_messages(twilio, 'IS123', messages, on_result=recorded.append,
+                             batch=test_batch)
+    assert twilio.notifications.calls == expected_calls
+    assert result[0] == expected
+    assert recorded == result
@@ -0,0 +1,50 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import pytest
+
+from NGS2apis.messaging.journal import *
+
+
+@pytest.mark.parametrize('test_results, expected', [
+    (
+        [SendResult('A1', '+11111111111', None, 'failed', '21211'),
+         SendResult(2, '+12222222222', 'SM2', 'queued', None),
+         SendResult('A1', '+11111111111', 'SM1', 'queued', None)],
+        {'A1': SendResult('A1', '+11111111111', 'SM1', 'queued', None),
+         '2': SendResult('2', '+12222222222', 'SM2', 'queued', None)},
+    ),
+])
+def test_send_journal(tmpdir, test_results, expected):
+    path = str(tmpdir.join('journal.jsonl'))
+    journal = SendJournal(path)
+    for result in test_results:
+        journal.record(result)
+    journal.close()
+
+    # a record cut short by a crash is skipped
+    with open(path, 'a') as f:
+        f.write('{"ExternalDataReference": "A3", "ph')
+
+    results, first = read_journal(path)
+    assert results == expected
+    assert first is not None
+
+
+def test_read_journal_missing(tmpdir):
+    assert read_journal(str(tmpdir.join('missing.jsonl'))) == ({}, None)
+
+
+@pytest.mark.parametrize('test_resume, expected', [
+    (False, ['2']),
+    (True, ['1', '2']),
+])
+def test_send_journal_fresh_run(tmpdir, test_resume, expected):
+    path = str(tmpdir.join('journal.jsonl'))
+    journal = SendJournal(path)
+    journal.record(SendResult('1', '+11111111111', 'SM1', 'queued', None))
+    journal.close()
+
+    journal = SendJournal(path, resume=test_resume)
+    journal.record(SendResult('2', '+12222222222', 'SM2', 'queued', None))
+    journal.close()
+    assert sorted(read_journal(path)[0]) == expected
@@ -0,0 +1,30 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import pytest
+import time
+
+from NGS2apis.messaging.ratelimit import *
+
+
+@pytest.mark.parametrize('test_rate, test_capacity, test_calls', [
+    (1, 5, 5),
+    (100, 1, 11),
+])
+def test_token_bucket_acquire(test_rate, test_capacity, test_calls):
+    bucket = TokenBucket(test_rate, capacity=test_capacity)
+    start = time.time()
+    for _ in range(test_calls):
+        bucket.acquire()
+    expected = (test_calls - test_capacity) / float(test_rate)
+    assert expected <= time.time() - start < expected + .5
+
+
+@pytest.mark.parametrize('test_pause', [
+    (.2),
+])
+def test_token_bucket_throttle(test_pause):
+    bucket = TokenBucket(1000, capacity=10)
+    bucket.throttle(test_pause)
+    start = time.time()
+    bucket.acquire()
+    assert time.time() - start >= test_pause
@@ -0,0 +1,15 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import pytest
+
+from NGS2apis.messaging.segments import *
+
+
+@pytest.mark.parametrize('test, expected', [
+    (['Hi.', 'a' * 160, 'a' * 161, 'a' * 306, 'a' * 307], [1, 1, 2, 2, 3]),
+    ([u'€' * 80, u'€' * 81], [1, 2]),
+    ([u'é' * 70, u'ç' * 70, u'ç' * 71, u'ç' * 134, u'ç' * 135], [1, 1, 2, 2, 3]),
+    ([u'\U0001F600' * 35, u'\U0001F600' * 36], [1, 2]),
+])
+def test_segment_counts(test, expected):
+    assert segment_counts(test).tolist() == expected
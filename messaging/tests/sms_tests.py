@@ -1,45 +1,150 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
+import numpy as np
 import pytest
+import time
 
 from NGS2apis.messaging.sms import *
 
 
-@pytest.mark.parametrize('test_data, test_country, test_link, expected', [
+@pytest.mark.parametrize('test_data, test_content, test_link, expected', [
     (
-        [('A1', 1111111111), ('A2', 2222222222)],
-        'US',
+        pd.DataFrame({
+            'ExternalDataReference': ['A1', 'A2'],
+            'phone': ['+11111111111', '+12222222222'],
+        }),
+        'Hi.',
         False,
+        [('A1', '+11111111111', 'Hi.', 1), ('A2', '+12222222222', 'Hi.', 1)],
+    ),
+    (
+        pd.DataFrame({
+            'ExternalDataReference': ['A1'],
+            'phone': ['+11111111111'],
+            'url': ['http://bit.ly/a'],
+        }),
+        'Hi.',
+        True,
+        [('A1', '+11111111111', 'Hi. http://bit.ly/a', 1)],
+    ),
+])
+def test_build_messages(test_data, test_content, test_link, expected):
+    assert build_messages(test_data, test_content, test_link) == expected
+
+
+@pytest.mark.parametrize('test', [
+    ({'notify': None, 'url_link': True}),
+    ({'notify': 'IS123', 'url_link': False}),
+])
+def test_bulk_mode_test_pass(test):
+    assert bulk_mode_test(test) == None
+
+
+@pytest.mark.parametrize('test', [
+    ({'notify': 'IS123', 'url_link': True}),
+])
+@pytest.mark.xfail(raises=AssertionError)
+def test_bulk_mode_test_fail(test):
+    assert bulk_mode_test(test)
+
+
+@pytest.mark.parametrize('test_messages, test_budget, expected', [
+    (
+        [('A1', '+11111111111', 'Hi.', 1), ('A2', '+12222222222', 'Hi.', 3)],
+        2,
+        ['A2'],
+    ),
+    ([('A1', '+11111111111', 'Hi.', 1)], 1, []),
+])
+def test_log_segment_issues(test_messages, test_budget, expected):
+    assert log_segment_issues(test_messages, test_budget, 10) == expected
+
+
+@pytest.mark.parametrize('test_data, test_country, expected', [
+    (
+        pd.DataFrame({
+            'ExternalDataReference': ['A1', 'A2', 'A3', 'A4'],
+            'SMS_PHONE_CLEAN': ['2222222222', '1111111111', '222222222',
+                                '9999999999'],
+        }),
+        'US',
+        ['A1', 'A4'],
+    ),
+    (
+        pd.DataFrame({
+            'ExternalDataReference': ['A1', 'A2', 'A3'],
+            'SMS_PHONE_CLEAN': ['612345678', '512345678', '6123456789'],
+        }),
+        'MA',
+        ['A1', 'A2'],
+    ),
+    (
+        pd.DataFrame({
+            'ExternalDataReference': ['A1', 'A2'],
+            'SMS_PHONE_CLEAN': ['9171234567', '2171234567'],
+        }),
+        'PH',
+        ['A1'],
+    ),
+])
+def test_check_format_validity(test_data, test_country, expected):
+    result = check_format_validity(test_data, test_country)
+    assert result.ExternalDataReference.tolist() == expected
+
+
+@pytest.mark.parametrize('test_country', [
+    ('GB'),
+])
+@pytest.mark.xfail(raises=SystemExit)
+def test_check_format_validity_fail(test_country):
+    check_format_validity(pd.DataFrame({'SMS_PHONE_CLEAN': []}), test_country)
+
+
+@pytest.mark.parametrize('test_data, test_country, expected', [
+    (
+        pd.DataFrame({
+            'ExternalDataReference': ['A1', 'A2'],
+            'SMS_PHONE_CLEAN': ['1111111111', '2222222222'],
+        }),
+        'US',
         [('A1', '+11111111111'), ('A2', '+12222222222')],
     ),
+    (
+        pd.DataFrame({
+            'ExternalDataReference': ['A1'],
+            'SMS_PHONE_CLEAN': ['612345678'],
+        }),
+        'MA',
+        [('A1', '+212612345678')],
+    ),
 ])
-def test_format_phone_numbers(test_data, test_country, test_link, expected):
-    result = format_phone_numbers(test_data, test_country, test_link)
-    assert result[0][0] == expected[0][0]
-    assert result[0][1] == expected[0][1]
-    assert result[1][0] == expected[1][0]
-    assert result[1][1] == expected[1][1]
+def test_format_phone_numbers(test_data, test_country, expected):
+    result = format_phone_numbers(test_data, test_country)
+    assert list(zip(result.ExternalDataReference, result.phone)) == expected
 
 
-@pytest.mark.parametrize('test_data, test_digits, test_link, expected', [
+@pytest.mark.parametrize('test_data, test_digits, expected', [
     (
-        [('A1', 1111111111), ('A2', 222222222), ('A3', 333333333)],
+        pd.DataFrame({
+            'ExternalDataReference': ['A1', 'A2', 'A3'],
+            'SMS_PHONE_CLEAN': ['1111111111', '222222222', '333333333'],
+        }),
         10,
-        False,
-        [('A1', 1111111111)],
+        [('A1', '1111111111')],
     ),
     (
-        [('A1', 1111111111), ('A2', 222222222), ('A3', 333333333)],
+        pd.DataFrame({
+            'ExternalDataReference': ['A1', 'A2', 'A3'],
+            'SMS_PHONE_CLEAN': ['1111111111', '222222222', '333333333'],
+        }),
         9,
-        False,
-        [('A2', 222222222), ('A3', 333333333)],
+        [('A2', '222222222'), ('A3', '333333333')],
     ),
 ])
-def test_log_length_issues(test_data, test_digits, test_link, expected):
-    result = log_length_issues(test_data, test_digits, test_link)
-    assert result[0][0] == expected[0][0]
-    assert result[0][1] == expected[0][1]
-    assert len(result) == len(expected)
+def test_log_length_issues(test_data, test_digits, expected):
+    result = log_length_issues(test_data, test_digits)
+    assert list(zip(result.ExternalDataReference, result.SMS_PHONE_CLEAN)) == \
+        expected
 
 
 @pytest.mark.parametrize('test, test_link, expected', [
@@ -49,16 +154,53 @@ def test_log_length_issues(test_data, test_digits, test_link, expected):
             'SMS_PHONE_CLEAN': [8888888888, 'a111111111', 9999999999],
         }),
         False,
-        [('A', 8888888888), ('C', 9999999999)],
+        [('A', '8888888888'), ('C', '9999999999')],
+    ),
+    (
+        pd.DataFrame({
+            'ExternalDataReference': ['A', 'B', 'C'],
+            'SMS_PHONE_CLEAN': [8888888888., np.nan, 9999999999.],
+            'url': ['a', 'b', 'c'],
+        }),
+        True,
+        [('A', '8888888888', 'a'), ('C', '9999999999', 'c')],
     ),
 ])
 def test_log_numeric_issues(test, test_link, expected):
     result = log_numeric_issues(test, test_link)
-    assert result[0][0] == expected[0][0]
-    assert result[0][1] == expected[0][1]
-    assert result[1][0] == expected[1][0]
-    assert result[1][1] == expected[1][1]
-    assert len(result) == len(expected)
+    assert list(zip(*[result[col] for col in result.columns])) == expected
+
+
+@pytest.mark.parametrize('test, test_link, expected', [
+    (
+        pd.DataFrame({
+            'ExternalDataReference': ['A', 'B', 'C'],
+            'url': ['a', np.nan, 'c'],
+            'url_error': [None, 'RATE_LIMIT_EXCEEDED', 'INVALID_URI'],
+        }),
+        True,
+        ['A'],
+    ),
+    (
+        pd.DataFrame({
+            'ExternalDataReference': ['A', 'B'],
+            'url': ['a', np.nan],
+        }),
+        True,
+        ['A'],
+    ),
+    (
+        pd.DataFrame({
+            'ExternalDataReference': ['A', 'B'],
+            'url': ['a', np.nan],
+        }),
+        False,
+        ['A', 'B'],
+    ),
+])
+def test_log_url_issues(test, test_link, expected):
+    assert log_url_issues(test, test_link).ExternalDataReference.tolist() == \
+        expected
 
 
 @pytest.mark.parametrize('test', [
@@ -74,3 +216,119 @@ def test_msg_exists_test_pass(test):
 @pytest.mark.xfail(raises=AssertionError)
 def test_msg_exists_test_fail(test):
     assert msg_exists_test(test)
+
+
+@pytest.fixture
+def stub():
+    from NGS2apis.messaging.stub import TwilioStub
+    server = TwilioStub(status_delay=.01, seed=0).start()
+    yield server
+    server.stop()
+
+
+def campaign(tmpdir, stub, n, **overrides):
+    # sms.run over `n` synthetic recipients against the stub
+    phones = tmpdir.join('recipients.csv')
+    if not phones.check():
+        pd.DataFrame({
+            'ExternalDataReference': ['R{}'.format(i) for i in range(n)],
+            'SMS_PHONE_CLEAN': [str(2000000000 + i) for i in range(n)],
+        }).to_csv(str(phones), index=False)
+        tmpdir.join('content.txt').write('Hi.\n')
+    args_dict = {
+        'api_base': stub.url,
+        'auth': ['AC{:032d}'.format(0), 'token', '+15005550006'],
+        'callback_url': None,
+        'chunksize': None,
+        'content': str(tmpdir.join('content.txt')),
+        'error_check': False,
+        'max_segments': 2,
+        'nation': 'US',
+        'notify': None,
+        'phones': str(phones),
+        'resume': False,
+        'senders': None,
+        'sps': 1000,
+        'status_timeout': 0,
+        'url_link': False,
+        'workers': 4,
+    }
+    args_dict.update(overrides)
+    run(args_dict)
+    return pd.read_csv(str(tmpdir.join('recipients_delivery.csv')))
+
+
+def test_resume_ignores_earlier_campaigns(tmpdir, stub):
+    # an earlier campaign reached everyone; this one failed for everyone
+    campaign(tmpdir, stub, 3)
+    stub.error_rate = 1
+    failed = campaign(tmpdir, stub, 3)
+    assert failed.MessageReference.isnull().all()
+
+    stub.error_rate = 0
+    resumed = campaign(tmpdir, stub, 3, resume=True)
+    assert stub.counts['create'] == 9
+    assert resumed.MessageReference.notnull().all()
+
+    # and resuming a finished campaign sends nothing more
+    campaign(tmpdir, stub, 3, resume=True)
+    assert stub.counts['create'] == 9
+
+
+@pytest.mark.parametrize('test_chunksize', [None, 1, 3, 7, 10])
+def test_chunked_run(tmpdir, stub, test_chunksize):
+    # every row lands once, in input order, under a single header, the last
+    # partial chunk included
+    delivered = campaign(tmpdir, stub, 7, chunksize=test_chunksize)
+    assert delivered.ExternalDataReference.tolist() == \
+        ['R{}'.format(i) for i in range(7)]
+    assert delivered.MessageReference.notnull().all()
+    assert stub.counts['create'] == 7
+
+
+def test_chunks_settle_in_background(tmpdir, stub, monkeypatch):
+    # the first chunk settles slowest; later chunks are sent meanwhile, and
+    # rows are still written in input order
+    from NGS2apis.messaging import sms
+    settle = sms.settle_chunk
+    sent_by_first_settle = []
+
+    def slow_settle(twilio, d, *args):
+        if d.ExternalDataReference.iloc[0] == 'R0':
+            time.sleep(.3)
+            sent_by_first_settle.append(stub.counts['create'])
+        return settle(twilio, d, *args)
+    monkeypatch.setattr(sms, 'settle_chunk', slow_settle)
+
+    delivered = campaign(tmpdir, stub, 6, chunksize=2)
+    assert sent_by_first_settle == [6]
+    assert delivered.ExternalDataReference.tolist() == \
+        ['R{}'.format(i) for i in range(6)]
+
+
+def test_chunks_in_flight_bounded(tmpdir, stub, monkeypatch):
+    # however slowly chunks settle, no more than workers + 1 are held
+    from NGS2apis.messaging import sms
+    settle, finish = sms.settle_chunk, sms.finish_chunk
+    counts = {'read': 0, 'written': 0, 'held': 0}
+
+    def slow_settle(*args):
+        time.sleep(.02)
+        return settle(*args)
+
+    def prepare(d, *args):
+        counts['read'] += 1
+        counts['held'] = max(counts['held'],
+                             counts['read'] - counts['written'])
+        return prepare_chunk(d, *args)
+
+    def counted_finish(*args):
+        finish(*args)
+        counts['written'] += 1
+    monkeypatch.setattr(sms, 'settle_chunk', slow_settle)
+    monkeypatch.setattr(sms, 'prepare_chunk', prepare)
+    monkeypatch.setattr(sms, 'finish_chunk', counted_finish)
+
+    delivered = campaign(tmpdir, stub, 20, chunksize=1, workers=1)
+    assert len(delivered) == 20 and counts['written'] == 20
+    assert counts['held'] <= 3
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import datetime
+import pytest
+
+from collections import namedtuple
+
+from NGS2apis.messaging.status import *
+
+
+Message = namedtuple('Message', ['sid', 'status'])
+
+
+class FakeMessages(object):
+    def __init__(self, pages):
+        self.pages = list(pages)
+        self.calls = 0
+
+    def stream(self, **kwargs):
+        self.calls += 1
+        return iter(self.pages.pop(0) if len(self.pages) > 1 else self.pages[0])
+
+
+class FakeTwilio(object):
+    def __init__(self, pages):
+        self.messages = FakeMessages(pages)
+
+
+@pytest.mark.parametrize('test_pages, test_deadline, expected, expected_calls', [
+    (
+        [[Message('S1', 'sent'), Message('S2', 'delivered'), Message('S9', 'sent')],
+         [Message('S1', 'delivered'), Message('S2', 'delivered')]],
+        1,
+        {'S1': 'delivered', 'S2': 'delivered'},
+        2,
+    ),
+    (
+        [[Message('S1', 'sent'), Message('S2', 'undelivered')]],
+        .05,
+        {'S1': 'sent', 'S2': 'undelivered'},
+        4,
+    ),
+])
+def test_reconcile_statuses(test_pages, test_deadline, expected, expected_calls):
+    twilio = FakeTwilio(test_pages)
+    result = reconcile_statuses(twilio, {'S1': 'queued', 'S2': 'queued'},
+                                datetime.datetime.utcnow(), test_deadline,
+                                interval=.01, max_interval=.01)
+    assert result == expected
+    assert twilio.messages.calls <= expected_calls
+
+
+ErrorMessage = namedtuple('ErrorMessage', ['to', 'error_code', 'date_sent'])
+
+
+@pytest.mark.parametrize('test_messages, test_since, expected', [
+    (
+        [ErrorMessage('+1', 30003, datetime.datetime(2017, 7, 2, 8)),
+         ErrorMessage('+2', 30001, datetime.datetime(2017, 7, 3, 9)),
+         ErrorMessage('+3', None, datetime.datetime(2017, 7, 1, 9))],
+        None,
+        ({'+1'}, datetime.date(2017, 7, 3)),
+    ),
+    (
+        [],
+        datetime.date(2017, 7, 3),
+        (set(), datetime.date(2017, 7, 3)),
+    ),
+])
+def test_sync_error_numbers(test_messages, test_since, expected):
+    assert sync_error_numbers(FakeTwilio([test_messages]), test_since) == expected
+
+
+RecipientMessage = namedtuple('RecipientMessage', ['sid', 'to', 'status'])
+
+
+@pytest.mark.parametrize('test_pages, expected', [
+    (
+        [[RecipientMessage('SM3', '+1', 'delivered'),
+          RecipientMessage('SM1', '+1', 'failed'),
+          RecipientMessage('SM2', '+2', 'undelivered')]],
+        {'+1': ('SM3', 'delivered'), '+2': ('SM2', 'undelivered')},
+    ),
+])
+def test_reconcile_recipients(test_pages, expected):
+    result = reconcile_recipients(FakeTwilio(test_pages), ['+1', '+2'],
+                                  datetime.datetime.utcnow(), 1, interval=.01)
+    assert result == expected
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import datetime
+import pytest
+import time
+
+from twilio.rest import Client
+
+from NGS2apis.messaging.dispatch import *
+from NGS2apis.messaging.ratelimit import TokenBucket
+from NGS2apis.messaging.status import reconcile_statuses
+from NGS2apis.messaging.stub import TwilioStub
+
+
+@pytest.fixture
+def stub():
+    server = TwilioStub(status_delay=.05, seed=0).start()
+    yield server
+    server.stop()
+
+
+def client(stub, buckets=()):
+    return Client('AC1', 'token', http_client=ThrottledHttpClient(
+        buckets, base_url=stub.url, backoff=.01))
+
+
+def test_send_and_fetch(stub):
+    twilio = client(stub)
+    msg = twilio.messages.create(to='+12025550100', from_='+15005550006',
+                                 body='hi')
+    assert msg.status == 'queued'
+    time.sleep(.15)
+    assert twilio.messages(msg.sid).fetch().status == 'delivered'
+
+
+def test_error_injection(stub):
+    stub.error_rate = 1
+    results = send_messages(client(stub), {'+15005550006': TokenBucket(100)},
+                            [('1', '+12025550100', 'hi', 1)], workers=1)
+    assert results[0].error == '21211'
+
+
+def test_throttling_retries(stub):
+    stub.max_rps = 2
+    bucket = TokenBucket(1000)
+    messages = [(str(i), '+1202555{:04d}'.format(i), 'hi', 1) for i in range(4)]
+    results = send_messages(client(stub, [bucket]), {'+15005550006': bucket},
+                            messages, workers=4)
+    assert all(r.sid for r in results)
+    assert stub.counts['throttled'] > 0
+
+
+@pytest.mark.parametrize('page_size', [1, 2, 50])
+def test_listing_pages(stub, page_size):
+    twilio = client(stub)
+    sent_after = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+    sids = [twilio.messages.create(to='+1202555010{}'.format(i),
+                                   from_='+15005550006', body='hi').sid for
+            i in range(3)]
+    listed = [m.sid for m in twilio.messages.stream(date_sent_after=sent_after,
+                                                   page_size=page_size)]
+    assert listed == sids[::-1]
+
+
+def test_reconcile_against_stub(stub):
+    twilio = client(stub)
+    sent_after = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+    msg = twilio.messages.create(to='+12025550100', from_='+15005550006',
+                                 body='hi')
+    statuses = reconcile_statuses(twilio, {msg.sid: msg.status}, sent_after,
+                                  deadline=2, interval=.1)
+    assert statuses == {msg.sid: 'delivered'}
+
+
+def test_no_added_latency(stub):
+    # a zero-latency stub answers kept-alive calls well inside a delayed ACK
+    twilio = client(stub)
+    msg = twilio.messages.create(to='+12025550100', from_='+15005550006',
+                                 body='hi')
+    timings = []
+    for _ in range(20):
+        start = time.time()
+        twilio.messages(msg.sid).fetch()
+        timings.append(time.time() - start)
+    assert sorted(timings)[10] < .02
@@ -0,0 +1,149 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import pytest
+
+from NGS2apis.messaging.urls import *
+
+
+class FakeBitly(Bitly):
+    RATE_LIMIT_BACKOFF = .01
+
+    def __init__(self, responses=(), **kwargs):
+        super(FakeBitly, self).__init__('KEY', **kwargs)
+        self.responses = list(responses)
+        self.calls = 0
+
+    def _request(self, url, format):
+        self.calls += 1
+        if self.responses:
+            response = self.responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+        return {'data': {'url': 'http://bit.ly/{}'.format(url)}}
+
+
+@pytest.mark.parametrize('test_links, test_workers, expected', [
+    (['a', 'b', 'a'], 1, ['http://bit.ly/a', 'http://bit.ly/b', 'http://bit.ly/a']),
+    (['a', 'b', 'a'], 3, ['http://bit.ly/a', 'http://bit.ly/b', 'http://bit.ly/a']),
+])
+def test_add_bitlinks(test_links, test_workers, expected):
+    api = FakeBitly()
+    result = add_bitlinks(api, pd.DataFrame({'link': test_links}), test_workers,
+                          TokenBucket(1000))
+    assert result.url.tolist() == expected
+    assert result.url_error.isnull().all()
+    assert api.calls == 2
+
+
+@pytest.mark.parametrize('test_chunksize, test_done', [
+    (2, 0),
+    (2, 2),
+    (3, 4),
+])
+def test_stream_bitlinks(tmpdir, test_chunksize, test_done):
+    data = str(tmpdir.join('links.csv'))
+    output = str(tmpdir.join('links_bitly.csv'))
+    links = ['l{}'.format(i) for i in range(5)]
+    pd.DataFrame({'id': range(5), 'link': links}).to_csv(data, index=False)
+
+    # simulate a crash after `test_done` rows plus a partly appended chunk
+    if test_done:
+        done = pd.DataFrame({'id': range(test_done), 'link': links[:test_done]})
+        add_bitlinks(FakeBitly(), done, 1, None).to_csv(output, index=False)
+        write_checkpoint('{}.checkpoint'.format(output), test_done,
+                         os.path.getsize(output))
+        with open(output, 'a') as f:
+            f.write('9,partial,row\n')
+
+    api = FakeBitly()
+    stream_bitlinks(api, data, output, test_chunksize, 1, TokenBucket(1000))
+    result = pd.read_csv(output)
+    assert result.link.tolist() == links
+    assert result.url.tolist() == ['http://bit.ly/{}'.format(l) for l in links]
+    assert api.calls == len(links) - test_done
+    assert not os.path.exists('{}.checkpoint'.format(output))
+
+
+def test_stream_bitlinks_outage(tmpdir):
+    data = str(tmpdir.join('links.csv'))
+    output = str(tmpdir.join('links_bitly.csv'))
+    links = ['l{}'.format(i) for i in range(4)]
+    pd.DataFrame({'id': range(4), 'link': links}).to_csv(data, index=False)
+
+    # the second chunk hits an outage; nothing of it is written or skipped
+    outage = requests.ConnectionError('Circuit open for api-ssl.bitly.com.')
+    api = FakeBitly(responses=[{'data': {'url': 'http://bit.ly/l0'}},
+                               {'data': {'url': 'http://bit.ly/l1'}}, outage])
+    with pytest.raises(SystemExit):
+        stream_bitlinks(api, data, output, 2, 1, None)
+    assert read_checkpoint('{}.checkpoint'.format(output))['rows'] == 2
+    assert len(pd.read_csv(output)) == 2
+
+    stream_bitlinks(FakeBitly(), data, output, 2, 1, None)
+    result = pd.read_csv(output)
+    assert result.url.tolist() == ['http://bit.ly/{}'.format(l) for l in links]
+    assert result.url_error.isnull().all()
+
+
+@pytest.mark.parametrize('test_response, expected', [
+    ({'data': [], 'status_txt': 'INVALID_URI', 'status_code': 500}, True),
+    ({'data': [], 'status_txt': 'INVALID_URI', 'status_code': 400}, False),
+    ({'data': None, 'status_txt': Bitly.RATE_LIMITED, 'status_code': 403},
+     True),
+    (requests.Timeout('timed out'), True),
+])
+def test_lookup_transient(test_response, expected):
+    assert FakeBitly(responses=[test_response]).lookup('a').transient == \
+        expected
+
+
+def test_shorten_paced_rate_limited():
+    limited = {'data': None, 'status_txt': Bitly.RATE_LIMITED}
+    api = FakeBitly(responses=[limited, limited])
+    result = api.shorten_paced('a', TokenBucket(1000))
+    assert result == ShortenResult('a', 'http://bit.ly/a', None)
+    assert api.calls == 3
+
+
+@pytest.mark.parametrize('test_response, expected', [
+    ({'data': {'url': 'http://bit.ly/a'}}, ShortenResult('a', 'http://bit.ly/a', None)),
+    ({'data': [], 'status_txt': 'INVALID_URI'}, ShortenResult('a', None, 'INVALID_URI')),
+])
+def test_shorten_many(test_response, expected):
+    assert FakeBitly(responses=[test_response]).shorten_many(['a']) == [expected]
+
+
+@pytest.mark.parametrize('test_url, expected', [
+    ('http://example.com/a', 'http://bit.ly/a'),
+    ('http://example.com/b', None),
+])
+def test_link_cache(tmpdir, test_url, expected):
+    cache = LinkCache(str(tmpdir.join('cache.db')))
+    cache.set('http://example.com/a', 'http://bit.ly/a')
+    assert cache.get(test_url) == expected
+
+
+def test_bitly_cache_hit(tmpdir):
+    cache = LinkCache(str(tmpdir.join('cache.db')))
+    cache.set('http://example.com/a', 'http://bit.ly/a')
+    api = FakeBitly(cache=cache)
+    assert api.shorten('http://example.com/a') == 'http://bit.ly/a'
+    assert api.calls == 0
+
+
+def test_shorten_paced_cache_hit(tmpdir):
+    class Bucket(object):
+        acquired = 0
+
+        def acquire(self, tokens=1):
+            self.acquired += tokens
+    cache = LinkCache(str(tmpdir.join('cache.db')))
+    cache.set('http://example.com/a', 'http://bit.ly/a')
+    api = FakeBitly(cache=cache)
+    bucket = Bucket()
+    results = api.shorten_many(['http://example.com/a'] * 3 +
+                               ['http://example.com/b'], 1, bucket)
+    assert [r.url for r in results] == ['http://bit.ly/a'] * 3 + \
+        ['http://bit.ly/http://example.com/b']
+    assert api.calls == 1 and bucket.acquired == 1
@@ -1,35 +1,111 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 import argparse
+import json
 import os
 import pandas as pd
-import time
+import sys
 
+from NGS2apis import metrics
 from NGS2apis.messaging import *
+from NGS2apis.messaging.ratelimit import TokenBucket
 
 
-def shorten_url(api, ct, link):
-    # avoid rate limits
-    if (ct>0) & (ct%99==0):
-        time.sleep(60)
+def add_bitlinks(api, d, workers, bucket, strict=False):
+    # shorten each distinct URL once and fan bitlinks back out to every row;
+    # `strict` stops on outages and rate limits rather than recording them
+    links = d['link'].unique()
+    with metrics.stage('shorten'):
+        results = api.shorten_many(links, workers=workers, bucket=bucket)
+    failed = [r for r in results if r.transient]
+    if strict and failed:
+        sys.exit('STOP! {} links failed to shorten ({}); rerun to resume.'
+                 .format(len(failed), failed[0].error))
+    d['url'] = d['link'].map(pd.Series([r.url for r in results], index=links))
+    d['url_error'] = d['link'].map(
+        pd.Series([r.error for r in results], index=links)
+    )
+    return d
 
-    # make api call
-    return api.shorten(link)
 
+def read_checkpoint(path):
+    # rows already written and the output size that goes with them
+    if not os.path.exists(path):
+        return {'rows': 0, 'bytes': 0}
+    with open(path, 'r') as f:
+        return json.load(f)
 
-def run(args_dict):
-    # load data
-    d = pd.read_csv(args_dict['data'], sep=None, engine='python')
 
-    # authorize client
-    client = Bitly(args_dict['auth'])
+def write_checkpoint(path, rows, size):
+    # write-then-rename so a crash never leaves a half-written checkpoint
+    with open('{}.tmp'.format(path), 'w') as f:
+        json.dump({'rows': rows, 'bytes': size}, f)
+    os.rename('{}.tmp'.format(path), path)
+
+
+def stream_bitlinks(api, data, output, chunksize, workers, bucket):
+    checkpoint = '{}.checkpoint'.format(output)
+    done = read_checkpoint(checkpoint)
+
+    # drop anything appended after the last checkpoint, or start over
+    if done['rows'] and os.path.exists(output):
+        with open(output, 'r+') as f:
+            f.truncate(done['bytes'])
+    elif os.path.exists(output):
+        os.remove(output)
+
+    rows = 0
+    for chunk in pd.read_csv(data, sep=None, engine='python',
+                             chunksize=chunksize):
+        rows += len(chunk)
+        if rows <= done['rows']:
+            continue
+        chunk = chunk.iloc[max(done['rows'] - (rows - len(chunk)), 0):]
+
+        # a chunk hit by an outage is left for the rerun to shorten again
+        add_bitlinks(api, chunk, workers, bucket, strict=True)
+        with metrics.stage('write'):
+            chunk.to_csv(output, mode='a', header=not os.path.exists(output),
+                         index=False)
+            write_checkpoint(checkpoint, rows, os.path.getsize(output))
+
+    # a finished run needs no checkpoint
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
 
-    # iterate over URLs and return bitlinks
-    d['url'] = [shorten_url(client, i, url) for i, url in enumerate(d['link'])]
 
-    # write data to disk
+def run(args_dict):
+    # authorize client; call and stage metrics are written next to the
+    # output when the run ends
+    registry = metrics.reset()
+    cache = LinkCache(args_dict['cache']) if args_dict['cache'] else None
+    client = Bitly(args_dict['auth'], cache=cache,
+                   pool_size=args_dict['workers'])
+
+    # keep `workers` calls in flight, paced at `rate` calls per minute
+    bucket = TokenBucket(args_dict['rate'] / 60.0, capacity=args_dict['workers'])
+
     FILENAME = os.path.splitext(args_dict['data'])
-    d.to_csv('{}_bitly{}'.format(FILENAME[0], FILENAME[1]), index=False)
+    output = '{}_bitly{}'.format(FILENAME[0], FILENAME[1])
+    if args_dict['chunksize']:
+        # shorten and append chunk by chunk, resuming from any checkpoint
+        stream_bitlinks(client, args_dict['data'], output,
+                        args_dict['chunksize'], args_dict['workers'], bucket)
+    else:
+        # load data
+        with metrics.stage('load'):
+            d = pd.read_csv(args_dict['data'], sep=None, engine='python')
+
+        # iterate over URLs and return bitlinks
+        d = add_bitlinks(client, d, args_dict['workers'], bucket)
+
+        # write data to disk
+        with metrics.stage('write'):
+            d.to_csv(output, index=False)
+
+    if cache is not None:
+        cache.close()
+    registry.write('{}_bitly'.format(FILENAME[0]))
 
 
 if __name__ == '__main__':
@@ -37,8 +113,18 @@ if __name__ == '__main__':
                                      'short URLs.')
     parser.add_argument('-a', '--auth', required=True, help='Authentication '
                         'token for Bitly; note, does not use OAuth2.')
+    parser.add_argument('-c', '--cache', required=False,
+                        default='messaging/bitly_cache.db', help='Path/file '
+                        'for the persistent URL cache; empty to disable.')
     parser.add_argument('-d', '--data', required=True, help='Path/file for '
                         'URLs to shorten; must have a field called `link`.')
+    parser.add_argument('-r', '--rate', required=False, default=99, type=float,
+                        help='Maximum Bitly calls per minute.')
+    parser.add_argument('-s', '--chunksize', required=False, default=None,
+                        type=int, help='Stream the file this many rows at a '
+                        'time, checkpointing so a rerun resumes.')
+    parser.add_argument('-w', '--workers', required=False, default=1, type=int,
+                        help='Number of Bitly calls to keep in flight.')
     args_dict = vars(parser.parse_args())
 
     run(args_dict)
@@ -0,0 +1,236 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import json
+import os
+import random
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+# upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+PREFIX = 'ngs2_'
+HELP = {
+    'api_call_seconds': ('histogram', 'Latency of outbound API calls, '
+                         'retries included.'),
+    'api_calls_total': ('counter', 'Outbound API calls by outcome.'),
+    'api_in_flight': ('gauge', 'Outbound API calls in flight.'),
+    'api_in_flight_max': ('gauge', 'Most outbound API calls in flight at '
+                          'once.'),
+    'http_requests_total': ('counter', 'HTTP attempts by host and status.'),
+    'http_retries_total': ('counter', 'HTTP retries by host and reason.'),
+    'http_circuit_open_total': ('counter', 'Calls refused by an open '
+                                'circuit.'),
+    'stage_seconds': ('histogram', 'Time spent in each pipeline stage.'),
+}
+
+
+class Histogram(object):
+    # bucket counts for Prometheus, and a bounded reservoir of samples for
+    # the percentiles in the JSON summary
+    def __init__(self, buckets=BUCKETS, reservoir=10000):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.reservoir = reservoir
+        self.samples = []
+        self.random = random.Random(0)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        self.counts[next((i for i, bound in enumerate(self.buckets) if
+                          value <= bound), len(self.buckets))] += 1
+        if len(self.samples) < self.reservoir:
+            self.samples.append(value)
+        else:
+            i = self.random.randint(0, self.count - 1)
+            if i < self.reservoir:
+                self.samples[i] = value
+
+    def quantile(self, q):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def label_text(labels, extra=()):
+    # {a="1",b="2"} with quotes, backslashes and newlines escaped
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')
+                         .replace('\n', '\\n')) for k, v in pairs))
+
+
+class Registry(object):
+    # histograms, counters and gauges keyed by name and sorted label pairs;
+    # safe to share between worker threads
+    def __init__(self):
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def gauge(self, name, delta, **labels):
+        # moves a gauge by `delta`, keeping its high-water mark alongside
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.gauges.setdefault(name, {})
+            peaks = self.gauges.setdefault('{}_max'.format(name), {})
+            series[key] = series.get(key, 0) + delta
+            peaks[key] = max(peaks.get(key, 0), series[key])
+
+    def prometheus(self):
+        # Prometheus text exposition format, e.g. for node_exporter's textfile
+        # collector
+        lines = []
+        with self.lock:
+            names = sorted(set(self.histograms) | set(self.counters) |
+                           set(self.gauges))
+            for name in names:
+                kind, text = HELP.get(name, ('untyped', name))
+                lines.append('# HELP {}{} {}'.format(PREFIX, name, text))
+                lines.append('# TYPE {}{} {}'.format(PREFIX, name, kind))
+                for key, hist in sorted(self.histograms.get(name, {}).items()):
+                    total = 0
+                    for bound, count in zip(list(hist.buckets) + ['+Inf'],
+                                            hist.counts):
+                        total += count
+                        lines.append('{}{}_bucket{} {}'.format(
+                            PREFIX, name, label_text(key, [('le', bound)]),
+                            total))
+                    lines.append('{}{}_sum{} {}'.format(
+                        PREFIX, name, label_text(key), hist.sum))
+                    lines.append('{}{}_count{} {}'.format(
+                        PREFIX, name, label_text(key), hist.count))
+                for series in (self.counters.get(name, {}),
+                               self.gauges.get(name, {})):
+                    for key, value in sorted(series.items()):
+                        lines.append('{}{}{} {}'.format(
+                            PREFIX, name, label_text(key), value))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        # percentiles per call and stage, with counters and peaks as they
+        # stand, for reading after a run
+        with self.lock:
+            elapsed = time.time() - self.started
+            histograms = dict(
+                (name, [dict(dict(key), count=hist.count, mean=hist.sum /
+                             max(hist.count, 1), p50=hist.quantile(.5),
+                             p95=hist.quantile(.95), p99=hist.quantile(.99),
+                             max=hist.max, rate=hist.count / max(elapsed, 1e-6))
+                        for key, hist in sorted(series.items())])
+                for name, series in self.histograms.items()
+            )
+            other = dict(
+                (name, [dict(dict(key), value=value) for key, value in
+                        sorted(series.items())])
+                for name, series in list(self.counters.items()) +
+                list(self.gauges.items())
+            )
+        return dict(other, elapsed=elapsed, **histograms)
+
+    def write(self, prefix):
+        # <prefix>_metrics.prom and <prefix>_metrics.json, each swapped in
+        # whole so a collector never reads half a file
+        for path, text in (
+            ('{}_metrics.prom'.format(prefix), self.prometheus()),
+            ('{}_metrics.json'.format(prefix),
+             json.dumps(self.summary(), indent=2, sort_keys=True)),
+        ):
+            with open('{}.tmp'.format(path), 'w') as f:
+                f.write(text)
+            os.rename('{}.tmp'.format(path), path)
+
+
+class Call(object):
+    # handed out by `track`; callers that learn how a call went without an
+    # exception say so through `outcome` or `status`
+    def __init__(self):
+        self.outcome = None
+
+    def status(self, code):
+        if code == 429:
+            self.outcome = 'throttled'
+        elif code >= 400:
+            self.outcome = 'error'
+        else:
+            self.outcome = 'ok'
+
+
+__registry__ = None
+
+
+def default():
+    global __registry__
+    if __registry__ is None:
+        __registry__ = Registry()
+    return __registry__
+
+
+def reset():
+    # a fresh registry, so each run reports on itself alone
+    global __registry__
+    __registry__ = Registry()
+    return __registry__
+
+
+def inc(name, amount=1, **labels):
+    default().inc(name, amount, **labels)
+
+
+@contextmanager
+def track(service, call):
+    # one outbound call: its latency, its outcome, and the calls in flight
+    registry = default()
+    labels = {'service': service, 'call': call}
+    result = Call()
+    registry.gauge('api_in_flight', 1, **labels)
+    start = time.time()
+    try:
+        yield result
+    except Exception:
+        result.outcome = 'error'
+        raise
+    finally:
+        registry.gauge('api_in_flight', -1, **labels)
+        registry.observe('api_call_seconds', time.time() - start, **labels)
+        registry.inc('api_calls_total', outcome=result.outcome or 'ok',
+                     **labels)
+
+
+@contextmanager
+def stage(name):
+    # time spent in one pipeline stage; stages run per chunk are observed
+    # once per chunk
+    registry = default()
+    start = time.time()
+    try:
+        yield
+    finally:
+        registry.observe('stage_seconds', time.time() - start, stage=name)
@@ -0,0 +1,50 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import logging
+import paypalrestsdk as pp
+
+from NGS2apis import metrics
+from NGS2apis.transport import default
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+
+logger = logging.getLogger(__name__)
+
+
+TOKEN_PATH = '/v1/oauth2/token'
+PAYOUTS_PATH = '/v1/payments/payouts'
+
+
+def paypal_call(method, url):
+    # metric name for a PayPal REST call, e.g. payout.create
+    path = urlsplit(url).path.rstrip('/')
+    if path == TOKEN_PATH:
+        return 'oauth.token'
+    if path == PAYOUTS_PATH:
+        return 'payout.create'
+    if path.startswith(PAYOUTS_PATH):
+        return 'payout.find'
+    return '{} {}'.format(method.upper(), path)
+
+
+class TransportApi(pp.Api):
+    # paypalrestsdk's Api with every call made through the package transport;
+    # asking for a token is safe to repeat, and payouts are not paid twice
+    # for one sender_batch_id, but submit_payout owns those retries
+    def __init__(self, options=None, transport=None, **kwargs):
+        pp.Api.__init__(self, options, **kwargs)
+        self.transport = transport or default()
+
+    def http_call(self, url, method, **kwargs):
+        with metrics.track('paypal', paypal_call(method, url)) as call:
+            response = self.transport.request(
+                method, url, idempotent=method.upper() == 'GET' or
+                url.endswith(TOKEN_PATH), proxies=self.proxies, **kwargs
+            )
+            call.status(response.status_code)
+        logger.debug('{} {}: {}'.format(method, url, response.status_code))
+        return self.handle_response(response, response.content.decode('utf-8'))
@@ -0,0 +1,174 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import argparse
+import collections
+import multiprocessing
+import numpy as np
+import os
+import pandas as pd
+import requests
+import shutil
+import tempfile
+import time
+
+from NGS2apis.payments import paypal, paypal_post_process
+from NGS2apis.payments.ledger import load_ledger
+from NGS2apis.payments.stub import PayPalStub
+from NGS2apis.stub import peak_memory_mb, start_stub
+
+
+# stage -> function timed for it, per entry point; functions are patched on
+# the entry point's module, so calls from worker threads count too
+STAGES = {
+    'paypal': [
+        ('load', 'read_ledger'),
+        ('validate', 'data_checks'),
+        ('build', 'build_payout'),
+        ('submit', 'submit_payout'),
+    ],
+    'post_process': [
+        ('load', 'load_ledger'),
+        ('poll', 'fetch_statuses'),
+        ('build', 'construct_details'),
+        ('write', 'write_ledger'),
+    ],
+}
+
+ENTRY_POINTS = {'paypal': paypal, 'post_process': paypal_post_process}
+
+
+class StageTimer(object):
+    # (start, end) of every call per stage; wall time is first start to last
+    # end, busy time sums the calls across threads
+    def __init__(self):
+        self.spans = collections.defaultdict(list)
+
+    def wrap(self, stage, func):
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.spans[stage].append((start, time.time()))
+        return timed
+
+    def summary(self):
+        return dict(
+            (stage, (max(end for _, end in spans) -
+                     min(start for start, _ in spans),
+                     sum(end - start for start, end in spans), len(spans)))
+            for stage, spans in self.spans.items()
+        )
+
+
+def write_synthetic_ledger(path, n, seed=0):
+    # n unpaid rows in batches of 250, all passing the data checks; batch ids
+    # carry the size, as the stub refuses a sender_batch_id it has seen
+    rows = np.arange(n)
+    pd.DataFrame({
+        'batch_id': pd.Series(rows // paypal.MAX_BATCH).map(
+            lambda batch: 'N{}B{}'.format(n, batch)),
+        'first_name': pd.Series(rows).map('P{}'.format),
+        'receiver_email': pd.Series(rows).map('p{}@test.com'.format),
+        'value': np.random.RandomState(seed).randint(100, 2000, n) / 100.0,
+        'currency': 'USD',
+        'item_id': rows,
+        'processed_code': np.nan,
+    }).to_csv(path, index=False)
+
+
+def profile(results, entry, args_dict):
+    # runs one entry point with its stages timed; in a child process of its
+    # own, so each reports its own peak memory
+    module = ENTRY_POINTS[entry]
+    timer = StageTimer()
+    for stage, name in STAGES[entry]:
+        setattr(module, name, timer.wrap(stage, getattr(module, name)))
+    start = time.time()
+    module.run(args_dict)
+    results.put((time.time() - start, timer.summary(), peak_memory_mb()))
+
+
+def measure(entry, args_dict, base_url):
+    before = requests.get('{}/stats'.format(base_url)).json()
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=profile,
+                                      args=(results, entry, args_dict))
+    process.start()
+    process.join()
+    if process.exitcode:
+        raise RuntimeError('{} exited with code {}.'.format(entry,
+                                                            process.exitcode))
+    elapsed, stages, peak = results.get()
+    after = requests.get('{}/stats'.format(base_url)).json()
+    calls = dict((k, after.get(k, 0) - before.get(k, 0)) for k in after)
+    return elapsed, stages, peak, calls
+
+
+def report(entry, rows, elapsed, stages, peak, calls):
+    print('{} ({} rows): {:.1f}s, {:.0f} rows/s, peak memory {:.1f}MB'.format(
+        entry, rows, elapsed, rows / max(elapsed, 1e-6), peak))
+    for stage, _ in STAGES[entry]:
+        wall, busy, count = stages.get(stage, (0, 0, 0))
+        print('  {:<9} wall {:8.2f}s  busy {:8.2f}s  calls {}'.format(
+            stage, wall, busy, count))
+    print('  api calls {}'.format(', '.join(
+        '{} {}'.format(k, v) for k, v in sorted(calls.items()) if v)))
+
+
+def run(args_dict):
+    stub, base_url = start_stub(PayPalStub, {
+        'latency': args_dict['latency'],
+        'error_rate': args_dict['error_rate'],
+        'max_rps': args_dict['max_rps'],
+        'unclaimed_rate': args_dict['unclaimed_rate'],
+        'seed': 0,
+    })
+    workdir = tempfile.mkdtemp()
+    try:
+        for rows in args_dict['rows']:
+            path = os.path.join(workdir, 'ledger_{}.csv'.format(rows))
+            write_synthetic_ledger(path, rows)
+            common = {'api_base': base_url, 'auth': ['id', 'secret'],
+                      'environment': 'sandbox', 'payments': path,
+                      'token_cache': os.path.join(workdir, 'tokens.json'),
+                      'workers': args_dict['workers']}
+            report('paypal', rows, *measure('paypal', dict(
+                common, materialize=False, retries=args_dict['retries'],
+                split=False), base_url))
+            unpaid = load_ledger(path).processed_code.isnull().sum()
+            if unpaid:
+                print('  {} rows left unpaid'.format(unpaid))
+            report('post_process', rows, *measure('post_process', dict(
+                common, no_poll=False, refresh=False), base_url))
+    finally:
+        shutil.rmtree(workdir)
+        stub.terminate()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark paypal.py and '
+                                     'paypal_post_process.py against a local '
+                                     'PayPal stub.')
+    parser.add_argument('-e', '--error_rate', required=False, default=0,
+                        type=float, help='Share of requests the stub answers '
+                        'with a 503.')
+    parser.add_argument('-l', '--latency', required=False, default=.05,
+                        type=float, help='Seconds the stub adds to every '
+                        'request.')
+    parser.add_argument('-n', '--rows', required=False, default=[10000],
+                        nargs='+', type=int, help='Synthetic ledger sizes, '
+                        'e.g. 10000 100000 1000000.')
+    parser.add_argument('-r', '--retries', required=False, default=3, type=int,
+                        help='Retries per batch passed to paypal.py.')
+    parser.add_argument('-t', '--max_rps', required=False, default=None,
+                        type=float, help='Requests per second before the stub '
+                        'answers 429.')
+    parser.add_argument('-u', '--unclaimed_rate', required=False, default=0,
+                        type=float, help='Share of items the stub leaves '
+                        'unclaimed.')
+    parser.add_argument('-w', '--workers', required=False, default=8, type=int,
+                        help='Batches in flight passed to both entry points.')
+    args_dict = vars(parser.parse_args())
+
+    run(args_dict)
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import datetime
+import pandas as pd
+import sqlite3
+import threading
+
+
+# item statuses PayPal may still change; anything else is final
+OPEN_STATUSES = {'ONHOLD', 'PENDING', 'UNCLAIMED'}
+
+DETAIL_COLUMNS = ['processed_code', 'item_id', 'payout_item_id',
+                  'transaction_status', 'error']
+
+
+class StatusCache(object):
+    # last known status of every payout item, keyed by payout_item_id, so a
+    # run only polls batches that still have open items; webhooks (events.py)
+    # write here too
+    def __init__(self, path, timeout=30):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=timeout,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS items ('
+                              'payout_item_id TEXT PRIMARY KEY, '
+                              'processed_code TEXT, item_id TEXT, '
+                              'transaction_status TEXT, error TEXT, '
+                              'updated TEXT)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS items_code ON '
+                              'items (processed_code)')
+
+    def _write(self, details):
+        updated = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S')
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?)',
+                ((payout_item, code, item, status, error, updated) for
+                 payout_item, code, item, status, error in
+                 details[['payout_item_id', 'processed_code', 'item_id',
+                          'transaction_status', 'error']].itertuples(
+                              index=False))
+            )
+
+    def update(self, details):
+        # fresh item details replace cached ones in one transaction
+        with self.lock:
+            self._write(details)
+
+    def record(self, details):
+        # pushed events can arrive out of order, so an item's final status is
+        # never replaced by an open one; returns how many items were stored
+        with self.lock:
+            current = details.payout_item_id.map(dict(self.conn.execute(
+                'SELECT payout_item_id, transaction_status FROM items WHERE '
+                'payout_item_id IN ({})'.format(', '.join('?' * len(details))),
+                details.payout_item_id.tolist()
+            ).fetchall()))
+            regress = (current.notnull() & ~current.isin(OPEN_STATUSES) &
+                       details.transaction_status.isin(OPEN_STATUSES))
+            self._write(details[~regress])
+        return int((~regress).sum())
+
+    def _select(self, columns, codes, where='', chunk=500):
+        rows = []
+        with self.lock:
+            for i in range(0, len(codes), chunk):
+                batch = codes[i:i + chunk]
+                rows += self.conn.execute(
+                    'SELECT {} FROM items WHERE processed_code IN ({}){}'
+                    .format(', '.join(columns), ', '.join('?' * len(batch)),
+                            where), batch
+                ).fetchall()
+        return rows
+
+    def stale(self, codes):
+        # batches never fetched, or with an item that may still change
+        codes = list(codes)
+        known = set(row[0] for row in self._select(['processed_code'], codes))
+        pending = set(row[0] for row in self._select(
+            ['processed_code'], codes, ' AND transaction_status IN ({})'
+            .format(', '.join("'{}'".format(s) for s in sorted(OPEN_STATUSES)))
+        ))
+        return [code for code in codes if code not in known or code in pending]
+
+    def details(self, codes):
+        # cached item details for `codes`, shaped like construct_details
+        return pd.DataFrame(self._select(DETAIL_COLUMNS, list(codes)),
+                            columns=DETAIL_COLUMNS)
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,92 @@
+#!/usr/bin/python
+import datetime
+import os
+import pandas as pd
+import sqlite3
+import threading
+
+
+class LedgerStore(object):
+    # processed codes keyed by (batch_id, item_id), committed one payout batch
+    # per transaction as soon as PayPal accepts it, so a crash loses nothing
+    # that was paid; WAL mode keeps each commit to an append
+    def __init__(self, path, timeout=30):
+        self.conn = sqlite3.connect(path, timeout=timeout,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.lock = threading.Lock()
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS payouts ('
+                              'batch_id TEXT, item_id TEXT, '
+                              'sender_batch_id TEXT, processed_code TEXT, '
+                              'committed TEXT, '
+                              'PRIMARY KEY (batch_id, item_id))')
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM payouts').fetchone()[0]
+
+    def commit(self, sender_batch_id, code, items):
+        # `items` are the batch's (batch_id, item_id); the first code wins
+        committed = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S')
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO payouts VALUES (?, ?, ?, ?, ?)',
+                ((str(batch), str(item), sender_batch_id, code, committed) for
+                 batch, item in items)
+            )
+
+    def sender_batch_ids(self):
+        # every sender_batch_id PayPal has accepted for this ledger
+        with self.lock:
+            rows = self.conn.execute('SELECT DISTINCT sender_batch_id FROM '
+                                     'payouts').fetchall()
+        return set(row[0] for row in rows)
+
+    def codes(self):
+        # processed_code series indexed by (batch_id, item_id)
+        with self.lock:
+            rows = self.conn.execute('SELECT batch_id, item_id, processed_code '
+                                     'FROM payouts').fetchall()
+        codes = pd.DataFrame(rows, columns=['batch_id', 'item_id',
+                                            'processed_code'])
+        return codes.set_index(['batch_id', 'item_id']).processed_code
+
+    def close(self):
+        self.conn.close()
+
+
+def read_ledger(path):
+    # processed codes stay text even while every row is blank
+    return pd.read_csv(path, sep=None, engine='python',
+                       dtype={'processed_code': str})
+
+
+def write_ledger(d, path):
+    d.to_csv(path, index=False)
+
+
+def materialize(d, store):
+    # fills the ledger's blank processed codes from the store
+    keys = pd.MultiIndex.from_arrays([d.batch_id.astype(str),
+                                      d.item_id.astype(str)])
+    committed = pd.Series(store.codes().reindex(keys).values, index=d.index)
+    d['processed_code'] = d.processed_code.fillna(committed)
+    return d
+
+
+def ledger_store_path(path):
+    return '{}_ledger.db'.format(os.path.splitext(path)[0])
+
+
+def load_ledger(path):
+    # the worksheet with every code committed to its ledger store filled in,
+    # built on demand instead of written back after each run
+    d = read_ledger(path)
+    if os.path.exists(ledger_store_path(path)):
+        store = LedgerStore(ledger_store_path(path))
+        try:
+            d = materialize(d, store)
+        finally:
+            store.close()
+    return d
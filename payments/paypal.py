@@ -1,10 +1,20 @@
 #!/usr/bin/python
 import argparse
 import logging
+import os
 import pandas as pd
 import paypalrestsdk as pp
-import re
+import requests
 import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from paypalrestsdk.exceptions import ClientError, ServerError
+
+from NGS2apis import metrics
+from NGS2apis.payments.ledger import (LedgerStore, ledger_store_path,
+                                      materialize, read_ledger, write_ledger)
+from NGS2apis.payments.tokens import TOKEN_CACHE, configure
 
 
 logger = logging.getLogger(__name__)
@@ -15,69 +25,136 @@ logging.getLogger('paypalrestsdk').setLevel(logging.WARN)
 logging.getLogger('urllib3').setLevel(logging.INFO)
 
 
+# columns every payment worksheet needs
+EXPECTED_COLUMNS = {
+    'batch_id',
+    'currency',
+    'first_name',
+    'item_id',
+    'processed_code',
+    'receiver_email',
+    'value'
+}
+
+CURRENCIES = ['USD', 'PHP']
+EMAIL_CHECK = r'^\w*@\w*.(com|org|edu)$'
+MAX_BATCH = 250
+
+# columns of the report returned by `validate`
+REPORT_COLUMNS = ['row', 'rule', 'value']
+
+
+def batch_size_issues(d):
+    # rows whose batch has more than 250 entries
+    return d.batch_id.map(d.groupby('batch_id').size()) > MAX_BATCH
+
+
+def name_issues(d):
+    return d.first_name.isnull()
+
+
+def email_issues(d):
+    return ~d.receiver_email.astype(str).str.match(EMAIL_CHECK)
+
+
+def value_issues(d):
+    issues = pd.to_numeric(d.value, errors='coerce').isnull()
+    if d.value.dtype == object:
+        # numbers stored as text would still break amount formatting
+        issues |= d.value.map(type).isin([str, type(u'')])
+    return issues
+
+
+def currency_issues(d):
+    return ~d.currency.astype(str).str.upper().isin(CURRENCIES)
+
+
+def duplicate_id_issues(d):
+    # item ids repeated within a batch; every copy is reported
+    return d.duplicated(['batch_id', 'item_id'], keep=False)
+
+
+# (rule, column reported, check) for each row-level rule
+RULES = [
+    ('batch_size', 'batch_id', batch_size_issues),
+    ('missing_name', 'first_name', name_issues),
+    ('email', 'receiver_email', email_issues),
+    ('value', 'value', value_issues),
+    ('currency', 'currency', currency_issues),
+    ('duplicate_item_id', 'item_id', duplicate_id_issues),
+]
+
+
+def validate(d, rules=RULES):
+    # every violation in the worksheet in one sweep, one report row per
+    # offending (row, rule); rows are labelled by the worksheet's index
+    missing = sorted(EXPECTED_COLUMNS - set(d.columns))
+    if missing:
+        return pd.DataFrame({'row': None, 'rule': 'structure',
+                             'value': missing}, columns=REPORT_COLUMNS)
+
+    reports = []
+    for rule, col, check in rules:
+        issues = check(d).values
+        reports.append(pd.DataFrame({'row': d.index[issues], 'rule': rule,
+                                     'value': d[col].values[issues]},
+                                    columns=REPORT_COLUMNS))
+    return pd.concat(reports, ignore_index=True)
+
+
 def data_structure_test(d):
-    # ensure all expected columns and no others are present
-    EXPECTED_COLUMNS = {
-        'batch_id',
-        'currency',
-        'first_name',
-        'item_id',
-        'processed_code',
-        'receiver_email',
-        'value'
-    }
-    assert all([col in d.columns for col in EXPECTED_COLUMNS]), \
+    # ensure all expected columns are present
+    assert not EXPECTED_COLUMNS - set(d.columns), \
     'STOP! The input worksheet is not structured as expected.'
 
 
 def batch_size_test(d):
     # ensure no batch has more than 250 entries
-    assert d.groupby('batch_id').apply(lambda x: len(x) <= 250).all(), \
+    assert not batch_size_issues(d).any(), \
     'STOP! Some batches are too large.'
 
 
 def check_name_test(d):
     # check that names are not missing and place in proper case
-    assert d.first_name.notnull().all(), \
+    assert not name_issues(d).any(), \
     'STOP! Some names are missing.'
-    return d.first_name.apply(lambda x: x.title())
+    return d.first_name.str.title()
 
 
 def currency_type_test(d):
     # check currencies are valid
-    d.currency = d.currency.apply(lambda x: x.upper())
-    assert d.currency.all() in ['USD', 'PHP'], \
+    assert not currency_issues(d).any(), \
     'STOP! Not all currency choices are valid.'
-    return d.currency
+    return d.currency.str.upper()
 
 
 def email_formation_test(d):
     # check if email is well-formed
-    EMAIL_CHECK = '^\w*@\w*.(com|org|edu)$'
-    assert d.receiver_email.apply(lambda x: re.match(EMAIL_CHECK, x)).all(), \
+    assert not email_issues(d).any(), \
     'STOP! Not all email addresses are well-formed.'
 
 
 def unique_transaction_ids_test(d):
     # check all item id's are unique
-    assert d.groupby('batch_id').item_id.apply(lambda x: len(x) == len(set(x))).all(), \
+    assert not duplicate_id_issues(d).any(), \
     'STOP! Not all transactions IDs are unique within batches.'
 
 
 def values_numeric_test(d):
     # check currency values are valid
-    assert d.value.apply(lambda x: isinstance(x, (int, float))).all(), \
+    assert not value_issues(d).any(), \
     'STOP! Currencies not numeric'
 
 
-def data_checks(d):
-    data_structure_test(d)
-    batch_size_test(d)
-    d.first_name = check_name_test(d)
-    email_formation_test(d)
-    values_numeric_test(d)
-    d.currency = currency_type_test(d)
-    unique_transaction_ids_test(d)
+def data_checks(d, split=False):
+    # returns the violation report; a clean worksheet has its names and
+    # currencies normalized in place. Oversized batches pass when `split`
+    rules = [r for r in RULES if not (split and r[0] == 'batch_size')]
+    report = validate(d, rules)
+    if report.empty:
+        d['first_name'] = d.first_name.str.title()
+        d['currency'] = d.currency.str.upper()
+    return report
 
 
 def build_payout(df):
@@ -104,36 +181,46 @@ def build_payout(df):
     ]
 
 
-def run(args_dict):
-    # start logger
-    logger.info('Starting transactions for {}.'.format(args_dict['payments']))
-
-    # load payout worksheet
-    d = pd.read_csv(args_dict['payments'], sep=None, engine='python')
-
-    # subset to new transactions
-    subd = d[d.processed_code.isnull()]
-    if subd.shape[0]==0:
-        logger.info('STOP! No new transactions to process. Quitting and closing log.\n')
-        sys.exit()
-
-    # run data checks
-    data_checks(subd)
-
-    # group data by batches
-    subd = subd.groupby('batch_id')
-
-    # authenticate client
-    pp.configure(
-        {
-            'mode': args_dict['environment'],
-            'client_id': args_dict['auth'][0],
-            'client_secret': args_dict['auth'][1],
-        }
+def split_batches(d, size=MAX_BATCH, committed=()):
+    # sender_batch_id for every unpaid row: batches over `size` are cut into
+    # runs of `size` items in item id order, suffixed -1, -2, ...; a batch
+    # that already has a `committed` sender_batch_id (rows added after it was
+    # paid) is always suffixed, and suffixes skip every id PayPal has accepted
+    # or another batch uses, so none is ever sent twice
+    items = d.assign(sort_id=d.item_id.astype(str)).sort_values(
+        ['batch_id', 'sort_id'], kind='mergesort'
     )
-
-    # make payouts
-    for batch, details in subd:
+    batches = items.batch_id.astype(str)
+    part = items.groupby(batches).cumcount() // size
+    committed = set(committed)
+    taken = committed | set(batches)
+    names = {}
+    for batch, parts in part.groupby(batches).max().items():
+        if parts == 0 and batch not in committed:
+            names[batch, 0] = batch
+            continue
+        suffix = 0
+        for p in range(parts + 1):
+            suffix += 1
+            while '{}-{}'.format(batch, suffix) in taken:
+                suffix += 1
+            names[batch, p] = '{}-{}'.format(batch, suffix)
+            taken.add(names[batch, p])
+    return pd.Series([names[key] for key in zip(batches, part)],
+                     index=items.index).reindex(d.index)
+
+
+def transient(e):
+    # server errors, throttling, and dropped connections are worth a retry
+    if isinstance(e, ClientError):
+        return getattr(e.response, 'status_code', None) == 429
+    return isinstance(e, (ServerError, requests.RequestException))
+
+
+def submit_payout(batch, details, retries=3, backoff=1):
+    # returns (payout_batch_id, error); a retry reuses the sender_batch_id,
+    # which PayPal refuses to pay out twice
+    for attempt in range(retries + 1):
         payout = pp.Payout(
             {
                 'sender_batch_header': {
@@ -143,20 +230,119 @@ def run(args_dict):
                 'items': build_payout(details)
             },
         )
+        try:
+            if payout.create():
+                return payout.batch_header.payout_batch_id, None
+            return None, payout.error
+        except (ClientError, ServerError, requests.RequestException) as e:
+            if not transient(e):
+                raise
+            if attempt == retries:
+                return None, str(e)
+            wait = backoff * 2 ** attempt
+            logger.info('Payout for `batch_id` {} failed ({}); retrying in '
+                        '{}s.'.format(batch, e, wait))
+            time.sleep(wait)
+
 
-        # send payouts
-        if payout.create():
-            logger.info('Payout for `batch_id` {} successfully processed '
-                        '(processing code: {}).'
-                        .format(batch, payout.batch_header.payout_batch_id)
+def run(args_dict):
+    # start logger
+    logger.info('Starting transactions for {}.'.format(args_dict['payments']))
+
+    # load payout worksheet; call and stage metrics are written next to it
+    # however the run ends
+    registry = metrics.reset()
+    base = os.path.splitext(args_dict['payments'])[0]
+    with metrics.stage('load'):
+        d = read_ledger(args_dict['payments'])
+
+    # fold in batches committed by earlier runs, including any that crashed
+    # before the worksheet was written back
+    store = LedgerStore(ledger_store_path(args_dict['payments']))
+    try:
+        blank = d.processed_code.isnull().sum()
+        with metrics.stage('materialize'):
+            d = materialize(d, store)
+        if blank > d.processed_code.isnull().sum():
+            logger.info('{} transactions already committed to the ledger store.'
+                        .format(blank - d.processed_code.isnull().sum()))
+        if args_dict['materialize']:
+            write_ledger(d, args_dict['payments'])
+            logger.info('Wrote committed codes to {}. Closing log.\n'.format(
+                args_dict['payments'])
             )
-            d.loc[(d.batch_id==batch) & (d.processed_code.isnull()),
-                  'processed_code'] = payout.batch_header.payout_batch_id
+            sys.exit()
+
+        # subset to new transactions
+        subd = d[d.processed_code.isnull()].copy()
+        if subd.shape[0]==0:
+            logger.info('STOP! No new transactions to process. Quitting and closing log.\n')
+            sys.exit()
+
+        # run data checks, reporting every violation before stopping
+        with metrics.stage('validate'):
+            report = data_checks(subd, split=args_dict['split'])
+        if not report.empty:
+            for row, rule, value in report.itertuples(index=False):
+                logger.info('Row {} breaks `{}` rule: {}.'.format(row, rule,
+                                                                 value))
+            report_path = '{}_violations.csv'.format(base)
+            report.to_csv(report_path, index=False)
+            message = 'STOP! {} data check violations (see {}).'.format(
+                len(report), report_path)
+            logger.info('{} Quitting and closing log.\n'.format(message))
+            sys.exit(message)
+
+        # group data by batches, cutting oversized ones into sub-batches
+        if args_dict['split']:
+            paid = d.batch_id[d.processed_code.notnull()].astype(str)
+            sender_ids = split_batches(subd, committed=set(paid) |
+                                       store.sender_batch_ids())
         else:
-            logger.info(payout.error)
+            sender_ids = subd.batch_id
+        batches = list(subd.groupby(sender_ids))
 
-    # output data
-    d.to_csv(args_dict['payments'], index=False)
+        # authenticate client
+        config = {
+            'mode': args_dict['environment'],
+            'client_id': args_dict['auth'][0],
+            'client_secret': args_dict['auth'][1],
+        }
+        if args_dict['api_base']:
+            config['endpoint'] = args_dict['api_base']
+        configure(config, args_dict['token_cache'])
+
+        # make payouts concurrently, committing each batch's code the moment
+        # PayPal accepts it
+        def send(batch):
+            sender_batch_id, details = batch
+            code, error = submit_payout(sender_batch_id, details,
+                                        retries=args_dict['retries'])
+            if code:
+                store.commit(sender_batch_id, code, zip(details.batch_id,
+                                                        details.item_id))
+            return code, error
+
+        with metrics.stage('submit'), \
+                ThreadPoolExecutor(max_workers=args_dict['workers']) as pool:
+            for (batch, _), (code, error) in zip(batches,
+                                                 pool.map(send, batches)):
+                if code:
+                    logger.info('Payout for `batch_id` {} successfully '
+                                'processed (processing code: {}).'
+                                .format(batch, code))
+                else:
+                    logger.info(error)
+
+        # each paid batch's rows are already in the ledger store; the
+        # worksheet is left as is rather than rewritten whole on every run,
+        # and is filled in on demand with --materialize (or load_ledger)
+        logger.info('Committed codes are in {}; run with --materialize to '
+                    'write them to the worksheet.'.format(
+                        ledger_store_path(args_dict['payments'])))
+    finally:
+        store.close()
+        registry.write(base)
     logger.info('Closing log for {}.\n'.format(args_dict['payments']))
 
 
@@ -164,11 +350,30 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Make PayPal payments.')
     parser.add_argument('-a', '--auth', required=True, nargs=2, help='API '
                         'authorization key and secret (in that order).')
+    parser.add_argument('-b', '--api_base', required=False, default=None,
+                        help='Base URL of the PayPal API, e.g. a local stub '
+                        '(payments/stub.py); overrides the environment\'s.')
     parser.add_argument('-e', '--environment', required=False, default='sandbox',
                         choices=['sandbox', 'live'], help= 'Indicates the '
                         'environment for use.')
+    parser.add_argument('-m', '--materialize', action='store_true',
+                        help='Only write codes committed to the ledger store '
+                        'into the worksheet; pays nothing. Paying runs leave '
+                        'the worksheet as is.')
     parser.add_argument('-p', '--payments', required=True, help='Path/file to '
                         'CSV with payment information.')
+    parser.add_argument('-r', '--retries', required=False, default=3, type=int,
+                        help='Retries per batch on server errors, throttling, '
+                        'or dropped connections.')
+    parser.add_argument('-s', '--split', action='store_true', help='Split '
+                        'batches over 250 items into sub-batches (`batch_id`'
+                        '-1, -2, ...) instead of stopping.')
+    parser.add_argument('-t', '--token_cache', required=False,
+                        default=TOKEN_CACHE, help='File sharing PayPal access '
+                        'tokens between runs and processes; empty to fetch a '
+                        'token per run.')
+    parser.add_argument('-w', '--workers', required=False, default=4, type=int,
+                        help='Number of batches to submit at once.')
     args_dict = vars(parser.parse_args())
 
     run(args_dict)
@@ -6,6 +6,14 @@ import os
 import pandas as pd
 import paypalrestsdk as pp
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from paypalrestsdk.util import join_url_params
+
+from NGS2apis import metrics
+from NGS2apis.payments.cache import StatusCache
+from NGS2apis.payments.ledger import load_ledger, write_ledger
+from NGS2apis.payments.tokens import TOKEN_CACHE, configure
+
 
 VARNAMES = [
     'batch_id',
@@ -31,6 +39,7 @@ logging.getLogger('urllib3').setLevel(logging.INFO)
 
 def construct_details(items):
     return pd.DataFrame({
+        'processed_code': items['batch_header']['payout_batch_id'],
         'item_id': [item['payout_item']['sender_item_id'] for item in items['items']],
         'payout_item_id': [item['payout_item_id'] for item in items['items']],
         'transaction_status': [item['transaction_status'] for item in items['items']],
@@ -39,36 +48,94 @@ def construct_details(items):
     })
 
 
+def fetch_batch(code, page_size=1000, api=None):
+    # yields a details frame per page of a payout batch, following the pages
+    # until PayPal reports no more (the SDK's join_url repeats the last path
+    # segment on newer Pythons, so the path is built here)
+    api = api or pp.api.default()
+    page = 1
+    while True:
+        items = api.get(join_url_params('{}{}'.format(pp.Payout.path, code), {
+            'page': page,
+            'page_size': page_size,
+            'total_required': 'true',
+        }))
+        yield construct_details(items)
+        more = any(link.get('rel') == 'next' for link in items.get('links', []))
+        if not more and page >= items.get('total_page', 0):
+            break
+        page += 1
+
+
+def fetch_statuses(codes, workers=8, page_size=1000):
+    # item details for every batch in `codes`, gathered as each batch lands
+    def fetch(code):
+        return list(fetch_batch(code, page_size))
+
+    frames = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(fetch, code) for code in codes]
+        for future in as_completed(futures):
+            frames += future.result()
+    logger.info('Fetched {} items across {} batches.'.format(
+        sum(len(frame) for frame in frames), len(codes))
+    )
+    if not frames:
+        return construct_details({'batch_header': {'payout_batch_id': None},
+                                  'items': []})
+    return pd.concat(frames, axis=0, ignore_index=True)
+
+
 def run(args_dict):
     # authenticate client
-    pp.configure(
-        {
-            'mode': args_dict['environment'],
-            'client_id': args_dict['auth'][0],
-            'client_secret': args_dict['auth'][1],
-        }
-    )
+    config = {
+        'mode': args_dict['environment'],
+        'client_id': args_dict['auth'][0],
+        'client_secret': args_dict['auth'][1],
+    }
+    if args_dict['api_base']:
+        config['endpoint'] = args_dict['api_base']
+    configure(config, args_dict['token_cache'])
 
     # read in payments data
     logger.info('Starting post-processing for {}.'.format(args_dict['payments']))
-    d = pd.read_csv(args_dict['payments'], sep=None, engine='python')
-
-    # gather batch ids to find transaction history
-    ids = d.processed_code.unique().tolist()
-
-    # get transactions
-    post_process = [pp.Payout.find(code).to_dict() for code in ids]
+    registry = metrics.reset()
+    with metrics.stage('load'):
+        d = load_ledger(args_dict['payments'])
 
-    # extract transaction details
-    processed_data = [construct_details(item) for item in post_process]
-    processed_data = pd.concat(processed_data, axis=0)
+    # gather batch ids to find transaction history, skipping unpaid rows
+    ids = d.processed_code.dropna().unique().tolist()
 
-    # merge with payment information
-    d = d.merge(processed_data, on='item_id', how='left')
+    # poll only batches with items that may still change, then rebuild the
+    # details of every batch from the status cache; with webhooks feeding the
+    # cache (events.py) there may be nothing to poll at all
+    fname = os.path.splitext(args_dict['payments'])
+    cache = StatusCache('{}_statuses.db'.format(fname[0]))
+    try:
+        if args_dict['no_poll']:
+            stale = []
+        elif args_dict['refresh']:
+            stale = ids
+        else:
+            stale = cache.stale(ids)
+        logger.info('Polling {} of {} batches.'.format(len(stale), len(ids)))
+        with metrics.stage('poll'):
+            cache.update(fetch_statuses(stale, args_dict['workers']))
+        processed_data = cache.details(ids)
+    finally:
+        cache.close()
+
+    # merge with payment information; item ids repeat across batches, and
+    # PayPal returns them as strings
+    with metrics.stage('merge'):
+        d['item_key'] = d.item_id.astype(str)
+        d = d.merge(processed_data.rename(columns={'item_id': 'item_key'}),
+                    on=['processed_code', 'item_key'], how='left')
 
     # output data
-    fname = os.path.splitext(args_dict['payments'])
-    d[VARNAMES].to_csv('{}_final{}'.format(fname[0], fname[1]), index=False)
+    with metrics.stage('write'):
+        write_ledger(d[VARNAMES], '{}_final{}'.format(fname[0], fname[1]))
+    registry.write('{}_final'.format(fname[0]))
 
     logger.info(
         'Post-processing done. The file is at: {}_final{}'.format(fname[0],
@@ -81,11 +148,26 @@ if __name__ == '__main__':
                                      'transactions after processing payments.')
     parser.add_argument('-a', '--auth', required=True, nargs=2, help='API '
                         'authorization key and secret (in that order).')
+    parser.add_argument('-b', '--api_base', required=False, default=None,
+                        help='Base URL of the PayPal API, e.g. a local stub '
+                        '(payments/stub.py); overrides the environment\'s.')
     parser.add_argument('-e', '--environment', required=False, default='sandbox',
                         choices=['sandbox', 'live'], help= 'Indicates the '
                         'environment for use.')
+    parser.add_argument('-n', '--no_poll', action='store_true',
+                        help='Build the output from statuses already cached, '
+                        'e.g. by webhooks, without calling PayPal.')
     parser.add_argument('-p', '--payments', required=True, help='Path/file to '
                         'payments that have been processed through PayPal.')
+    parser.add_argument('-r', '--refresh', action='store_true',
+                        help='Poll every batch again, not only those with '
+                        'pending, unclaimed, or on-hold items.')
+    parser.add_argument('-t', '--token_cache', required=False,
+                        default=TOKEN_CACHE, help='File sharing PayPal access '
+                        'tokens between runs and processes; empty to fetch a '
+                        'token per run.')
+    parser.add_argument('-w', '--workers', required=False, default=8, type=int,
+                        help='Number of batches to fetch at once.')
     args_dict = vars(parser.parse_args())
 
     run(args_dict)
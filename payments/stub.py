@@ -0,0 +1,184 @@
+#!/usr/bin/python
+import argparse
+import itertools
+import json
+import re
+import time
+
+from NGS2apis.stub import JSONHandler, StubServer
+
+try:
+    from urllib.parse import parse_qs, urlencode, urlparse
+except ImportError:
+    from urllib import urlencode
+    from urlparse import parse_qs, urlparse
+
+
+# local stand-in for the slice of the PayPal REST API paypal.py and
+# paypal_post_process.py use
+TOKEN = '/v1/oauth2/token'
+PAYOUTS = re.compile(r'^/v1/payments/payouts/?(?:/(\w+))?$')
+
+
+class PayPalStub(StubServer):
+    def __init__(self, address=('127.0.0.1', 0), latency=0, error_rate=0,
+                 max_rps=None, unclaimed_rate=0, expires_in=32400, seed=None):
+        StubServer.__init__(self, address, StubHandler, latency, error_rate,
+                            max_rps, seed)
+        self.unclaimed_rate = unclaimed_rate
+        self.expires_in = expires_in
+
+        # payout_batch_id -> (sender_batch_id, items); items are kept as
+        # compact tuples so million-row ledgers fit; like PayPal, item ids come
+        # back as strings
+        self.batches = {}
+        self.sender_ids = set()
+        self.ids = itertools.count()
+
+    def failed(self):
+        with self.lock:
+            if self.random.random() < self.error_rate:
+                self.counts['failed'] += 1
+                return True
+            return False
+
+    def token(self):
+        with self.lock:
+            self.counts['token'] += 1
+        return 200, {'access_token': 'A21stub{}'.format(next(self.ids)),
+                     'token_type': 'Bearer', 'app_id': 'APP-STUB',
+                     'expires_in': self.expires_in}
+
+    def create(self, body):
+        header = body['sender_batch_header']
+        with self.lock:
+            self.counts['create'] += 1
+            if header['sender_batch_id'] in self.sender_ids:
+                return 400, {
+                    'name': 'USER_BUSINESS_ERROR',
+                    'message': 'User business error.',
+                    'details': [{'field': 'SENDER_BATCH_ID',
+                                 'issue': 'Batch with given sender_batch_id '
+                                          'already exists'}],
+                }
+            self.sender_ids.add(header['sender_batch_id'])
+            code = 'STUB{:012d}'.format(next(self.ids))
+            items = [(str(item['sender_item_id']), item['receiver'],
+                      item['amount']['value'], item['amount']['currency'],
+                      self.random.random() < self.unclaimed_rate)
+                     for item in body['items']]
+            self.batches[code] = (header['sender_batch_id'], items)
+        return 201, {'batch_header': {'payout_batch_id': code,
+                                      'batch_status': 'PENDING',
+                                      'sender_batch_header': header}}
+
+    def find(self, code, query):
+        with self.lock:
+            self.counts['find'] += 1
+            batch = self.batches.get(code)
+        if batch is None:
+            return 404, {'name': 'INVALID_RESOURCE_ID',
+                         'message': 'Requested resource ID was not found.'}
+        sender_batch_id, items = batch
+
+        page = int(query.get('page', 1))
+        size = int(query.get('page_size', 1000))
+        pages = max((len(items) + size - 1) // size, 1)
+        response = {
+            'batch_header': {'payout_batch_id': code,
+                             'batch_status': 'SUCCESS',
+                             'sender_batch_header': {
+                                 'sender_batch_id': sender_batch_id}},
+            'items': [{
+                'payout_item_id': '{}-{}'.format(code, i),
+                'payout_batch_id': code,
+                'transaction_status': 'UNCLAIMED' if unclaimed else 'SUCCESS',
+                'payout_item': {
+                    'sender_item_id': item_id,
+                    'receiver': receiver,
+                    'amount': {'value': value, 'currency': currency},
+                },
+            } for i, (item_id, receiver, value, currency, unclaimed) in
+                enumerate(items[(page - 1) * size:page * size],
+                          (page - 1) * size)],
+            'links': [],
+        }
+        if query.get('total_required') == 'true':
+            response['total_page'] = pages
+        if page < pages:
+            response['links'].append({
+                'rel': 'next', 'method': 'GET',
+                'href': '{}/v1/payments/payouts/{}?{}'.format(
+                    self.url, code, urlencode(dict(query, page=page + 1))),
+            })
+        return 200, response
+
+
+class StubHandler(JSONHandler):
+    def route(self):
+        # the stub's own counters are exempt from latency and failures
+        parts = urlparse(self.path)
+        if parts.path == '/stats':
+            self.respond(200, dict(self.server.counts))
+            return None, None
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.throttled():
+            self.respond(429, {'name': 'RATE_LIMIT_REACHED',
+                               'message': 'Too many requests.'},
+                         {'Retry-After': '1'})
+            return None, None
+        if self.server.failed():
+            self.respond(503, {'name': 'INTERNAL_SERVICE_ERROR',
+                               'message': 'An internal service error '
+                                          'occurred.'})
+            return None, None
+        query = dict((k, v[-1]) for k, v in parse_qs(parts.query).items())
+        return parts.path, query
+
+    def do_GET(self):
+        # the SDK sends a body with GETs too; read it so the kept-alive
+        # connection stays in step
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        path, query = self.route()
+        if path is None:
+            return
+        match = PAYOUTS.match(path)
+        if match is None or match.group(1) is None:
+            self.respond(404, {'name': 'NOT_FOUND'})
+        else:
+            self.respond(*self.server.find(match.group(1), query))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8')
+        path, _ = self.route()
+        if path is None:
+            return
+        if path == TOKEN:
+            self.respond(*self.server.token())
+        elif PAYOUTS.match(path) and PAYOUTS.match(path).group(1) is None:
+            self.respond(*self.server.create(json.loads(body)))
+        else:
+            self.respond(404, {'name': 'NOT_FOUND'})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a local stand-in for '
+                                     'the PayPal Payouts API.')
+    parser.add_argument('-e', '--error_rate', required=False, default=0,
+                        type=float, help='Share of requests answered with a '
+                        '503.')
+    parser.add_argument('-l', '--latency', required=False, default=0,
+                        type=float, help='Seconds added to every request.')
+    parser.add_argument('-p', '--port', required=False, default=8098, type=int,
+                        help='Port to listen on.')
+    parser.add_argument('-t', '--max_rps', required=False, default=None,
+                        type=float, help='Requests per second before '
+                        'answering 429.')
+    parser.add_argument('-u', '--unclaimed_rate', required=False, default=0,
+                        type=float, help='Share of items left unclaimed.')
+    args_dict = vars(parser.parse_args())
+
+    port = args_dict.pop('port')
+    PayPalStub(('127.0.0.1', port), **args_dict).serve_forever()
@@ -0,0 +1,33 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import pandas as pd
+import pytest
+
+from NGS2apis.payments.cache import *
+
+
+def details(rows):
+    return pd.DataFrame(rows, columns=DETAIL_COLUMNS)
+
+
+@pytest.mark.parametrize('cached, codes, expected', [
+    ([], ['P1', 'P2'], ['P1', 'P2']),
+    ([('P1', '1', 'I1', 'SUCCESS', '')], ['P1', 'P2'], ['P2']),
+    ([('P1', '1', 'I1', 'SUCCESS', ''), ('P1', '2', 'I2', 'UNCLAIMED', ''),
+      ('P2', '1', 'I3', 'FAILED', 'RECEIVER_UNREGISTERED')], ['P1', 'P2'],
+     ['P1']),
+])
+def test_status_cache_stale(tmpdir, cached, codes, expected):
+    cache = StatusCache(str(tmpdir.join('statuses.db')))
+    cache.update(details(cached))
+    assert cache.stale(codes) == expected
+
+
+def test_status_cache_update(tmpdir):
+    cache = StatusCache(str(tmpdir.join('statuses.db')))
+    cache.update(details([('P1', '1', 'I1', 'PENDING', ''),
+                          ('P2', '1', 'I2', 'SUCCESS', '')]))
+    cache.update(details([('P1', '1', 'I1', 'SUCCESS', '')]))
+    result = cache.details(['P1'])
+    assert result.values.tolist() == [['P1', '1', 'I1', 'SUCCESS', '']]
+    assert cache.stale(['P1', 'P2']) == []
@@ -0,0 +1,52 @@
+#!/usr/bin/python
+import numpy as np
+import pandas as pd
+import pytest
+
+from NGS2apis.payments.ledger import *
+
+
+@pytest.mark.parametrize('commits, expected', [
+    ([], [np.nan, 'OLD', np.nan]),
+    ([('A', 'PA', [('A', 1), ('A', 2)])], ['PA', 'OLD', np.nan]),
+    ([('B', 'PB', [('B', '1')]), ('B', 'PB2', [('B', '1')])],
+     [np.nan, 'OLD', 'PB']),
+])
+def test_materialize(tmpdir, commits, expected):
+    store = LedgerStore(str(tmpdir.join('ledger.db')))
+    for sender_batch_id, code, items in commits:
+        store.commit(sender_batch_id, code, items)
+    d = pd.DataFrame({
+        'batch_id': ['A', 'A', 'B'],
+        'item_id': [1, 2, 1],
+        'processed_code': [np.nan, 'OLD', np.nan],
+    })
+    result = materialize(d, store).processed_code.tolist()
+    assert [str(r) for r in result] == [str(e) for e in expected]
+
+
+def test_ledger_store_shared(tmpdir):
+    path = str(tmpdir.join('ledger.db'))
+    first, second = LedgerStore(path), LedgerStore(path)
+    first.commit('A-1', 'PA', [('A', 1)])
+    assert len(second) == 1
+    assert second.codes()[('A', '1')] == 'PA'
+
+
+@pytest.mark.parametrize('commits, expected', [
+    (None, ['nan', 'nan']),
+    ([('A', 'PA', [('A', 1)])], ['PA', 'nan']),
+])
+def test_load_ledger(tmpdir, commits, expected):
+    path = str(tmpdir.join('ledger.csv'))
+    pd.DataFrame({'batch_id': ['A', 'B'], 'item_id': [1, 1],
+                  'processed_code': [np.nan, np.nan]}).to_csv(path,
+                                                              index=False)
+    if commits is not None:
+        store = LedgerStore(ledger_store_path(path))
+        for sender_batch_id, code, items in commits:
+            store.commit(sender_batch_id, code, items)
+        store.close()
+    result = load_ledger(path).processed_code.tolist()
+    assert [str(r) for r in result] == expected
+    assert tmpdir.join('ledger_ledger.db').check() == (commits is not None)
@@ -0,0 +1,95 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+import pytest
+
+from NGS2apis.payments.paypal_post_process import *
+
+
+class FakeApi(object):
+    # serves `batches` (code -> statuses) a page at a time
+    def __init__(self, batches, next_links=True):
+        self.batches = batches
+        self.next_links = next_links
+        self.calls = []
+
+    def get(self, url):
+        self.calls.append(url)
+        path, query = url.split('?')
+        code = path.rstrip('/').split('/')[-1]
+        params = dict(p.split('=') for p in query.split('&'))
+        page, size = int(params['page']), int(params['page_size'])
+        statuses = self.batches[code]
+        pages = (len(statuses) + size - 1) // size
+        items = [{
+            'payout_item_id': '{}-{}'.format(code, i),
+            'transaction_status': status,
+            'payout_item': {'sender_item_id': str(i)},
+            'errors': {'name': 'RECEIVER_UNREGISTERED'},
+        } for i, status in enumerate(statuses)][(page - 1) * size:page * size]
+        response = {'batch_header': {'payout_batch_id': code}, 'items': items}
+        if self.next_links:
+            response['links'] = [{'rel': 'next'}] if page < pages else []
+        else:
+            response['total_page'] = pages
+        return response
+
+
+@pytest.mark.parametrize('next_links', [True, False])
+@pytest.mark.parametrize('page_size, expected_calls', [(2, 3), (1000, 1)])
+def test_fetch_batch(next_links, page_size, expected_calls):
+    api = FakeApi({'P1': ['SUCCESS', 'FAILED', 'UNCLAIMED', 'SUCCESS', 'ONHOLD']},
+                  next_links)
+    items = pd.concat(fetch_batch('P1', page_size, api=api))
+    assert len(api.calls) == expected_calls
+    assert items.item_id.tolist() == ['0', '1', '2', '3', '4']
+    assert items.error.tolist() == ['', 'RECEIVER_UNREGISTERED', '', '', '']
+    assert set(items.processed_code) == {'P1'}
+
+
+def test_run(monkeypatch, tmpdir):
+    api = FakeApi({'P1': ['SUCCESS', 'FAILED'], 'P2': ['UNCLAIMED']})
+    monkeypatch.setattr(pp.api, 'default', lambda: api)
+    monkeypatch.setattr(pp, 'configure', lambda options: None)
+    path = str(tmpdir.join('ledger.csv'))
+    pd.DataFrame({
+        'batch_id': ['A', 'A', 'B', 'C'],
+        'first_name': ['Mark', 'Liz', 'Fe', 'Fi'],
+        'receiver_email': ['a@b.com'] * 4,
+        'value': [1, 2, 3, 4],
+        'currency': ['USD'] * 4,
+        'item_id': [0, 1, 0, 0],
+        'processed_code': ['P1', 'P1', 'P2', np.nan],
+    }).to_csv(path, index=False)
+
+    args_dict = {'api_base': None, 'auth': ['id', 'secret'],
+                 'environment': 'sandbox', 'no_poll': False,
+                 'payments': path, 'refresh': False, 'token_cache': None,
+                 'workers': 2}
+    run(args_dict)
+
+    result = pd.read_csv(str(tmpdir.join('ledger_final.csv')))
+    assert list(result.columns) == VARNAMES
+    assert result.transaction_status.fillna('').tolist() == [
+        'SUCCESS', 'FAILED', 'UNCLAIMED', ''
+    ]
+    assert not any(url.startswith('/v1/payments/payouts/nan') for
+                   url in api.calls)
+
+    # a second run polls only the batch with an unclaimed item
+    api.batches['P2'] = ['RETURNED']
+    api.calls = []
+    run(args_dict)
+    assert [url.split('?')[0] for url in api.calls] == ['/v1/payments/payouts/P2']
+    result = pd.read_csv(str(tmpdir.join('ledger_final.csv')))
+    assert result.transaction_status.fillna('').tolist() == [
+        'SUCCESS', 'FAILED', 'RETURNED', ''
+    ]
+
+    # nothing left open, unless asked to refresh
+    api.calls = []
+    run(args_dict)
+    assert api.calls == []
+    run(dict(args_dict, refresh=True))
+    assert len(api.calls) == 2
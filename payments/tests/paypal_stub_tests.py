@@ -0,0 +1,121 @@
+#!/usr/bin/python
+import json
+import pandas as pd
+import paypalrestsdk as pp
+import pytest
+import time
+
+from NGS2apis.payments import paypal_post_process
+from NGS2apis.payments.benchmark import write_synthetic_ledger
+from NGS2apis.payments.ledger import load_ledger
+from NGS2apis.payments.paypal import run, submit_payout
+from NGS2apis.payments.paypal_post_process import fetch_batch
+from NGS2apis.payments.tokens import configure
+from NGS2apis.transport import Transport
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    from NGS2apis.payments.stub import PayPalStub
+    server = PayPalStub(seed=0).start()
+    monkeypatch.setattr(pp.api, '__api__', None)
+    configure({'mode': 'sandbox', 'client_id': 'id', 'client_secret': 'secret',
+               'endpoint': server.url}, None, Transport(retries=10,
+                                                        backoff=.01))
+    yield server
+    server.stop()
+
+
+def details(n, batch='A'):
+    return pd.DataFrame({
+        'batch_id': [batch] * n,
+        'first_name': ['P{}'.format(i) for i in range(n)],
+        'receiver_email': ['p{}@test.com'.format(i) for i in range(n)],
+        'value': [1.5] * n,
+        'currency': ['USD'] * n,
+        'item_id': range(n),
+    })
+
+
+def test_submit(stub):
+    code, error = submit_payout('A', details(3))
+    assert code.startswith('STUB') and error is None
+    assert [item[0] for item in stub.batches[code][1]] == ['0', '1', '2']
+
+
+def test_duplicate_sender_batch_id(stub):
+    submit_payout('A', details(1))
+    code, error = submit_payout('A', details(1))
+    assert code is None and error['name'] == 'USER_BUSINESS_ERROR'
+
+
+def test_retries_server_errors(stub):
+    stub.error_rate = .5
+    codes = [submit_payout(batch, details(1, batch), retries=20, backoff=0)[0]
+             for batch in 'ABCD']
+    assert all(codes)
+    assert stub.counts['failed'] > 0
+
+
+def test_fetch_retries_server_errors(stub):
+    code, _ = submit_payout('A', details(5))
+    stub.error_rate = .5
+    pages = list(fetch_batch(code, 1))
+    assert len(pages) == 5
+    assert stub.counts['failed'] > 0
+
+
+def test_retries_throttling(stub):
+    stub.max_rps = 2
+    codes = [submit_payout(batch, details(1, batch), retries=20,
+                           backoff=.1)[0] for batch in 'ABCD']
+    assert all(codes)
+    assert stub.counts['throttled'] > 0
+
+
+@pytest.mark.parametrize('page_size', [1, 2, 50])
+def test_fetch_pages(stub, page_size):
+    code, _ = submit_payout('A', details(5))
+    pages = list(fetch_batch(code, page_size))
+    assert len(pages) == -(-5 // page_size)
+    assert pd.concat(pages).item_id.tolist() == ['0', '1', '2', '3', '4']
+
+
+def test_run_against_stub(stub, tmpdir):
+    stub.unclaimed_rate = .5
+    path = str(tmpdir.join('ledger.csv'))
+    write_synthetic_ledger(path, 600)
+    args_dict = {'api_base': stub.url, 'auth': ['id', 'secret'],
+                 'environment': 'sandbox', 'payments': path,
+                 'token_cache': str(tmpdir.join('tokens.json')), 'workers': 2}
+
+    run(dict(args_dict, materialize=False, retries=0, split=False))
+    paid = load_ledger(path)
+    assert paid.processed_code.notnull().all()
+    assert paid.processed_code.nunique() == 3
+
+    paypal_post_process.run(dict(args_dict, no_poll=False, refresh=False))
+    result = pd.read_csv(str(tmpdir.join('ledger_final.csv')))
+    assert len(result) == 600
+    assert set(result.transaction_status) == {'SUCCESS', 'UNCLAIMED'}
+    assert stub.counts['create'] == 3 and stub.counts['find'] == 3
+    assert stub.counts['token'] == 1
+
+    # each run leaves its call metrics beside the ledger
+    with open(str(tmpdir.join('ledger_metrics.json'))) as f:
+        calls = json.load(f)['api_calls_total']
+    assert [(row['call'], row['outcome'], row['value']) for row in calls] == [
+        ('oauth.token', 'ok', 1), ('payout.create', 'ok', 3)]
+    assert 'call="payout.find"' in tmpdir.join(
+        'ledger_final_metrics.prom').read()
+
+
+def test_no_added_latency(stub):
+    # a zero-latency stub answers kept-alive calls well inside a delayed ACK
+    code, _ = submit_payout('A', details(1))
+    timings = []
+    for _ in range(20):
+        start = time.time()
+        list(fetch_batch(code, 50))
+        timings.append(time.time() - start)
+    assert sorted(timings)[10] < .02
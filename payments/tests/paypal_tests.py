@@ -3,6 +3,9 @@ import numpy as np
 import pandas as pd
 import pytest
 
+import requests
+
+from NGS2apis.payments.ledger import load_ledger
 from NGS2apis.payments.paypal import *
 
 
@@ -175,3 +178,226 @@ def test_build_payout(test, expected):
     assert result[0]['amount']['currency'] == expected[2]
     assert result[0]['receiver'] == expected[3]
     assert result[0]['sender_item_id'] == expected[4]
+
+
+def ledger(**overrides):
+    d = pd.DataFrame({
+        'batch_id': ['A', 'A', 'B'],
+        'first_name': ['mark', 'LIZ', 'fe'],
+        'receiver_email': ['this@g.com', 'that@help.edu', '112@test.org'],
+        'value': [1, .99, 2.3],
+        'currency': ['usd', 'USD', 'php'],
+        'item_id': ['A1', 'A2', 'B1'],
+        'processed_code': [np.nan] * 3,
+    })
+    for col, values in overrides.items():
+        d[col] = values
+    return d
+
+
+@pytest.mark.parametrize('test, expected', [
+    (ledger(), []),
+    (ledger(first_name=['mark', np.nan, 'fe']), [(1, 'missing_name')]),
+    (ledger(receiver_email=['112@help', 'this@good.com', 'that#fail.org']),
+     [(0, 'email'), (2, 'email')]),
+    (ledger(value=['1', 1.99, np.nan]), [(0, 'value'), (2, 'value')]),
+    (ledger(currency=['USD', 'US', 'AUD']), [(1, 'currency'), (2, 'currency')]),
+    (ledger(item_id=['A1', 'A1', 'A1']),
+     [(0, 'duplicate_item_id'), (1, 'duplicate_item_id')]),
+    (ledger(currency=['USD', 'US', 'PHP'], item_id=['A1', 'A1', 'B1']),
+     [(1, 'currency'), (0, 'duplicate_item_id'), (1, 'duplicate_item_id')]),
+])
+def test_validate(test, expected):
+    report = validate(test)
+    assert list(report.columns) == ['row', 'rule', 'value']
+    assert list(zip(report.row, report.rule)) == expected
+
+
+def test_validate_batch_size():
+    d = ledger()
+    d = pd.concat([d] + [d.iloc[[0]]] * 250, ignore_index=True)
+    d['item_id'] = range(len(d))
+    report = validate(d)
+    assert set(report.rule) == {'batch_size'}
+    assert len(report) == 252
+
+
+def test_validate_structure():
+    report = validate(ledger().drop(['currency', 'value'], axis=1))
+    assert list(zip(report.rule, report.value)) == [('structure', 'currency'),
+                                                    ('structure', 'value')]
+
+
+def test_data_checks_normalizes():
+    d = ledger()
+    assert data_checks(d).empty
+    assert list(d.first_name) == ['Mark', 'Liz', 'Fe']
+    assert list(d.currency) == ['USD', 'USD', 'PHP']
+
+
+@pytest.mark.parametrize('sizes, size, expected', [
+    ({'A': 3, 'B': 1}, 250, {'A': 3, 'B': 1}),
+    ({'A': 5, 'B': 2}, 2, {'A-1': 2, 'A-2': 2, 'A-3': 1, 'B': 2}),
+])
+def test_split_batches(sizes, size, expected):
+    d = pd.DataFrame({
+        'batch_id': [b for b, n in sizes.items() for _ in range(n)],
+        'item_id': ['{}{}'.format(b, i) for b, n in sizes.items() for
+                    i in range(n)],
+    })
+    ids = split_batches(d, size)
+    assert ids.value_counts().to_dict() == expected
+
+    # shuffled rows land in the same sub-batches
+    shuffled = d.sample(frac=1, random_state=0)
+    assert split_batches(shuffled, size).loc[d.index].equals(ids)
+
+
+@pytest.mark.parametrize('committed, expected', [
+    (set(), {'A-1': 2, 'A-2': 1, 'B': 2}),
+    ({'B'}, {'A-1': 2, 'A-2': 1, 'B-1': 2}),
+    ({'A-1', 'A-3', 'B-1'}, {'A-2': 2, 'A-4': 1, 'B': 2}),
+])
+def test_split_batches_committed(committed, expected):
+    # only unpaid rows are split, and no committed id is handed out again
+    d = pd.DataFrame({'batch_id': ['A'] * 3 + ['B'] * 2,
+                      'item_id': ['A1', 'A2', 'A3', 'B1', 'B2']})
+    assert split_batches(d, 2, committed).value_counts().to_dict() == expected
+
+
+def test_split_batches_other_batch_ids():
+    # a suffix never lands on another batch's own id
+    d = pd.DataFrame({'batch_id': ['A', 'A', 'A-1'],
+                      'item_id': ['A1', 'A2', 'X1']})
+    assert split_batches(d, 1).tolist() == ['A-2', 'A-3', 'A-1']
+
+
+class FakePayout(object):
+    # fails with the queued exceptions, then succeeds; batches in `broken`
+    # always raise their exception
+    failures = []
+    created = []
+    broken = {}
+
+    def __init__(self, attributes):
+        self.attributes = attributes
+        self.error = None
+
+    def create(self):
+        batch = self.attributes['sender_batch_header']['sender_batch_id']
+        if batch in self.broken:
+            raise self.broken[batch]
+        if self.failures:
+            raise self.failures.pop(0)
+        self.created.append(batch)
+        self.batch_header = type('Header', (object, ),
+                                 {'payout_batch_id': 'P' + batch})
+        return True
+
+
+def response(status):
+    return type('Response', (object, ), {'status_code': status})
+
+
+@pytest.fixture
+def payouts(monkeypatch):
+    monkeypatch.setattr(pp, 'Payout', FakePayout)
+    FakePayout.failures, FakePayout.created, FakePayout.broken = [], [], {}
+    return FakePayout
+
+
+@pytest.mark.parametrize('failures, expected', [
+    ([], ('PA', None)),
+    ([ServerError(response(503)), requests.ConnectionError()], ('PA', None)),
+    ([ClientError(response(429))] * 3, (None, 'Failed.')),
+])
+def test_submit_payout(payouts, failures, expected):
+    payouts.failures = list(failures)
+    code, error = submit_payout('A', ledger().iloc[:1], retries=2, backoff=0)
+    assert code == expected[0]
+    assert (error is None) == (expected[1] is None)
+
+
+@pytest.mark.xfail(raises=ClientError)
+def test_submit_payout_permanent(payouts):
+    payouts.failures = [ClientError(response(403))]
+    submit_payout('A', ledger().iloc[:1], retries=2, backoff=0)
+
+
+def test_run_split(payouts, tmpdir):
+    d = ledger()
+    d = pd.concat([d.iloc[:2]] + [d.iloc[[2]]] * 502, ignore_index=True)
+    d['item_id'] = ['A1', 'A2'] + ['B{:03d}'.format(i) for i in range(502)]
+    d['processed_code'] = ['OLD'] + [np.nan] * 503
+    path = str(tmpdir.join('ledger.csv'))
+    d.to_csv(path, index=False)
+
+    run({'api_base': None, 'auth': ['id', 'secret'], 'environment': 'sandbox',
+         'materialize': False, 'payments': path, 'retries': 0,
+         'split': True, 'token_cache': None, 'workers': 2})
+
+    # the worksheet isn't rewritten; its codes come from the ledger store
+    assert pd.read_csv(path).processed_code.isnull().sum() == 503
+
+    # A was partly paid already, so its new row goes out under a fresh id
+    result = load_ledger(path)
+    assert sorted(payouts.created) == ['A-1', 'B-1', 'B-2', 'B-3']
+    assert list(result.processed_code[:2]) == ['OLD', 'PA-1']
+    assert result.processed_code[2:].value_counts().to_dict() == {
+        'PB-1': 250, 'PB-2': 250, 'PB-3': 2
+    }
+
+    # rows added to B later never reuse a sender_batch_id PayPal accepted
+    added = pd.concat([result, result.iloc[[2, 2]]], ignore_index=True)
+    added['item_id'] = list(result.item_id) + ['B500', 'B999']
+    added.loc[len(result):, 'processed_code'] = np.nan
+    added.to_csv(path, index=False)
+    run({'api_base': None, 'auth': ['id', 'secret'], 'environment': 'sandbox',
+         'materialize': False, 'payments': path, 'retries': 0,
+         'split': True, 'token_cache': None, 'workers': 2})
+    assert sorted(payouts.created) == ['A-1', 'B-1', 'B-2', 'B-3', 'B-4']
+    assert load_ledger(path).processed_code[:len(result)].equals(
+        result.processed_code)
+
+
+def test_run_violations_exit_code(payouts, tmpdir):
+    # a rejected worksheet exits non-zero, like the assertions it replaced
+    path = str(tmpdir.join('ledger.csv'))
+    ledger(receiver_email=['this@g.com', 'nope', '112@test.org']).to_csv(
+        path, index=False)
+    with pytest.raises(SystemExit) as e:
+        run({'api_base': None, 'auth': ['id', 'secret'],
+             'environment': 'sandbox', 'materialize': False, 'payments': path,
+             'retries': 0, 'split': False, 'token_cache': None, 'workers': 1})
+    assert e.value.code not in (None, 0)
+    assert str(e.value.code).startswith('STOP! 1 data check violations')
+    assert tmpdir.join('ledger_violations.csv').check()
+    assert payouts.created == []
+
+
+def test_run_crash_resume(payouts, tmpdir):
+    d = ledger()
+    path = str(tmpdir.join('ledger.csv'))
+    d.to_csv(path, index=False)
+    args_dict = {'api_base': None, 'auth': ['id', 'secret'],
+                 'environment': 'sandbox', 'materialize': False,
+                 'payments': path, 'retries': 0, 'split': False,
+                 'token_cache': None, 'workers': 1}
+
+    # batch A is paid, then B dies before the worksheet is written
+    payouts.broken = {'B': ClientError(response(403))}
+    with pytest.raises(ClientError):
+        run(args_dict)
+    assert pd.read_csv(path).processed_code.isnull().all()
+
+    # on demand the worksheet picks up what was committed
+    with pytest.raises(SystemExit):
+        run(dict(args_dict, materialize=True))
+    assert pd.read_csv(path).processed_code.tolist()[:2] == ['PA', 'PA']
+
+    # a rerun pays only B
+    payouts.broken = {}
+    run(args_dict)
+    assert payouts.created == ['A', 'B']
+    assert pd.read_csv(path).processed_code[2:].isnull().all()
+    assert load_ledger(path).processed_code.tolist() == ['PA', 'PA', 'PB']
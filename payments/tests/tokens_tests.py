@@ -0,0 +1,77 @@
+#!/usr/bin/python
+import multiprocessing
+import os
+import pytest
+import time
+
+from NGS2apis.payments.stub import PayPalStub
+from NGS2apis.payments.tokens import *
+
+
+@pytest.fixture
+def stub():
+    server = PayPalStub().start()
+    yield server
+    server.stop()
+
+
+def api(stub, path, client_id='id', margin=300):
+    return CachedTokenApi({'mode': 'sandbox', 'client_id': client_id,
+                           'client_secret': 'secret', 'endpoint': stub.url},
+                          cache=TokenCache(path, margin))
+
+
+def fetch(url, path):
+    CachedTokenApi({'mode': 'sandbox', 'client_id': 'id',
+                    'client_secret': 'secret', 'endpoint': url},
+                   cache=TokenCache(path)).get_access_token()
+
+
+@pytest.mark.parametrize('expires_in, expected', [(32400, 1), (200, 2)])
+def test_shared_between_clients(stub, tmpdir, expires_in, expected):
+    stub.expires_in = expires_in
+    path = str(tmpdir.join('tokens.json'))
+    first = api(stub, path).get_access_token()
+    second = api(stub, path).get_access_token()
+    assert stub.counts['token'] == expected
+    assert (first == second) == (expected == 1)
+
+
+def test_keyed_by_client_id(stub, tmpdir):
+    path = str(tmpdir.join('tokens.json'))
+    api(stub, path, 'one').get_access_token()
+    api(stub, path, 'two').get_access_token()
+    api(stub, path, 'one').get_access_token()
+    assert stub.counts['token'] == 2
+    assert os.stat(path).st_mode & 0o777 == 0o600
+
+
+def test_rejected_token_replaced(stub, tmpdir):
+    client = api(stub, str(tmpdir.join('tokens.json')))
+    first = client.get_access_token()
+    client.token_hash = None    # what the SDK does on a 401
+    assert client.get_access_token() != first
+    assert stub.counts['token'] == 2
+
+
+def test_refreshed_ahead_of_expiry(stub, tmpdir):
+    stub.expires_in = 400
+    client = api(stub, str(tmpdir.join('tokens.json')), margin=399)
+    client.get_access_token()
+    client.get_access_token()
+    assert stub.counts['token'] == 1
+    time.sleep(1.1)
+    client.get_access_token()
+    assert stub.counts['token'] == 2
+
+
+def test_processes_start_together(stub, tmpdir):
+    path = str(tmpdir.join('tokens.json'))
+    workers = [multiprocessing.Process(target=fetch, args=(stub.url, path))
+               for _ in range(6)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert all(worker.exitcode == 0 for worker in workers)
+    assert stub.counts['token'] == 1
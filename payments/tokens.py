@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import datetime
+import json
+import logging
+import os
+import paypalrestsdk as pp
+import tempfile
+import time
+
+from NGS2apis.payments.api import TransportApi
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+
+TOKEN_CACHE = os.path.join(os.path.expanduser('~'), '.ngs2_paypal_tokens.json')
+
+
+class TokenCache(object):
+    # PayPal access tokens and their expiry in a local JSON file, keyed by
+    # client_id and environment; the file stays locked while a token is read
+    # or refreshed, so processes starting together fetch one token between
+    # them, and a token is replaced `margin` seconds before it expires
+    def __init__(self, path=TOKEN_CACHE, margin=300):
+        self.path = path
+        self.margin = margin
+
+    def key(self, api):
+        return '{}|{}|{}'.format(api.mode, api.token_endpoint, api.client_id)
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _write(self, entries):
+        # readable by the owner only, and swapped in whole so a crash never
+        # leaves half a file
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entries, f)
+        os.chmod(tmp, 0o600)
+        os.rename(tmp, self.path)
+
+    def token(self, api, rejected=None):
+        # (token_hash, expires_at) for `api`, fetched with the client's
+        # credentials only when the cached token is missing, due to expire, or
+        # is the `rejected` access token
+        with open('{}.lock'.format(self.path), 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = self._read()
+            entry = entries.get(self.key(api))
+            if (entry is None or entry['expires_at'] - self.margin <= time.time()
+                    or entry['token']['access_token'] == rejected):
+                api.token_hash = None
+                token = pp.Api.get_token_hash(api)
+                entry = {'token': token,
+                         'expires_at': time.time() + token['expires_in']}
+                entries[self.key(api)] = entry
+                self._write(entries)
+                logger.info('Fetched a new PayPal token for {}.'.format(
+                    api.client_id))
+        return entry['token'], entry['expires_at']
+
+
+class CachedTokenApi(TransportApi):
+    # draws client-credential tokens from a TokenCache; the SDK drops a token
+    # PayPal refuses, and the next call asks the cache to replace it
+    def __init__(self, options=None, cache=None, transport=None, **kwargs):
+        TransportApi.__init__(self, options, transport, **kwargs)
+        self.cache = cache or TokenCache()
+        self.held = None
+
+    def get_token_hash(self, authorization_code=None, refresh_token=None,
+                       headers=None):
+        if authorization_code is not None or refresh_token is not None:
+            return pp.Api.get_token_hash(self, authorization_code,
+                                         refresh_token, headers)
+        self.validate_token_hash()
+        if self.token_hash is None:
+            token, expires_at = self.cache.token(self, rejected=self.held)
+            # the SDK expires a token `expires_in` seconds after it was
+            # requested; backdate that so it lets go `margin` seconds early
+            left = expires_at - self.cache.margin - time.time()
+            self.token_request_at = datetime.datetime.now() - \
+                datetime.timedelta(seconds=token['expires_in'] - left)
+            self.token_hash = token
+            self.held = token['access_token']
+        return self.token_hash
+
+
+def configure(options, path=TOKEN_CACHE, transport=None):
+    # pp.configure, with the default Api on the package transport and sharing
+    # tokens through the cache at `path` (none: a token per process)
+    if not path:
+        pp.api.__api__ = TransportApi(options, transport)
+    else:
+        pp.api.__api__ = CachedTokenApi(options, TokenCache(path), transport)
+    return pp.api.__api__
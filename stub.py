@@ -0,0 +1,107 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import collections
+import json
+import multiprocessing
+import random
+import resource
+import sys
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    # threaded local stand-in for an API: added latency, a share of failed
+    # calls, and a requests-per-second ceiling past which calls are throttled
+    daemon_threads = True
+
+    def __init__(self, address, handler, latency=0, error_rate=0,
+                 max_rps=None, seed=None):
+        HTTPServer.__init__(self, address, handler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.max_rps = max_rps
+        self.random = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.arrivals = collections.deque()
+        self.counts = collections.Counter()
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def throttled(self):
+        # sliding one-second window of accepted requests
+        if self.max_rps is None:
+            return False
+        with self.lock:
+            now = time.time()
+            while self.arrivals and self.arrivals[0] <= now - 1:
+                self.arrivals.popleft()
+            if len(self.arrivals) >= self.max_rps:
+                self.counts['throttled'] += 1
+                return True
+            self.arrivals.append(now)
+            return False
+
+
+class JSONHandler(BaseHTTPRequestHandler):
+    # keep-alive JSON responses for the local API stubs; headers and body go
+    # out in separate writes, so with Nagle on the body would wait on the
+    # client's delayed ACK and every call would gain ~40ms
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(ports, server, stub_args):
+    stub = server(**stub_args)
+    ports.put(stub.server_address[1])
+    stub.serve_forever()
+
+
+def start_stub(server, stub_args):
+    # a `server` stub in a separate process, so a benchmark's peak memory is
+    # the client's alone
+    ports = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve,
+                                      args=(ports, server, stub_args))
+    process.daemon = True
+    process.start()
+    return process, 'http://127.0.0.1:{}'.format(ports.get(timeout=10))
+
+
+def peak_memory_mb():
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024.0 ** (2 if sys.platform == 'darwin' else 1)
@@ -0,0 +1,121 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import json
+import pytest
+import requests
+import threading
+
+from twilio.request_validator import RequestValidator
+
+from NGS2apis.events import *
+
+
+# recorded payloads, trimmed to the fields the receiver reads
+TWILIO_CALLBACKS = [
+    {'AccountSid': 'AC1', 'MessageSid': 'SM1', 'MessageStatus': 'sent',
+     'To': '+12025550100', 'From': '+15005550006'},
+    {'AccountSid': 'AC1', 'MessageSid': 'SM1', 'MessageStatus': 'delivered',
+     'To': '+12025550100', 'From': '+15005550006'},
+    {'AccountSid': 'AC1', 'MessageSid': 'SM2', 'MessageStatus': 'undelivered',
+     'To': '+12025550101', 'From': '+15005550006', 'ErrorCode': '30003'},
+]
+
+PAYPAL_EVENTS = [
+    {'id': 'WH-1', 'event_type': 'PAYMENT.PAYOUTS-ITEM.UNCLAIMED',
+     'resource_type': 'payouts_item',
+     'resource': {'payout_item_id': 'I1', 'payout_batch_id': 'P1',
+                  'transaction_status': 'UNCLAIMED',
+                  'payout_item': {'sender_item_id': 'A1'}}},
+    {'id': 'WH-2', 'event_type': 'PAYMENT.PAYOUTS-ITEM.FAILED',
+     'resource_type': 'payouts_item',
+     'resource': {'payout_item_id': 'I2', 'payout_batch_id': 'P1',
+                  'transaction_status': 'FAILED',
+                  'errors': {'name': 'RECEIVER_UNREGISTERED'},
+                  'payout_item': {'sender_item_id': 'A2'}}},
+    {'id': 'WH-3', 'event_type': 'PAYMENT.PAYOUTSBATCH.SUCCESS',
+     'resource_type': 'payouts',
+     'resource': {'batch_header': {'payout_batch_id': 'P1'}}},
+]
+
+
+@pytest.fixture
+def server(tmpdir):
+    server = EventServer(
+        ('127.0.0.1', 0),
+        callbacks=CallbackStore(str(tmpdir.join('callbacks.db'))),
+        statuses=StatusCache(str(tmpdir.join('statuses.db'))),
+        auth_token='token', public_url='https://events.example.org',
+        paypal_verify=lambda headers, body: headers.get('PAYPAL-TRANSMISSION-SIG') == 'good',
+    )
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def post(server, path, data, headers):
+    return requests.post('http://127.0.0.1:{}{}'.format(
+        server.server_address[1], path), data=data, headers=headers)
+
+
+def twilio_post(server, params, token='token'):
+    signature = RequestValidator(token).compute_signature(
+        'https://events.example.org' + TWILIO_PATH, params
+    )
+    return post(server, TWILIO_PATH, params, {'X-Twilio-Signature': signature})
+
+
+def test_twilio_replay(server):
+    for params in TWILIO_CALLBACKS:
+        assert twilio_post(server, params).status_code == 204
+
+    # a late `sent` does not undo `delivered`
+    assert twilio_post(server, TWILIO_CALLBACKS[0]).status_code == 204
+    assert server.callbacks.statuses(['SM1', 'SM2', 'SM3']) == {
+        'SM1': ('delivered', None), 'SM2': ('undelivered', '30003'),
+    }
+
+
+@pytest.mark.parametrize('token', ['wrong', None])
+def test_twilio_refused(server, token):
+    params = TWILIO_CALLBACKS[0]
+    if token is None:
+        response = post(server, TWILIO_PATH, params, {})
+    else:
+        response = twilio_post(server, params, token)
+    assert response.status_code == 403
+    assert server.callbacks.statuses(['SM1']) == {}
+
+
+def test_paypal_replay(server):
+    for event in PAYPAL_EVENTS:
+        response = post(server, PAYPAL_PATH, json.dumps(event),
+                        {'PAYPAL-TRANSMISSION-SIG': 'good'})
+        assert response.status_code == 204
+
+    # a redelivered UNCLAIMED after the item was claimed changes nothing
+    claimed = json.loads(json.dumps(PAYPAL_EVENTS[0]))
+    claimed['resource']['transaction_status'] = 'SUCCESS'
+    handle_paypal(server.statuses, claimed)
+    assert not handle_paypal(server.statuses, PAYPAL_EVENTS[0])
+    assert sorted(server.statuses.details(['P1']).values.tolist()) == [
+        ['P1', 'A1', 'I1', 'SUCCESS', ''],
+        ['P1', 'A2', 'I2', 'FAILED', 'RECEIVER_UNREGISTERED'],
+    ]
+
+
+@pytest.mark.parametrize('signature, body, expected', [
+    ('bad', json.dumps(PAYPAL_EVENTS[0]), 403),
+    ('good', '{"event_type": "PAYMENT.PAYOUTS-ITEM.FAILED"}', 400),
+])
+def test_paypal_refused(server, signature, body, expected):
+    response = post(server, PAYPAL_PATH, body,
+                    {'PAYPAL-TRANSMISSION-SIG': signature})
+    assert response.status_code == expected
+    assert server.statuses.details(['P1']).empty
+
+
+def test_unknown_path(server):
+    assert post(server, '/other', 'x', {}).status_code == 404
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import json
+import pytest
+import threading
+import time
+
+from NGS2apis import metrics
+from NGS2apis.metrics import *
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    monkeypatch.setattr(metrics, '__registry__', None)
+    return reset()
+
+
+@pytest.mark.parametrize('values, expected_counts, expected_p50', [
+    ([.001, .02, .02, 3, 100], {0: 1, 2: 2, 9: 1, 13: 1}, .02),
+    ([], {}, 0.0),
+])
+def test_histogram(values, expected_counts, expected_p50):
+    hist = Histogram()
+    for value in values:
+        hist.observe(value)
+    assert dict((i, c) for i, c in enumerate(hist.counts) if c) == \
+        expected_counts
+    assert hist.quantile(.5) == expected_p50
+
+
+def test_histogram_reservoir():
+    hist = Histogram(reservoir=100)
+    for i in range(1000):
+        hist.observe(i / 1000.0)
+    assert len(hist.samples) == 100 and hist.count == 1000
+    assert .3 < hist.quantile(.5) < .7
+
+
+@pytest.mark.parametrize('labels, extra, expected', [
+    ((), (), ''),
+    ((('call', 'a"b'), ), (), '{call="a\\"b"}'),
+    ((('a', 1), ), [('le', '+Inf')], '{a="1",le="+Inf"}'),
+])
+def test_label_text(labels, extra, expected):
+    assert label_text(labels, extra) == expected
+
+
+def test_track_outcomes(registry):
+    with track('twilio', 'messages.create'):
+        pass
+    with track('twilio', 'messages.create') as call:
+        call.status(429)
+    with pytest.raises(ValueError):
+        with track('twilio', 'messages.create'):
+            raise ValueError('boom')
+    counts = dict((row['outcome'], row['value']) for row in
+                  registry.summary()['api_calls_total'])
+    assert counts == {'ok': 1, 'throttled': 1, 'error': 1}
+    latency = registry.summary()['api_call_seconds'][0]
+    assert latency['count'] == 3 and latency['call'] == 'messages.create'
+
+
+def test_in_flight_peak(registry):
+    def call():
+        with track('paypal', 'payout.find'):
+            time.sleep(.05)
+    threads = [threading.Thread(target=call) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    summary = registry.summary()
+    assert summary['api_in_flight'][0]['value'] == 0
+    assert summary['api_in_flight_max'][0]['value'] == 4
+
+
+def test_prometheus_text(registry):
+    with stage('load'):
+        pass
+    inc('http_retries_total', host='api.test', reason='throttled')
+    text = registry.prometheus()
+    assert '# TYPE ngs2_stage_seconds histogram' in text
+    assert 'ngs2_stage_seconds_bucket{stage="load",le="0.005"} 1' in text
+    assert 'ngs2_stage_seconds_bucket{stage="load",le="+Inf"} 1' in text
+    assert 'ngs2_stage_seconds_count{stage="load"} 1' in text
+    assert '# TYPE ngs2_http_retries_total counter' in text
+    assert ('ngs2_http_retries_total{host="api.test",reason="throttled"} 1' in
+            text)
+
+
+def test_write(registry, tmpdir):
+    with track('bitly', 'shorten'):
+        pass
+    prefix = str(tmpdir.join('links'))
+    registry.write(prefix)
+    assert 'ngs2_api_calls_total' in tmpdir.join('links_metrics.prom').read()
+    with open('{}_metrics.json'.format(prefix)) as f:
+        summary = json.load(f)
+    assert summary['api_call_seconds'][0]['service'] == 'bitly'
+    assert set(summary['api_call_seconds'][0]) >= {'p50', 'p95', 'p99',
+                                                   'rate'}
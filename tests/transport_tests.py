@@ -0,0 +1,131 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import pytest
+import threading
+import time
+
+from NGS2apis.transport import *
+
+
+class FakeSession(object):
+    # answers with `outcomes` in turn: a status code or an exception to raise
+    def __init__(self, outcomes, headers=None, delay=0):
+        self.outcomes = list(outcomes)
+        self.headers = headers or {}
+        self.delay = delay
+        self.calls = []
+        self.active = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def request(self, method, url, **kwargs):
+        with self.lock:
+            self.calls.append((method, url, kwargs.get('timeout')))
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            outcome = self.outcomes.pop(0) if self.outcomes else 200
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+        if isinstance(outcome, Exception):
+            raise outcome
+        return type('Response', (object, ), {'status_code': outcome,
+                                             'headers': self.headers})
+
+
+def transport(outcomes, headers=None, **kwargs):
+    kwargs.setdefault('backoff', .001)
+    client = Transport(**kwargs)
+    client.session = FakeSession(outcomes, headers)
+    return client
+
+
+@pytest.mark.parametrize('method, outcomes, expected_status, expected_calls', [
+    ('GET', [503, 502, 200], 200, 3),
+    ('GET', [503, 503, 503, 503], 503, 4),
+    ('POST', [503, 200], 503, 1),
+    ('POST', [429, 429, 201], 201, 3),
+    ('GET', [404, 200], 404, 1),
+])
+def test_retries(method, outcomes, expected_status, expected_calls):
+    client = transport(outcomes)
+    assert client.request(method, 'https://api.test/x').status_code == \
+        expected_status
+    assert len(client.session.calls) == expected_calls
+
+
+@pytest.mark.parametrize('method, idempotent, expected_calls', [
+    ('GET', None, 2),
+    ('POST', None, 1),
+    ('POST', True, 2),
+])
+def test_connection_errors(method, idempotent, expected_calls):
+    client = transport([requests.ConnectionError('reset')] * 2, retries=1)
+    with pytest.raises(requests.ConnectionError):
+        client.request(method, 'https://api.test/x', idempotent=idempotent)
+    assert len(client.session.calls) == expected_calls
+
+
+def test_retry_after_and_throttle_hook():
+    waits = []
+    client = transport([429, 201], {'Retry-After': '0.05'})
+    start = time.time()
+    assert client.request('POST', 'https://api.test/x',
+                          on_throttle=waits.append).status_code == 201
+    assert waits == [.05]
+    assert time.time() - start >= .05
+
+
+@pytest.mark.parametrize('attempt', [0, 3, 10])
+def test_jittered_backoff(attempt):
+    client = Transport(backoff=.5, max_backoff=2)
+    waits = [client.wait(attempt) for _ in range(50)]
+    assert all(0 <= w <= min(2, .5 * 2 ** attempt) for w in waits)
+    assert len(set(waits)) > 1
+
+
+def test_default_timeout():
+    client = transport([200, 200], timeout=7)
+    client.request('GET', 'https://api.test/x')
+    client.request('GET', 'https://api.test/x', timeout=2)
+    assert [call[2] for call in client.session.calls] == [7, 2]
+
+
+def test_circuit_breaker():
+    client = transport([503] * 4, retries=0, threshold=2, cooldown=.05)
+    for _ in range(2):
+        client.request('GET', 'https://api.test/x')
+    with pytest.raises(CircuitOpen) as e:
+        client.request('GET', 'https://api.test/x')
+    assert 0 < e.value.wait <= .05
+    assert len(client.session.calls) == 2
+
+    # other hosts are unaffected
+    assert client.request('GET', 'https://other.test/x').status_code == 503
+
+    # after the cooldown one trial goes through; a success closes the circuit
+    time.sleep(.06)
+    client.session.outcomes = [200, 200]
+    assert client.request('GET', 'https://api.test/x').status_code == 200
+    assert client.request('GET', 'https://api.test/x').status_code == 200
+
+
+def test_per_host_cap():
+    client = transport([], per_host=2)
+    client.session.delay = .02
+    threads = [threading.Thread(target=client.request,
+                                args=('GET', 'https://api.test/x')) for
+               _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(client.session.calls) == 6
+    assert client.session.peak == 2
+
+
+def test_configure_default(monkeypatch):
+    from NGS2apis import transport as module
+    monkeypatch.setattr(module, '__transport__', None)
+    shared = configure(retries=1)
+    assert default() is shared and default().retries == 1
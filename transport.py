@@ -0,0 +1,204 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import logging
+import random
+import requests
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+
+from NGS2apis import metrics
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+
+logger = logging.getLogger(__name__)
+
+
+# methods safe to repeat after a server error or a dropped connection; a 429
+# means the call was refused outright, so any method is retried on one
+IDEMPOTENT = {'DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT'}
+RETRY_STATUSES = {500, 502, 503, 504}
+
+
+def retry_after(headers, default):
+    # Retry-After in seconds; fall back when it's missing or a date
+    try:
+        return float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return default
+
+
+class CircuitOpen(requests.ConnectionError):
+    # raised before the call goes out, so it is always safe to repeat; `wait`
+    # is how long until the breaker may let a call through again
+    def __init__(self, message, wait=0):
+        requests.ConnectionError.__init__(self, message)
+        self.wait = wait
+
+
+class CircuitBreaker(object):
+    # opens after `threshold` failed calls in a row and refuses calls for
+    # `cooldown` seconds, then lets a single trial call through; a success
+    # closes it again, a failure reopens it
+    def __init__(self, threshold=5, cooldown=30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+            if self.trial or time.time() - self.opened < self.cooldown:
+                return False
+            self.trial = True
+            return True
+
+    def retry_in(self):
+        # seconds left of the cooldown; none once a trial call is out
+        with self.lock:
+            if self.opened is None:
+                return 0
+            return max(self.cooldown - (time.time() - self.opened), 0)
+
+    def record(self, ok):
+        with self.lock:
+            self.trial = False
+            if ok:
+                self.failures = 0
+                self.opened = None
+                return
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened = time.time()
+
+
+class Transport(object):
+    # one pooled keep-alive session for every call, at most `per_host` calls
+    # in flight to a host, a timeout on each, retries with jittered
+    # exponential backoff that honour Retry-After, and a circuit breaker per
+    # host so a service that is down fails fast instead of tying up workers
+    def __init__(self, pool_size=10, per_host=10, retries=3, backoff=.5,
+                 max_backoff=60, timeout=30, threshold=5, cooldown=30):
+        self.per_host = per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.hosts = {}
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        for prefix in ('https://', 'http://'):
+            self.session.mount(prefix, HTTPAdapter(pool_connections=10,
+                                                   pool_maxsize=pool_size))
+
+    def host(self, url):
+        # (concurrency slots, breaker) for the url's host
+        netloc = urlsplit(url).netloc
+        with self.lock:
+            if netloc not in self.hosts:
+                self.hosts[netloc] = (
+                    threading.BoundedSemaphore(self.per_host) if
+                    self.per_host else None,
+                    CircuitBreaker(self.threshold, self.cooldown),
+                )
+            return self.hosts[netloc]
+
+    def wait(self, attempt, response=None):
+        # full jitter, so throttled workers don't retry in lockstep, unless
+        # the server said how long to wait
+        default = random.uniform(0, min(self.max_backoff,
+                                        self.backoff * 2 ** attempt))
+        if response is None:
+            return default
+        return retry_after(response.headers, default)
+
+    def send(self, method, url, **kwargs):
+        # a single call; server errors and dropped connections count against
+        # the host's breaker, throttling doesn't
+        slots, breaker = self.host(url)
+        host = urlsplit(url).netloc
+        if not breaker.allow():
+            metrics.inc('http_circuit_open_total', host=host)
+            raise CircuitOpen('Circuit open for {}.'.format(host),
+                              breaker.retry_in() or self.backoff)
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        if slots is not None:
+            slots.acquire()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.RequestException as e:
+            breaker.record(False)
+            metrics.inc('http_requests_total', host=host,
+                        code=type(e).__name__)
+            raise
+        finally:
+            if slots is not None:
+                slots.release()
+        breaker.record(response.status_code not in RETRY_STATUSES)
+        metrics.inc('http_requests_total', host=host,
+                    code=str(response.status_code))
+        return response
+
+    def request(self, method, url, on_throttle=None, idempotent=None,
+                **kwargs):
+        # returns the last response whatever its status, and raises only once
+        # retries run out; `on_throttle` hears how long each 429 holds us
+        method = method.upper()
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.send(method, url, **kwargs)
+            except CircuitOpen:
+                raise
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if not idempotent or attempt == self.retries:
+                    raise
+                wait = self.wait(attempt)
+                metrics.inc('http_retries_total', host=urlsplit(url).netloc,
+                            reason='connection')
+                logger.info('{} {} failed ({}); retrying in {:.2f}s.'.format(
+                    method, url, type(e).__name__, wait))
+            else:
+                throttled = response.status_code == 429
+                if attempt == self.retries or not (throttled or (
+                        idempotent and
+                        response.status_code in RETRY_STATUSES)):
+                    return response
+                wait = self.wait(attempt, response)
+                if throttled and on_throttle is not None:
+                    on_throttle(wait)
+                metrics.inc('http_retries_total', host=urlsplit(url).netloc,
+                            reason='throttled' if throttled else 'server')
+                logger.info('{} {} answered {}; retrying in {:.2f}s.'.format(
+                    method, url, response.status_code, wait))
+            time.sleep(wait)
+
+
+__transport__ = None
+
+
+def default():
+    # the transport shared by clients not handed one of their own
+    global __transport__
+    if __transport__ is None:
+        __transport__ = Transport()
+    return __transport__
+
+
+def configure(**options):
+    global __transport__
+    __transport__ = Transport(**options)
+    return __transport__